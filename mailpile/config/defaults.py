@@ -244,6 +244,7 @@ CONFIG_RULES = {
         'host':            (_('Host'), str, ''),
         'port':            (_('Port'), int, 993),
         'keepalive':       (_('Keep server connections alive'), bool, False),
+        'connections':     (_('Max simultaneous server connections'), int, 3),
         'discovery':       (_('Mailbox discovery policy'), False, {
             'paths':       (_('Paths to watch for new mailboxes'), 'bin', []),
             'policy':      (_('Default mailbox policy'),
@@ -25,8 +25,8 @@ except ImportError:
 
 import mailpile.platforms
 from mailpile.command_cache import CommandCache
-from mailpile.crypto.streamer import DecryptingStreamer
-from mailpile.crypto.gpgi import GnuPG
+from mailpile.crypto.streamer import DecryptingStreamer, decrypt_buffer
+from mailpile.crypto.gpgi import GnuPG, GNUPG_WORKERS
 from mailpile.eventlog import EventLog, Event, GetThreadEvent
 from mailpile.httpd import HttpWorker
 from mailpile.i18n import gettext as _
@@ -674,16 +674,13 @@ class ConfigManager(ConfigDict):
             with open(pickle_path, 'rb') as fd:
                 master_key = self.get_master_key()
                 if master_key:
-                    from mailpile.crypto.streamer import DecryptingStreamer
-                    with DecryptingStreamer(fd,
-                                            mep_key=master_key,
-                                            name='load_pickle(%s)' % pfn
-                                            ) as streamer:
-                        data = streamer.read()
-                        streamer.verify(_raise=IOError)
+                    # The MAC must be checked before we unpickle anything,
+                    # so this cannot stream.
+                    data = decrypt_buffer(fd, mep_key=master_key,
+                                          name='load_pickle(%s)' % pfn)
+                    return cPickle.loads(data)
                 else:
-                    data = fd.read()
-            return cPickle.loads(data)
+                    return cPickle.load(fd)
         except (cPickle.UnpicklingError, IOError, EOFError, OSError):
             if delete_if_corrupt:
                 safe_remove(pickle_path)
@@ -697,11 +694,11 @@ class ConfigManager(ConfigDict):
                                     dir=self.tempfile_dir(),
                                     header_data={'subject': pfn},
                                     name='save_pickle') as fd:
-                cPickle.dump(obj, fd, protocol=0)
+                cPickle.dump(obj, fd, protocol=cPickle.HIGHEST_PROTOCOL)
                 fd.save(ppath)
         else:
             with open(ppath, 'wb') as fd:
-                cPickle.dump(obj, fd, protocol=0)
+                cPickle.dump(obj, fd, protocol=cPickle.HIGHEST_PROTOCOL)
 
     def _mailbox_info(self, mailbox_id, prefer_local=True):
         try:
@@ -1401,6 +1398,15 @@ class ConfigManager(ConfigDict):
             config.cron_worker.add_task(
                 'save_metadata_index', 900, metadata_index_saver)
 
+            def keyword_journal_flusher():
+                config.save_worker.add_unique_task(
+                    config.background, 'flush_keyword_journal',
+                    lambda: GlobalPostingList.FlushJournal(config.background))
+            config.cron_worker.add_task(
+                'flush_keyword_journal',
+                GlobalPostingList.JOURNAL_FLUSH_SECONDS,
+                keyword_journal_flusher)
+
             def search_history_saver():
                 config.save_worker.add_unique_task(
                     config.background, 'save_search_history',
@@ -1484,10 +1490,15 @@ class ConfigManager(ConfigDict):
             print('Waiting for %s' % save_worker)
 
         from mailpile.postinglist import PLC_CACHE_FlushAndClean
+        from mailpile.postinglist import GlobalPostingList
+        GlobalPostingList.FlushJournal(config.background)
         PLC_CACHE_FlushAndClean(config.background, keep=0)
         config.search_history.save(config)
         save_worker.quit(join=True)
 
+        # Retire any warm GnuPG processes
+        GNUPG_WORKERS.flush()
+
         if config.sys.debug:
             # Hooray!
             print('All stopped!')
@@ -12,6 +12,11 @@ from __future__ import print_function
 #
 # This does mean we need to take special care with our IVs/nonces!
 #
+# For backwards compatibility, we also implement the AES-CBC format used by
+# `openssl enc`, which older versions of Mailpile used to write data at rest.
+# It is only used to read (and migrate away from) that legacy data.
+#
+import hashlib
 import os
 import struct
 from hashlib import md5
@@ -48,7 +53,20 @@ def make_cryptography_utils():
     def aes_ctr_decryptor(key, nonce):
         return _aes_ctr(key, nonce).decryptor().update
 
-    return aes_ctr_encryptor, aes_ctr_decryptor
+    def _aes_cbc(key, iv):
+        return Cipher(
+            algorithms.AES(key),
+            modes.CBC(iv),
+            backend=cryptography.hazmat.backends.default_backend())
+
+    def aes_cbc_encryptor(key, iv):
+        return _aes_cbc(key, iv).encryptor().update
+
+    def aes_cbc_decryptor(key, iv):
+        return _aes_cbc(key, iv).decryptor().update
+
+    return (aes_ctr_encryptor, aes_ctr_decryptor,
+            aes_cbc_encryptor, aes_cbc_decryptor)
 
 
 def make_pycrypto_utils():
@@ -82,26 +100,36 @@ def make_pycrypto_utils():
     def aes_ctr_decryptor(key, nonce):
         return _aes_ctr(key, nonce).decrypt
 
-    return aes_ctr_encryptor, aes_ctr_decryptor
+    def aes_cbc_encryptor(key, iv):
+        return AES.new(key, mode=AES.MODE_CBC, IV=iv).encrypt
+
+    def aes_cbc_decryptor(key, iv):
+        return AES.new(key, mode=AES.MODE_CBC, IV=iv).decrypt
+
+    return (aes_ctr_encryptor, aes_ctr_decryptor,
+            aes_cbc_encryptor, aes_cbc_decryptor)
 
 
 def make_dummy_utils():
-    def aes_ctr_encryptor(key):
+    def aes_ctr_encryptor(key, nonce):
         return lambda d: d
 
-    def aes_ctr_decryptor(key):
+    def aes_ctr_decryptor(key, nonce):
         return lambda d: d
 
-    return aes_ctr_encryptor, aes_ctr_decryptor
+    return (aes_ctr_encryptor, aes_ctr_decryptor,
+            aes_ctr_encryptor, aes_ctr_decryptor)
 
 
 ##############################################################################
 
 try:
-    aes_ctr_encryptor, aes_ctr_decryptor = make_cryptography_utils()
+    (aes_ctr_encryptor, aes_ctr_decryptor,
+     aes_cbc_encryptor, aes_cbc_decryptor) = make_cryptography_utils()
 except ImportError:
     try:
-        aes_ctr_encryptor, aes_ctr_decryptor = make_pycrypto_utils()
+        (aes_ctr_encryptor, aes_ctr_decryptor,
+         aes_cbc_encryptor, aes_cbc_decryptor) = make_pycrypto_utils()
     except ImportError:
         raise ImportError("Please pip install cryptography (or pycrypto)")
 
@@ -121,6 +149,111 @@ def aes_ctr_decrypt(key, iv, data):
     return aes_ctr_decryptor(key, iv)(data)
 
 
+##############################################################################
+
+# Key lengths of the `openssl enc` ciphers we know how to handle ourselves
+OPENSSL_CIPHERS = {
+    'aes-128-cbc': 16,
+    'aes-192-cbc': 24,
+    'aes-256-cbc': 32}
+
+OPENSSL_MAGIC = 'Salted__'
+AES_BLOCK = 16
+
+
+def openssl_key_and_iv(password, salt, key_len, md_alg='md5'):
+    """Derive a key and IV from a password, like EVP_BytesToKey() does."""
+    derived = digest = ''
+    while len(derived) < key_len + AES_BLOCK:
+        digest = hashlib.new(md_alg, digest + password + salt).digest()
+        derived += digest
+    return derived[:key_len], derived[key_len:key_len + AES_BLOCK]
+
+
+class OpenSSLEncryptor(object):
+    """
+    An in-process equivalent of `openssl enc -e -<cipher> -md <md_alg>`,
+    without the base64 encoding. Call it with plaintext, get back
+    ciphertext; call finish() at the end to get the padded final block.
+
+    The output always comes in multiples of `align` bytes (except from
+    finish()), so it can be base64 encoded chunk by chunk.
+    """
+    def __init__(self, password, cipher='aes-256-cbc', md_alg='md5',
+                 salt=None, align=3 * AES_BLOCK):
+        salt = salt or os.urandom(8)
+        key, iv = openssl_key_and_iv(password, salt,
+                                     OPENSSL_CIPHERS[cipher], md_alg)
+        self.encryptor = aes_cbc_encryptor(key, iv)
+        self.align = align
+        self.plaintext = ''
+        self.output = OPENSSL_MAGIC + salt
+
+    def __call__(self, data):
+        self.plaintext += data
+        usable = len(self.plaintext) - (len(self.plaintext) % AES_BLOCK)
+        if usable:
+            self.output += self.encryptor(self.plaintext[:usable])
+            self.plaintext = self.plaintext[usable:]
+        usable = len(self.output) - (len(self.output) % self.align)
+        data, self.output = self.output[:usable], self.output[usable:]
+        return data
+
+    def finish(self):
+        padding = AES_BLOCK - len(self.plaintext)
+        data = self.output + self.encryptor(self.plaintext +
+                                            chr(padding) * padding)
+        self.plaintext = self.output = ''
+        return data
+
+
+class OpenSSLDecryptor(object):
+    """
+    An in-process equivalent of `openssl enc -d -<cipher> -md <md_alg>`,
+    without the base64 decoding. Call it with ciphertext, get back
+    plaintext; call finish() at the end to check and strip the padding.
+    Bad data (or a bad key) raises ValueError.
+    """
+    def __init__(self, password, cipher='aes-256-cbc', md_alg='md5'):
+        self.password = password
+        self.key_len = OPENSSL_CIPHERS[cipher]
+        self.md_alg = md_alg
+        self.decryptor = None
+        self.buffered = ''
+
+    def __call__(self, data):
+        self.buffered += data
+        if self.decryptor is None:
+            if len(self.buffered) < len(OPENSSL_MAGIC) + 8:
+                return ''
+            if not self.buffered.startswith(OPENSSL_MAGIC):
+                raise ValueError('Bad magic number')
+            salt = self.buffered[len(OPENSSL_MAGIC):len(OPENSSL_MAGIC) + 8]
+            key, iv = openssl_key_and_iv(self.password, salt,
+                                         self.key_len, self.md_alg)
+            self.decryptor = aes_cbc_decryptor(key, iv)
+            self.buffered = self.buffered[len(OPENSSL_MAGIC) + 8:]
+
+        # Always hold back the last block, it contains the padding.
+        usable = len(self.buffered) - 1
+        usable -= usable % AES_BLOCK
+        if usable <= 0:
+            return ''
+        data, self.buffered = self.buffered[:usable], self.buffered[usable:]
+        return self.decryptor(data)
+
+    def finish(self):
+        if self.decryptor is None or len(self.buffered) != AES_BLOCK:
+            raise ValueError('Bad decrypt')
+        data = self.decryptor(self.buffered)
+        padding = ord(data[-1])
+        if not (0 < padding <= AES_BLOCK and
+                data[-padding:] == data[-1] * padding):
+            raise ValueError('Bad decrypt')
+        self.buffered = ''
+        return data[:-padding]
+
+
 if __name__ == "__main__":
     import base64
 
@@ -131,7 +264,8 @@ if __name__ == "__main__":
     results = []
     for name, backend in (('Cryptography', make_cryptography_utils),
                           ('pyCrypto', make_pycrypto_utils)):
-        aes_ctr_encryptor, aes_ctr_decryptor = backend()
+        (aes_ctr_encryptor, aes_ctr_decryptor,
+         aes_cbc_encryptor, aes_cbc_decryptor) = backend()
 
         ct1 = aes_ctr_encryptor(bogus_key, bogus_nonce)(hello)
         results.append((name, base64.b64encode(ct1)))
@@ -163,4 +297,36 @@ if __name__ == "__main__":
     decrypted = aes_ctr_decrypt(legacy_key, legacy_nonce, legacy_ct)
     assert(legacy_data == decrypted)
 
+    # Verify we can read what `openssl enc -e -a -aes-256-cbc -md md5`
+    # wrote for us, and that a round-trip through our own code works.
+    legacy_ct = base64.b64decode(
+        "U2FsdGVkX18tcJkDBbEC2REZY1XwGNQ6aiAqLxJr1aVnEqKfv640W9+YBwFOYqga"
+        "FBo+qB2F5+l0yeUSExuCow==")
+    for name, backend in (('Cryptography', make_cryptography_utils),
+                          ('pyCrypto', make_pycrypto_utils)):
+        (aes_ctr_encryptor, aes_ctr_decryptor,
+         aes_cbc_encryptor, aes_cbc_decryptor) = backend()
+
+        for step in (1, 7, 16, len(legacy_ct)):
+            decryptor = OpenSSLDecryptor(legacy_key)
+            decrypted = ''.join(decryptor(legacy_ct[i:i+step])
+                                for i in range(0, len(legacy_ct), step))
+            assert(legacy_data * 2 == decrypted + decryptor.finish())
+
+        for length in (0, 1, 15, 16, 17, 1000):
+            encryptor = OpenSSLEncryptor(legacy_key)
+            ct = encryptor(hello[:1] * length)
+            assert(len(ct) % 48 == 0)
+            ct += encryptor.finish()
+            decryptor = OpenSSLDecryptor(legacy_key)
+            assert(decryptor(ct) + decryptor.finish() == hello[:1] * length)
+
+        try:
+            decryptor = OpenSSLDecryptor('bogus key')
+            decryptor(legacy_ct)
+            decryptor.finish()
+            assert(not 'reached')
+        except ValueError:
+            pass
+
     print("ok")
@@ -2,6 +2,7 @@
 from __future__ import print_function
 import os
 import string
+import struct
 import sys
 import time
 import re
@@ -14,6 +15,9 @@ import select
 import pgpdump
 import pgpdump.utils
 import base64
+import copy
+import errno
+import hashlib
 import quopri
 from datetime import datetime
 from email.parser import Parser
@@ -497,6 +501,357 @@ class StreamWriter(Thread):
             fd.close()
 
 
+class GnuPGWorkerPool(object):
+    """
+    Starting GnuPG is slow, so for the common operations which read all
+    their input from stdin (decrypting and verifying), we keep a few warm
+    worker processes waiting: they have already been spawned and have
+    initialized, and only need to be fed the passphrase (if any) and the
+    data. Replacements are started by a background thread, while the
+    previous requests are still being handled, so bursts of requests
+    (rendering a thread full of signed messages) do not wait for GnuPG
+    to start up.
+
+    Workers are keyed by their full command line (minus the status file),
+    so they are only used if nothing about the request differs. Idle
+    workers are retired after MAX_IDLE seconds, and all of them are
+    retired if the keyring changes (see flush()).
+
+    Workers belong to the process which started them. If we find we have
+    been forked (the parser pool does this), the inherited workers are
+    forgotten without touching their pipes, which the parent still uses,
+    and the child starts its own.
+    """
+    OPERATIONS = (('--decrypt',), ('--verify',))
+    WORKERS = 2
+    MAX_IDLE = 60
+    STATUS_FILE = '--status-file='
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.pending = set()
+        self.preparing = False
+        self.generation = 0
+
+    def _check_fork(self):
+        # After a fork, the lock may be held by a thread which only exists
+        # in the parent, so we replace everything instead of locking.
+        if self.pid != os.getpid():
+            self._reset()
+
+    def _key(self, args):
+        return tuple((None if a.startswith(self.STATUS_FILE) else a)
+                     for a in args)
+
+    def take(self, args):
+        """
+        Return a warm (process, status filename) tuple for running args,
+        or None if we have none.
+        """
+        self._check_fork()
+        key = self._key(args)
+        while True:
+            with self.lock:
+                workers = self.idle.get(key)
+                if not workers:
+                    return None
+                worker = workers.pop(0)
+            if worker[1] != os.getpid():
+                continue
+            if (worker[0] > time.time() - self.MAX_IDLE and
+                    worker[2].poll() is None):
+                return worker[2:]
+            self._retire(worker)
+
+    def prepare(self, args):
+        """Make sure warm workers will be ready the next time args run."""
+        self._check_fork()
+        with self.lock:
+            self.pending.add(self._key(args))
+            if self.preparing:
+                return
+            self.preparing = True
+        thr = threading.Thread(target=self._prepare_workers,
+                               name='GnuPG workers')
+        thr.daemon = True
+        thr.start()
+
+    def _prepare_workers(self):
+        while True:
+            self.expire()
+            with self.lock:
+                if not self.pending:
+                    self.preparing = False
+                    return
+                key = self.pending.pop()
+                wanted = self.WORKERS - len(self.idle.get(key, []))
+                generation = self.generation
+            for i in range(0, wanted):
+                fd = tempfile.NamedTemporaryFile(delete=False)
+                fd.close()  # Avoid potential conflicts on Windows
+                try:
+                    proc = Popen([(self.STATUS_FILE + fd.name) if (a is None)
+                                  else a for a in key],
+                                 stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                                 bufsize=0, long_running=True)
+                except (IOError, OSError):
+                    os.remove(fd.name)
+                    break
+                worker = (time.time(), os.getpid(), proc, fd.name)
+                with self.lock:
+                    if generation == self.generation:
+                        self.idle.setdefault(key, []).append(worker)
+                        worker = None
+                if worker is not None:
+                    # The keyring changed while we were starting up
+                    self._retire(worker)
+                    break
+
+    def expire(self, max_idle=None):
+        """Retire workers which have been idle for too long."""
+        self._check_fork()
+        deadline = time.time() - (self.MAX_IDLE if (max_idle is None)
+                                  else max_idle)
+        expired = []
+        with self.lock:
+            for key, workers in self.idle.items():
+                expired.extend(w for w in workers if w[0] <= deadline)
+                workers[:] = [w for w in workers if w[0] > deadline]
+                if not workers:
+                    del self.idle[key]
+        for worker in expired:
+            self._retire(worker)
+
+    def flush(self):
+        """Retire all workers, they may have outdated keyring state."""
+        self._check_fork()
+        with self.lock:
+            self.generation += 1
+        self.expire(max_idle=-1)
+
+    def _retire(self, worker):
+        ts, pid, proc, status_filename = worker
+        try:
+            for fd in (proc.stdin, proc.stdout, proc.stderr):
+                fd.close()
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        except (IOError, OSError):
+            pass
+        try:
+            os.remove(status_filename)
+        except OSError:
+            pass
+
+
+GNUPG_WORKERS = GnuPGWorkerPool()
+
+
+class GnuPGKeyringCache(object):
+    """
+    Listing keys means starting GnuPG and parsing all of its output, which
+    adds up when we look up keys for each recipient while composing. So we
+    keep the parsed key lists around, indexed by fingerprint, key ID,
+    e-mail address and keygrip, and answer lookups from memory.
+
+    Cached lists are discarded when the keyring files change on disk, when
+    Mailpile itself changes the keyring (see keyring_changed()) or after
+    MAX_AGE seconds, as key validity also depends on the clock.
+
+    Only selectors we can evaluate exactly are answered from the cache:
+
+    >>> GnuPGKeyringCache.selector_term('0xD13C70DA')
+    'd13c70da'
+    >>> GnuPGKeyringCache.selector_term('<Bre@example.com>')
+    '<bre@example.com>'
+    >>> GnuPGKeyringCache.selector_term('bre@example')
+    ('@', 'bre@example')
+    >>> GnuPGKeyringCache.selector_term('Bjarni') is None
+    True
+    """
+    MAX_AGE = 3600
+    KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'secring.gpg',
+                     'trustdb.gpg', 'private-keys-v1.d')
+    HEX_KEYID_LENGTHS = (8, 16, 40)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keyrings = {}
+        self.homedirs = {}
+        self.generation = 0
+
+    @classmethod
+    def selector_term(cls, selector):
+        """Return the index term for a selector, or None if unsupported."""
+        sel = selector.strip().lower()
+        if sel.startswith('0x'):
+            sel = sel[2:]
+        if sel.startswith('&'):
+            hexdigits = sel[1:]
+        else:
+            hexdigits = sel
+        if (hexdigits and all(c in string.hexdigits for c in hexdigits) and
+                (len(hexdigits) in cls.HEX_KEYID_LENGTHS or sel[:1] == '&')):
+            return sel
+        if sel.startswith('<') and sel.endswith('>') and '@' in sel:
+            return sel
+        if ('@' in sel and sel[:1] not in ('=', '*', '+', '#', '@') and
+                not any(c in string.whitespace for c in sel)):
+            # GnuPG does a substring match on the user ID
+            return ('@', sel)
+        return None
+
+    def _index(self, keys):
+        index = {}
+
+        def _add(term, fprint):
+            if term:
+                index.setdefault(term.lower(), set()).add(fprint)
+
+        for fprint, info in keys.iteritems():
+            for key in [info] + info.get('subkeys', []):
+                for kid in (key.get('fingerprint'), key.get('keyid')):
+                    for l in self.HEX_KEYID_LENGTHS:
+                        if kid and len(kid) >= l:
+                            _add(kid[-l:], fprint)
+                if key.get('keygrip'):
+                    _add('&' + key['keygrip'], fprint)
+            _add(fprint, fprint)
+            for uid in info.get('uids', []):
+                if uid.get('email'):
+                    _add('<%s>' % uid['email'], fprint)
+        return index
+
+    def _stamp(self, gnupg):
+        homedir = gnupg.homedir
+        if not homedir:
+            with self.lock:
+                homedir = self.homedirs.get(gnupg.gpgbinary)
+            if not homedir:
+                # Ask GnuPG without holding the lock, it takes a while
+                homedir = gnupg.gnupghome()
+                with self.lock:
+                    self.homedirs[gnupg.gpgbinary] = homedir
+        stamp = []
+        for fn in self.KEYRING_FILES:
+            try:
+                st = os.stat(os.path.join(homedir, fn))
+                stamp.append((fn, st.st_mtime, st.st_size))
+            except OSError:
+                pass
+        return tuple(stamp)
+
+    def keyring(self, gnupg, which, loader):
+        """
+        Return a (keys, index) tuple for the given keyring, using loader()
+        to (re)load the full key list if our copy is missing or stale.
+        """
+        cache_key = (gnupg.gpgbinary, gnupg.homedir, which)
+        stamp = self._stamp(gnupg)
+        with self.lock:
+            cached = self.keyrings.get(cache_key)
+            generation = self.generation
+        if cached and cached[0] > time.time() and cached[1] == stamp:
+            return cached[2:]
+
+        keys = loader()
+        index = self._index(keys)
+        with self.lock:
+            # Only keep the result if the keyring didn't change meanwhile
+            if generation == self.generation:
+                self.keyrings[cache_key] = (time.time() + self.MAX_AGE,
+                                            stamp, keys, index)
+        return keys, index
+
+    def lookup(self, index, term):
+        """Return the set of fingerprints matching a selector term."""
+        if isinstance(term, tuple):
+            found = set()
+            for t, fprints in index.iteritems():
+                if t[:1] == '<' and term[1] in t:
+                    found |= fprints
+            return found
+        return index.get(term, set())
+
+    def flush(self):
+        """Discard all cached key lists."""
+        with self.lock:
+            self.generation += 1
+            self.keyrings = {}
+
+
+GNUPG_KEYRINGS = GnuPGKeyringCache()
+
+
+class GnuPGVerifyCache(object):
+    """
+    Signatures verified ahead of time (see GnuPG.verify_batch), waiting for
+    the GnuPG.verify() call which would otherwise have checked them. Each
+    result is used once, and results are discarded if the keyring changes
+    or if nobody asks for them within MAX_AGE seconds.
+    """
+    MAX_AGE = 600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def key(self, gnupg, data, signature=None):
+        digest = hashlib.sha256()
+        for d in (data, '\0', signature or ''):
+            if isinstance(d, unicode):
+                d = d.encode('utf-8')
+            digest.update(d)
+        return (gnupg.gpgbinary, gnupg.homedir, digest.hexdigest())
+
+    def put(self, key, signature_info):
+        now = time.time()
+        with self.lock:
+            for k, (ts, si) in self.results.items():
+                if ts < now - self.MAX_AGE:
+                    del self.results[k]
+            self.results[key] = (now, signature_info)
+
+    def pop(self, key):
+        with self.lock:
+            ts, si = self.results.pop(key, (0, None))
+        if ts > time.time() - self.MAX_AGE:
+            return si
+        return None
+
+    def flush(self):
+        with self.lock:
+            self.results = {}
+
+
+GNUPG_VERIFIED = GnuPGVerifyCache()
+
+# These arguments may change the keyring, so when we see them we discard
+# any warm workers and cached key lists or signature checks, as they may
+# be stale.
+KEYRING_CHANGING_ARGS = set([
+    '--import', '--recv-key', '--sign-key', '--edit-key', '--delete-key',
+    '--delete-secret-key', '--delete-secret-and-public-key',
+    '--gen-key', '--full-gen-key', '--quick-gen-key', '--gen-revoke'])
+
+
+def keyring_changed(args=None):
+    """
+    Note that the keyring (may have) changed; if args are given, only if
+    they include an operation which changes the keyring.
+    """
+    if args is None or KEYRING_CHANGING_ARGS & set(args):
+        GNUPG_WORKERS.flush()
+        GNUPG_KEYRINGS.flush()
+        GNUPG_VERIFIED.flush()
+
+
 DEBUG_GNUPG = False
 
 class GnuPG:
@@ -516,6 +871,9 @@ class GnuPG:
 
     LAST_KEY_USED = 'DEFAULT'  # This is a 1-value global cache
 
+    VERIFY_BATCH_SIZE = 32
+    VERIFY_TIMEOUT = 60
+
     def __init__(self, config,
                  session=None, use_agent=None, debug=False, dry_run=False,
                  event=None, passphrase=None):
@@ -690,6 +1048,8 @@ class GnuPG:
         else:
             version = self.version_tuple()
 
+        warm = (self.status_filenames and
+                tuple(args or []) in GnuPGWorkerPool.OPERATIONS)
         args = self.common_args(
             args=list(args if args else []),
             version=version,
@@ -708,7 +1068,14 @@ class GnuPG:
 
             # Here we go!
             self.event.update_args(args)
-            proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0)
+            worker = warm and GNUPG_WORKERS.take(args)
+            if worker:
+                proc, status_filename = worker
+                os.remove(self.status_filenames[-1])
+                self.status_filenames[-1] = status_filename
+            else:
+                proc = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                             bufsize=0)
 
             # GnuPG is a bit crazy, and requires that the passphrase
             # be sent and the filehandle closed before anything else
@@ -770,6 +1137,12 @@ class GnuPG:
         if outputfd:
             outputfd.close()
 
+        # Get ready for next time, or note that the keyring has changed.
+        if warm:
+            GNUPG_WORKERS.prepare(args)
+        else:
+            keyring_changed(args)
+
         if gpg_retcode != 0 and _raise:
             raise _raise('GnuPG failed, exit code: %s' % gpg_retcode)
 
@@ -805,13 +1178,42 @@ class GnuPG:
         rlp = GnuPGRecordParser()
         return rlp.parse(keylist)
 
+    def _cached_keys(self, which, loader, selectors, complete=True):
+        """
+        Answer a key listing from GNUPG_KEYRINGS, returning None if the
+        selectors are not ones the cache can evaluate. Callers get their
+        own copies of the key data, as some of them modify it.
+        """
+        terms = [GnuPGKeyringCache.selector_term(s) for s in selectors or []]
+        if None in terms:
+            return None
+        keys, index = GNUPG_KEYRINGS.keyring(self, which, loader)
+        if not terms:
+            fprints = keys.keys()
+        else:
+            fprints = set()
+            for term in set(terms):
+                found = GNUPG_KEYRINGS.lookup(index, term)
+                if not (found or complete):
+                    return None
+                fprints |= found
+        return dict((fp, copy.deepcopy(keys[fp])) for fp in fprints)
+
     def list_keys(self, selectors=None):
         """
         >>> g = GnuPG(None)
         >>> g.list_keys()[0]
         0
         """
+        keys = self._cached_keys('public', self._list_keys, selectors)
+        if keys is None:
+            keys = self._list_keys(selectors)
+        return keys
+
+    def _list_keys(self, selectors=None):
         list_keys = ["--fingerprint"]
+        if self.version_tuple() >= (2, 1):
+            list_keys += ["--with-keygrip"]
         for sel in set(selectors or []):
             list_keys += ["--list-keys", sel]
         if not selectors:
@@ -822,6 +1224,15 @@ class GnuPG:
         return self.parse_keylist(retvals[1]["stdout"])
 
     def list_secret_keys(self, selectors=None):
+        # Without selectors, GnuPG < 2.1 does not list every key (see
+        # below), so a miss in the cache is only conclusive on 2.1+.
+        keys = self._cached_keys('secret', self._list_secret_keys, selectors,
+                                 complete=(self.version_tuple() >= (2, 1)))
+        if keys is None:
+            keys = self._list_secret_keys(selectors)
+        return keys
+
+    def _list_secret_keys(self, selectors=None):
         #
         # Note: The selectors that are passed by default work around a bug
         #       in GnuPG < 2.1, where --list-secret-keys does not list
@@ -1238,6 +1649,10 @@ class GnuPG:
             clearsign=True)[1]
         >>> g.verify(s)
         """
+        si = GNUPG_VERIFIED.pop(GNUPG_VERIFIED.key(self, data, signature))
+        if si is not None:
+            return si
+
         params = ["--verify"]
         if signature:
             sig = tempfile.NamedTemporaryFile()
@@ -1253,6 +1668,161 @@ class GnuPG:
         rp = GnuPGResultParser(debug=self.debug)
         return rp.parse([None, retvals]).signature_info
 
+    def verify_batch(self, items):
+        """
+        Verify many (data, signature) pairs, as would be passed to verify(),
+        starting GnuPG as few times as possible. Returns a list of results,
+        with None wherever we did not get a conclusive answer; those should
+        be checked one at a time, using verify().
+        """
+        results = [None for i in items]
+        if mailpile.platforms.WindowsPopenSemantics():
+            return results  # We cannot hand GnuPG extra pipes
+
+        messages = [self._as_signed_message(d, s) for d, s in items]
+        pending = [i for i, m in enumerate(messages) if m is not None]
+        while pending:
+            batch = pending[:self.VERIFY_BATCH_SIZE]
+            self.event.running_gpg(_('Checking %d signatures') % len(batch))
+            checked = self._verify_files([messages[i] for i in batch])
+            if not checked:
+                break
+
+            # GnuPG gives up on the whole list at the first bad signature,
+            # so only files it finished with get results here; the rest
+            # of the list goes into the next round.
+            for j, (status, complete) in checked.iteritems():
+                if complete:
+                    rp = GnuPGResultParser(debug=self.debug)
+                    results[batch[j]] = rp.parse([None, {
+                        'status': status, 'stdout': [], 'stderr': []
+                        }]).signature_info
+            pending = pending[max(checked.keys()) + 1:]
+
+        return results
+
+    def _as_signed_message(self, data, signature):
+        """
+        GnuPG's --verify-files cannot check detached signatures, so we turn
+        the data and its armored signature into an old style signed message
+        instead: the signature packets followed by a literal data packet.
+        Returns None for things we cannot check this way.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not signature:
+            if data.lstrip().startswith(self.ARMOR_BEGIN_SIGNED):
+                return data
+            return None
+
+        lines = [l.strip() for l in signature.strip().splitlines()]
+        if not lines or lines[0] != self.ARMOR_BEGIN_SIGNATURE:
+            return None
+        try:
+            blank = lines.index('', 1)
+            sig = base64.b64decode(''.join(
+                l for l in lines[blank+1:] if l[:1] not in ('=', '-')))
+        except (ValueError, TypeError):
+            return None
+
+        body = 'b\0\0\0\0\0' + data  # Binary, no file name, no date
+        length = len(body)
+        if length < 192:
+            length = chr(length)
+        elif length < 8384:
+            length -= 192
+            length = chr((length >> 8) + 192) + chr(length & 0xff)
+        else:
+            length = '\xff' + struct.pack('>I', length)
+        return sig + '\xcb' + length + body
+
+    def _verify_files(self, messages):
+        """
+        Feed messages to a single GnuPG --verify-files, each through a pipe
+        of its own. Returns a dict mapping the index of every message GnuPG
+        looked at to a tuple of its status lines and whether it finished.
+        """
+        import fcntl
+
+        pipes = [os.pipe() for m in messages]
+        names = dict(('-&%d' % r, i) for i, (r, w) in enumerate(pipes))
+        unclosed = set(fd for p in pipes for fd in p)
+        output, writing, proc = [], {}, None
+        try:
+            if max(unclosed) >= 1024:
+                return {}  # Too many files open for select() or Popen
+
+            proc = Popen(self.common_args(args=[
+                             '--status-fd=1', '--enable-special-filenames',
+                             '--verify-files', '--'
+                         ] + sorted(names, key=lambda n: names[n])),
+                         stdout=PIPE, bufsize=0,
+                         keep_open=[r for r, w in pipes])
+            for (r, w), message in zip(pipes, messages):
+                os.close(r)
+                unclosed.remove(r)
+                fcntl.fcntl(w, fcntl.F_SETFL,
+                            fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+                writing[w] = [message, 0]
+
+            # GnuPG may skip ahead in its list of files without reading
+            # everything, so we write to whichever pipe it is ready for.
+            stdout = proc.stdout.fileno()
+            last_activity = time.time()
+            while time.time() - last_activity < self.VERIFY_TIMEOUT:
+                try:
+                    readable, writable, x = select.select(
+                        [stdout], writing.keys(), [], 1)
+                except select.error:
+                    continue
+                for w in writable:
+                    message, offset = writing[w]
+                    try:
+                        offset += os.write(
+                            w, message[offset:offset + BLOCKSIZE])
+                    except OSError as e:
+                        if e.errno in (errno.EAGAIN, errno.EINTR):
+                            continue
+                        offset = len(message)  # GnuPG moved on
+                    if offset < len(message):
+                        writing[w][1] = offset
+                    else:
+                        del writing[w]
+                        os.close(w)
+                        unclosed.remove(w)
+                if readable:
+                    data = os.read(stdout, BLOCKSIZE)
+                    if not data:
+                        break
+                    output.append(data)
+                if readable or writable:
+                    last_activity = time.time()
+        finally:
+            for fd in unclosed:
+                os.close(fd)
+            if proc:
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.stdout.close()
+                proc.wait()
+
+        checked, current = {}, None
+        for line in ''.join(output).splitlines(True):
+            self.debug('<<STATUS<< %s' % line)
+            elems = line.replace("[GNUPG:] ", "").split(" ")
+            keyword = elems[0].strip()
+            if keyword == 'FILE_START':
+                current = names.get(elems[-1].strip())
+                if current is not None:
+                    checked[current] = ([], False)
+            elif keyword == 'FILE_DONE':
+                if current is not None:
+                    checked[current] = (checked[current][0], True)
+                current = None
+            elif current is not None:
+                checked[current][0].append(elems)
+        return checked
+
     def encrypt(self, data, tokeys=[], armor=True,
                             sign=False, fromkey=None, throw_keyids=False):
         """
@@ -1438,7 +2008,7 @@ class GnuPG:
 
     def address_to_keys(self, address):
         res = {}
-        keys = self.list_keys(selectors=[address])
+        keys = self.list_keys(selectors=['<%s>' % address])
         for key, props in keys.iteritems():
             if any([x["email"] == address for x in props["uids"]]):
                 res[key] = props
@@ -1489,6 +2059,7 @@ class GnuPG:
                 self.event.update_return_code(proc.wait())
             else:
                 self.event.update_return_code(-1)
+            keyring_changed()
 
 
 def GetKeys(gnupg, config, people):
@@ -1556,6 +2127,27 @@ def GetKeys(gnupg, config, people):
     return keys
 
 
+class GnuPGSignatureCollector(GnuPG):
+    """
+    This stands in for GnuPG when unwrapping MIME crypto, collecting the
+    arguments of the verify() calls which would have been made instead of
+    checking anything, so they can be checked all at once using
+    GnuPG.verify_batch(). Decryption is not attempted.
+    """
+    def __init__(self, collected, *args, **kwargs):
+        GnuPG.__init__(self, *args, **kwargs)
+        self.collected = collected
+
+    def verify(self, data, signature=None):
+        self.collected.append((data, signature))
+        si = SignatureInfo()
+        si["protocol"] = "openpgp"
+        return si
+
+    def decrypt(self, *args, **kwargs):
+        raise ValueError('Not decrypting while collecting signatures')
+
+
 class OpenPGPMimeSigningWrapper(MimeSigningWrapper):
     CONTAINER_PARAMS = (('micalg', 'pgp-sha512'),
                         ('protocol', 'application/pgp-signature'))
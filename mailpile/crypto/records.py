@@ -1,5 +1,5 @@
 #
-# NOTE: THIS CODE IS NOT BEING USED - YET.
+# NOTE: THIS CODE IS ONLY USED BY EXPERIMENTS (see mailpile/index/records.py).
 #       IT IS HERE TO FACILITATE REVIEW, COMMENTS AND EXPERIMENTS.
 #
 # FIXME:  Respond to following comment from Kai Michaelis
@@ -251,6 +251,10 @@ class EncryptedRecordStore(_SimpleList):
             self._fd.flush()
             self._header_skip = len(header)
 
+    def flush(self):
+        with self._lock:
+            self._fd.flush()
+
     def close(self):
         self._write_header()
         self._fd.close()
@@ -429,8 +433,10 @@ class EncryptedBlobStore(_SimpleList):
                 overwrite=self._overwrite))
 
     def __getitem__(self, pos):
-        shard, pos = pos // self._shard_size, pos % self._shard_size
-        value = self._shards[shard][pos]
+        shard, spos = pos // self._shard_size, pos % self._shard_size
+        if shard >= len(self._shards):
+            raise KeyError('Out of range: %s' % pos)
+        value = self._shards[shard][spos]
         if value.startswith(self._BIG_POINTER):
             self._big_map[pos] = int(value[len(self._BIG_POINTER):], 16)
             return self._big()[self._big_map[pos]]
@@ -438,23 +444,45 @@ class EncryptedBlobStore(_SimpleList):
             return value
 
     def __setitem__(self, pos, data):
-        shard, pos = pos // self._shard_size, pos % self._shard_size
+        # Note: The big-map is keyed by the global position, as the local
+        #       positions within each shard are not unique.
+        shard, spos = pos // self._shard_size, pos % self._shard_size
         with self._lock:
             while shard >= len(self._shards):
                 self._load_next_shard()
         if len(data) > self.s0._MAX_DATA_SIZE:
             with self._lock:
-                bpos = self._big_map.get(pos, len(self._big()))
+                bpos = self._big_map.get(pos)
+                if bpos is None:
+                    # Reuse the old big record, if there is one.
+                    old = self._shards[shard].get(spos, '')
+                    if old.startswith(self._BIG_POINTER):
+                        bpos = int(old[len(self._BIG_POINTER):], 16)
+                    else:
+                        bpos = len(self._big())
                 self._big()[bpos] = data
                 self._big_map[pos] = bpos
                 data = '%s%x' % (self._BIG_POINTER, bpos)
-        self._shards[shard][pos] = data
+        self._shards[shard][spos] = data
+
+    def get(self, pos, default=None):
+        try:
+            return self[pos]
+        except (KeyError, ValueError):
+            return default
 
     def __len__(self):
         with self._lock:
             return (self._shard_size * (len(self._shards) - 1) +
                     len(self._shards[-1]))
 
+    def flush(self):
+        with self._lock:
+            for s in self._shards:
+                s.flush()
+            if self._big_shard is not None:
+                self._big_shard.flush()
+
     def close(self):
         with self._lock:
             for s in self._shards:
@@ -483,9 +511,14 @@ class EncryptedDict(object):
     that do not fit alongside the keys. At the moment, data can be
     overwritten, but not deleted.
 
+    If cluster_hot_keys is set, saving a value which does not fit in its
+    hash bucket will bump the smallest inline value from the bucket to a
+    later keyset, if the new value is larger. As value size correlates
+    with popularity (see above), this clusters the hot keys at the front
+    of the dict, where the OS will cache them.
+
     TODO:
         - Grow the dict by adding keysets
-        - Migrating "exciting" keys to the primary keyset
     """
 
     DEFAULT_BUCKET_SIZE = 5
@@ -508,7 +541,8 @@ class EncryptedDict(object):
                  digest_size=None,
                  overwrite=False,
                  init_zeros=True,
-                 sparse=False):
+                 sparse=False,
+                 cluster_hot_keys=False):
         self._base_fn = base_fn
         self._key = key
         self._key_bytes = key_bytes or self.DEFAULT_KEY_BYTES
@@ -523,6 +557,7 @@ class EncryptedDict(object):
         self._overwrite = overwrite
         self._sparse = sparse
         self._init_zeros = init_zeros
+        self._on_fail = self._bump_smaller if cluster_hot_keys else None
 
         self._lock = threading.RLock()
 
@@ -672,7 +707,34 @@ class EncryptedDict(object):
         else:
             return None
 
+    def _bump_smaller(self, dct, kfi, keyset, pos, digest, value, records):
+        if (self._values is None and
+                len(digest) + 1 + len(value) > keyset._MAX_DATA_SIZE):
+            return None
+        victims = sorted((len(r[1]), r) for r in records
+                         if r[1][self._digest_size:self._digest_size+1] == '=')
+        if not victims or victims[0][0] - self._digest_size - 1 >= len(value):
+            return None
+
+        # Free the victim's slot, take it, and then find the victim a new
+        # home; its bucket in this keyset is now full, so it moves on.
+        # Stale copies (shadowed by a copy in an earlier keyset) are just
+        # dropped, as moving them would overwrite the current value.
+        rpos, rdata = victims[0][1]
+        vdigest = self.rdata_digest(rdata)
+        try:
+            live_keyset, (live_rpos, _) = self.load_digest_record(vdigest)
+            live = (live_keyset is keyset and live_rpos == rpos)
+        except (KeyError, ValueError):
+            live = True
+        keyset[rpos] = self._DELETED
+        new_rpos = self._try_save(kfi, keyset, pos, digest, value)
+        if live:
+            self.save_digest_record(vdigest, rdata[self._digest_size + 1:])
+        return new_rpos
+
     def save_digest_record(self, digest, value, on_fail=None):
+        on_fail = on_fail or self._on_fail
         pos = self._offset(digest)
         for kfi, keyset in enumerate(self._keys):
             rpos = self._try_save(kfi, keyset, pos, digest, value,
@@ -746,6 +808,13 @@ class EncryptedDict(object):
         except KeyError:
             return default
 
+    def flush(self):
+        with self._lock:
+            for s in self._keys:
+                s.flush()
+            if self._values is not None:
+                self._values.flush()
+
     def close(self):
         with self._lock:
             for s in self._keys:
@@ -891,3 +960,20 @@ if __name__ == '__main__':
            % (done - t0, (done - t0) / count, ed.reads, ed.load_factor))
 
 
+
+    print('Creating EncryptedDict with hot key clustering...')
+    ed = EncryptedDict('/tmp/test.aes', 'another secret key',
+                       shard_size=1024, overwrite=True, sparse=True,
+                       cluster_hot_keys=True)
+    values = {}
+    for i in range(0, 3000):
+        values[str(i)] = 'x' * ((i % 10) + 1 if (i % 10) else (i % 3000))
+        ed[str(i)] = values[str(i)]
+    for k, v in values.iteritems():
+        assert(ed[k] == v)
+    ed.reset_counters()
+    for k, v in values.iteritems():
+        if len(v) > 100:
+            ed[k]
+    print(' -- popular key reads=%s (should be mostly in the first keyset)'
+          % ed.reads)
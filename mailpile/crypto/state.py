@@ -27,6 +27,10 @@ class CryptoInfo(dict):
     STATUSES = ["none", "mixed-error", "error"]
     DEFAULTS = {"status": "none"}
 
+    # Unpickling sets the dict items before restoring instance attributes,
+    # so this needs a class-level default.
+    _status = None
+
     def __init__(self, parent=None, copy=None, bubbly=True):
         self.parent = parent
         self.bubbly = bubbly
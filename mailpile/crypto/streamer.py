@@ -31,6 +31,7 @@ from __future__ import print_function
 ##############################################################################
 #
 import base64
+import cStringIO
 import os
 import hashlib
 import sys
@@ -50,6 +51,8 @@ from mailpile.util import sha512b64 as genkey
 
 from mailpile.crypto.aes_utils import getrandbits
 from mailpile.crypto.aes_utils import aes_ctr_encryptor, aes_ctr_decryptor
+from mailpile.crypto.aes_utils import OPENSSL_CIPHERS
+from mailpile.crypto.aes_utils import OpenSSLEncryptor, OpenSSLDecryptor
 
 PREFERRED_CIPHER = 'aes-128-ctr'
 
@@ -262,6 +265,113 @@ class ReadLineIOFilter(IOFilter):
             self._maybe_flush(eof=True)
 
 
+class SynchronousIOFilter(object):
+    """
+    This is a file-like object which filters data from an iterator of input
+    chunks as it is read, in the calling thread. It is the thread- and
+    pipe-free alternative to IOFilter.reader(), for when the filter can
+    do all the work itself and no coprocess is needed.
+
+    Until commit() is called, all input is kept, so it can be handed over
+    to a regular IOFilter if it turns out we need a coprocess after all.
+    """
+    def __init__(self, chunks, callback):
+        self.chunks = chunks
+        self.callback = callback
+        self.consumed = []
+        self.buffered = ''
+        self.eof = False
+        self.exc_info = None
+
+    def commit(self):
+        self.consumed = None
+
+    def pump(self):
+        """Filter one more chunk of input, returning False at EOF."""
+        if self.eof:
+            return False
+        try:
+            data = next(self.chunks, None)
+            if data:
+                if self.consumed is not None:
+                    self.consumed.append(data)
+                self.buffered += self.callback(data)
+            else:
+                self.eof = True
+                data = self.callback(None)
+                while data:
+                    self.buffered += data
+                    data = self.callback(None)
+        except (IOError, OSError, TypeError, ValueError, AssertionError):
+            # Like an IOFilter thread, we give up and report EOF. The data
+            # will then fail to verify.
+            self.exc_info = sys.exc_info()
+            self.eof = True
+        return not self.eof
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = [self.buffered]
+            self.buffered = ''
+            while self.pump():
+                chunks.append(self.buffered)
+                self.buffered = ''
+            chunks.append(self.buffered)
+            self.buffered = ''
+            return ''.join(chunks)
+        while len(self.buffered) < size and self.pump():
+            pass
+        data, self.buffered = self.buffered[:size], self.buffered[size:]
+        return data
+
+    def readline(self, size=-1):
+        pos = self.buffered.find('\n')
+        while pos < 0 and not self.eof:
+            searched = len(self.buffered)
+            self.pump()
+            pos = self.buffered.find('\n', searched)
+        end = len(self.buffered) if (pos < 0) else (pos + 1)
+        if size is not None and 0 <= size < end:
+            end = size
+        line, self.buffered = self.buffered[:end], self.buffered[end:]
+        return line
+
+    def readlines(self, *args):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.chunks = iter([])
+        self.buffered = ''
+        self.eof = True
+
+
+class _ReplayReader(object):
+    """Replays some already-consumed data, before reading from a file."""
+    def __init__(self, data, fd):
+        self.data = data
+        self.fd = fd
+
+    def read(self, size=-1):
+        if self.data:
+            data, self.data = self.data, ''
+            return data
+        return self.fd.read(size)
+
+
+class _StartupFlag(object):
+    """Stands in for the DecryptingStreamer startup lock, without threads."""
+    released = False
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        self.released = True
+
+
 class IOCoprocess(object):
     def __init__(self, command, fd, name=None, long_running=False):
         self.stderr = ''
@@ -540,6 +650,12 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
         elif self.cipher == 'broken':
             self.encoder = self.encryptor = lambda d: d
             self.encode_batches = None
+        elif self.cipher in OPENSSL_CIPHERS:
+            # Legacy format, compatible with `openssl enc -a`
+            self.encryptor = OpenSSLEncryptor(self.key, self.cipher,
+                                              OPENSSL_MD_ALG)
+            self.encoder = base64.encodestring
+            self.encode_batches = self.FILTER_BLOCKSIZE
         else:
             self.encoder = self.encryptor = None
             self.encode_batches = None
@@ -605,6 +721,9 @@ class EncryptingDelimitedStreamer(ChecksummingStreamer):
         if not self.finished:
             while self.encode_buffer:
                 self.write('')
+            if hasattr(self.encryptor, 'finish'):
+                # Bypass _write_filter(), this is not more plaintext.
+                self._fd.write(self.encoder(self.encryptor.finish()))
             rv = ChecksummingStreamer.finish(self, *args, **kwargs)
             self._write_inner_sha256()
             return rv
@@ -723,29 +842,27 @@ class DecryptingStreamer(InputCoprocess):
                  mep_key=None, gpg_pass=None, sha256=None, cipher=None,
                  name=None, long_running=False, gpgi=None, md_alg=None):
         self.expected_outer_sha256 = sha256
-        self.expected_inner_sha256 = None
-        self.expected_inner_md5sum = None
         self.name = name
-        self.outer_sha = hashlib.sha256()
-        self.inner_sha = hashlib.sha256()
-        self.inner_md5 = hashlib.md5()
-        self.cipher = self.PREFERRED_CIPHER or PREFERRED_CIPHER
         self.md_alg = md_alg or OPENSSL_MD_ALG
-        self.state = self.STATE_BEGIN
-        self.buffered = ''
-        self.mep_version = None
-        self.mep_mutated = None
         self.mep_key = mep_key
         self.gpg_pass = gpg_pass
         self.gpgi = gpgi
-        self.decryptor = None
-        self.decoder = None
-        self.decoder_data_bytes = 0  # Not counting white-space
+        self._reset_state()
+
+        # If we can decrypt the data ourselves, which is the common case,
+        # do so in the calling thread without any threads or pipes.
+        self.data_filter = None
+        self.read_fd = self._mk_synchronous_filter(fd)
+        if self.read_fd is not None:
+            InputCoprocess.__init__(self, None, self.read_fd,
+                                    name=name, long_running=long_running)
+            return
 
         # Start reading our data...
         self.startup_lock = CryptoLock()
         self.startup_lock.acquire()
-        self.data_filter = self._mk_data_filter(fd, self._read_data,
+        self.data_filter = self._mk_data_filter(self._fallback_fd,
+                                                self._read_data,
                                                 self.startup_lock.release)
         self.read_fd = self.data_filter.reader()
         try:
@@ -765,6 +882,48 @@ class DecryptingStreamer(InputCoprocess):
             self.startup_lock.release()
             self.startup_lock = None
 
+    def _reset_state(self):
+        self.expected_inner_sha256 = None
+        self.expected_inner_md5sum = None
+        self.outer_sha = hashlib.sha256()
+        self.inner_sha = hashlib.sha256()
+        self.inner_md5 = hashlib.md5()
+        self.cipher = self.PREFERRED_CIPHER or PREFERRED_CIPHER
+        self.state = self.STATE_BEGIN
+        self.buffered = ''
+        self.mep_version = None
+        self.mep_mutated = None
+        self.decryptor = None
+        self.decoder = None
+        self.decoder_data_bytes = 0  # Not counting white-space
+
+    def _synchronous_chunks(self, fd):
+        return iter(lambda: fd.read(IOFilter.BLOCKSIZE), '')
+
+    def _replay_input(self, consumed, fd):
+        return _ReplayReader(''.join(consumed), fd)
+
+    def _mk_synchronous_filter(self, fd):
+        """
+        Process the header in this thread. If it turns out we do not need
+        a coprocess, return a SynchronousIOFilter for reading the rest.
+        Otherwise, reset and arrange for the input to be replayed to the
+        threaded IOFilter.
+        """
+        self.startup_lock = _StartupFlag()
+        sync_fd = SynchronousIOFilter(self._synchronous_chunks(fd),
+                                      self._read_data)
+        while not self.startup_lock.released and sync_fd.pump():
+            pass
+        if self.startup_lock.released and self._mk_command() is None:
+            sync_fd.commit()
+            self.startup_lock = None
+            return sync_fd
+
+        self._fallback_fd = self._replay_input(sync_fd.consumed, fd)
+        self._reset_state()
+        return None
+
     def _read_filter(self, data):
         if data:
             if self.expected_inner_sha256:
@@ -775,7 +934,8 @@ class DecryptingStreamer(InputCoprocess):
 
     def close(self):
         self.read_fd.close()
-        self.data_filter.join()
+        if self.data_filter is not None:
+            self.data_filter.join()
         return InputCoprocess.close(self)
 
     def verify(self, testing=False, _raise=None):
@@ -826,8 +986,7 @@ class DecryptingStreamer(InputCoprocess):
             if self.decryptor is not None:
                 eof = not data
                 if self.decoder_data_bytes and data:
-                    self.buffered += ''.join([c for c in data if c not in
-                                              (' ', '\t', '\r', '\n')])
+                    self.buffered += data.translate(None, ' \t\r\n')
                 else:
                     self.buffered += (data or '')
                 data = ''
@@ -855,7 +1014,12 @@ class DecryptingStreamer(InputCoprocess):
                 self.startup_lock.release()
                 data, self.buffered = self.buffered, ''
                 return process(data) + process(None)
-            return process(None)
+            data = process(None)
+            if hasattr(self.decryptor, 'finish'):
+                # Only once: we may be called again at EOF.
+                decryptor, self.decryptor = self.decryptor, None
+                data += decryptor.finish()
+            return data
 
         if self.expected_outer_sha256:
             # The outer MD5 sum is calculated over all data, but with any
@@ -960,6 +1124,12 @@ class DecryptingStreamer(InputCoprocess):
                 self.decoder = lambda d: d
                 self.expected_inner_md5sum = None
                 self.expected_inner_sha256 = None
+            elif self.cipher in OPENSSL_CIPHERS:
+                # Legacy data, written by `openssl enc -a`
+                self.decryptor = OpenSSLDecryptor(self.mep_mutated,
+                                                  self.cipher, self.md_alg)
+                self.decoder = base64.b64decode
+                self.decoder_data_bytes = 32 * 1024
             else:
                 self.decryptor = None
                 data = '\n'.join((self.mep_mutated, data))
@@ -1005,6 +1175,29 @@ class PartialDecryptingStreamer(DecryptingStreamer):
         self.start_data = start_data
         DecryptingStreamer.__init__(self, *args, **kwargs)
 
+    def _synchronous_chunks(self, fd):
+        # Mirror ReadLineIOFilter: feed whole lines, in batches, and stop
+        # at the end marker so the rest of fd is left for our caller.
+        batch, batch_bytes = list(self.start_data), 0
+        self._seen_end = False
+        for line in fd:
+            batch.append(line)
+            if not re.match(BLANK_LINE_RE, line):
+                batch_bytes += len(line)
+            if self.EndEncrypted(line):
+                self._seen_end = True
+                break
+            if batch_bytes >= IOFilter.BLOCKSIZE:
+                yield ''.join(batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            yield ''.join(batch)
+
+    def _replay_input(self, consumed, fd):
+        # If we already consumed the end marker, do not read any further.
+        self.start_data = consumed
+        return [] if self._seen_end else fd
+
     def _mk_data_filter(self, fd, cb, ecb):
         return ReadLineIOFilter(fd, cb,
                                 start_data=self.start_data,
@@ -1013,6 +1206,83 @@ class PartialDecryptingStreamer(DecryptingStreamer):
                                 name='%s/rlfilter' % (self.name or 'ds'))
 
 
+def decrypt_buffer(data, mep_key=None, sha256=None, name=None, _raise=IOError):
+    """
+    Decrypt a whole buffer (a string, an mmap or an open file) and verify
+    its MACs, returning the plaintext. For the formats we handle natively
+    this all happens in the calling thread, without threads or pipes.
+    """
+    fd = data if hasattr(data, 'read') else cStringIO.StringIO(data)
+    with DecryptingStreamer(fd, mep_key=mep_key, sha256=sha256,
+                            name=name) as streamer:
+        plaintext = streamer.read()
+        streamer.verify(_raise=_raise)
+    return plaintext
+
+
+def obsolete_formats(fd):
+    """
+    Scan a file for Mailpile encrypted data, returning the set of formats
+    it uses (see DETECTED_OBSOLETE_FORMATS) which are not our preferred one.
+    """
+    found = set()
+    lines = iter(fd)
+    for line in lines:
+        if line.startswith(DecryptingStreamer.BEGIN_PGP):
+            continue
+        if DecryptingStreamer.StartEncrypted(line):
+            delimited = line.startswith(DecryptingStreamer.BEGIN_MED)
+            if delimited:
+                line = next(lines, '')
+            headers = {}
+            while ': ' in line:
+                key, val = line.split(': ', 1)
+                headers[key] = val.strip()
+                line = next(lines, '')
+            data_fmt = '%s:%s' % (headers.get('X-Mailpile-Encrypted-Data',
+                                              'v1'),
+                                  headers.get('cipher', PREFERRED_CIPHER))
+            if data_fmt != PREFERRED_FORMAT:
+                found.add(data_fmt)
+            if not delimited:
+                break
+            for line in lines:
+                if DecryptingStreamer.EndEncrypted(line):
+                    break
+    return found
+
+
+def reencrypt_obsolete(fd, mep_key, dir=None, name=None):
+    """
+    Read a file, returning its contents with all Mailpile encrypted data
+    re-encrypted using our preferred format. Plain text and PGP data are
+    returned unchanged. Raises IOError if anything fails to verify.
+    """
+    output = []
+    for line in fd:
+        if line.startswith(DecryptingStreamer.BEGIN_PGP):
+            output.append(line)
+            for line in fd:
+                output.append(line)
+                if DecryptingStreamer.EndEncrypted(line):
+                    break
+        elif DecryptingStreamer.StartEncrypted(line):
+            with PartialDecryptingStreamer([line], fd,
+                                           mep_key=mep_key,
+                                           name=name) as ds:
+                plaintext = ds.read()
+                ds.verify(_raise=IOError)
+            delimited = line.startswith(DecryptingStreamer.BEGIN_MED)
+            with EncryptingStreamer(mep_key, dir=dir, name=name,
+                                    delimited=delimited) as es:
+                es.write(plaintext)
+                es.finish()
+                output.append(es.save(None))
+        else:
+            output.append(line)
+    return ''.join(output)
+
+
 if __name__ == "__main__":
     import random  # See! Not in the main module!
     import StringIO
@@ -1133,6 +1403,25 @@ U2FsdGVkX19U8G7SKp8QygUusdHZThlrLcI04+jZ9U5kwfsw7bJJ2721dwgIpCUh
             _assert(ds.verify(testing=True))
     _assert(fdcheck('Decrypting test, sha256 verification'))
 
+    print('In-process buffer decryption test')
+    with EncryptingStreamer('test key', dir='/tmp', delimited=False) as es:
+        es.write(LEGACY_PLAINTEXT)
+        es.finish()
+        encrypted = es.save(None)
+        outer_mac_sha256 = es.outer_mac_sha256()
+    threads = threading.active_count()
+    _assert(LEGACY_PLAINTEXT, decrypt_buffer(encrypted,
+                                             mep_key='test key',
+                                             sha256=outer_mac_sha256))
+    _assert(threading.active_count(), threads)
+    try:
+        decrypt_buffer(encrypted, mep_key='wrong key',
+                       sha256=outer_mac_sha256)
+        _assert(False, msg='decrypt_buffer accepted a bad key')
+    except IOError:
+        pass
+    _assert(fdcheck('In-process buffer decryption test'))
+
     print('Legacy (MEP v1) decryption test')
     for legacy in (LEGACY_TEST_1, LEGACY_TEST_2):
         lfd = StringIO.StringIO(legacy)
@@ -1146,12 +1435,34 @@ U2FsdGVkX19U8G7SKp8QygUusdHZThlrLcI04+jZ9U5kwfsw7bJJ2721dwgIpCUh
             try:
                 _assert(plaintext, LEGACY_PLAINTEXT)
                 _assert(ds.verify(testing=True))
+                _assert(ds.command, None, msg='Used a coprocess')
             except AssertionError:
                 print('command=%s' % ds.command)
                 print('stderr=%s' % ds.stderr)
                 print('key=%s [%s]\n%s' % (LEGACY_TEST_KEY, ds.mep_mutated, legacy))
                 raise
 
+    print('Legacy data migration test')
+    mixed = 'Plain text\n' + LEGACY_TEST_2 + LEGACY_TEST_2
+    _assert(obsolete_formats(StringIO.StringIO(mixed)),
+            set(['v1:aes-256-cbc']))
+    migrated = reencrypt_obsolete(StringIO.StringIO(mixed), LEGACY_TEST_KEY)
+    _assert(obsolete_formats(StringIO.StringIO(migrated)), set())
+    mfd = StringIO.StringIO(migrated)
+    _assert(mfd.readline(), 'Plain text\n')
+    for i in range(0, 2):
+        with PartialDecryptingStreamer([mfd.readline()], mfd,
+                                       mep_key=LEGACY_TEST_KEY) as ds:
+            _assert(ds.read(), LEGACY_PLAINTEXT)
+            _assert(ds.verify(testing=True))
+    _assert(mfd.read(), '')
+    migrated = reencrypt_obsolete(StringIO.StringIO(LEGACY_TEST_1),
+                                  LEGACY_TEST_KEY)
+    _assert(obsolete_formats(StringIO.StringIO(migrated)), set())
+    _assert(decrypt_buffer(migrated, mep_key=LEGACY_TEST_KEY),
+            LEGACY_PLAINTEXT)
+    _assert(fdcheck('Legacy data migration test'))
+
     for cipher in ('none', 'broken', 'aes-128-ctr', 'aes-256-cbc'):
       for filter_sha256 in (True, False):
         for delim in (True, False):
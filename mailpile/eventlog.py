@@ -7,7 +7,7 @@ import threading
 import time
 from email.utils import formatdate, parsedate_tz, mktime_tz
 
-from mailpile.crypto.streamer import EncryptingStreamer, DecryptingStreamer
+from mailpile.crypto.streamer import EncryptingStreamer, decrypt_buffer
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.util import EventRLock, EventLock, CleanText, json_helper
@@ -277,11 +277,8 @@ class EventLog(object):
         enc_key = self.decryption_key_func()
         with open(os.path.join(self.logdir, lfn)) as fd:
             if enc_key:
-                with DecryptingStreamer(fd, mep_key=enc_key,
-                                        name='EventLog/DS(%s)' % lfn
-                                        ) as streamer:
-                    lines = streamer.read()
-                    streamer.verify(_raise=IOError)
+                lines = decrypt_buffer(fd, mep_key=enc_key,
+                                       name='EventLog/DS(%s)' % lfn)
             else:
                 lines = fd.read()
             if lines:
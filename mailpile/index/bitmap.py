@@ -0,0 +1,160 @@
+from __future__ import print_function
+import binascii
+
+
+# For each possible byte value, the offsets of the bits which are set.
+_BYTE_BITS = [tuple(b for b in range(0, 8) if v & (1 << b))
+              for v in range(0, 256)]
+
+
+class Bitmap(object):
+    """
+    A set of non-negative integers (message indexes), stored as the bits
+    of a single Python long. Unions, intersections and differences are
+    then word-wise operations implemented in C, which is much faster than
+    the equivalent operations on Python sets for large result sets.
+
+    >>> a = Bitmap([1, 5, 9, 1000])
+    >>> b = Bitmap(range(0, 10))
+    >>> list(a & b)
+    [1, 5, 9]
+    >>> len(a | b), 1000 in (a - b), 5 in (a - b)
+    (11, True, False)
+
+    Ranges are cheap to construct, so "all mail" costs nothing:
+    >>> list(Bitmap.Range(5) - Bitmap([0, 2]))
+    [1, 3, 4]
+
+    The in-place operators and update() modify the bitmap itself:
+    >>> c = Bitmap()
+    >>> c.update([3, 4])
+    >>> c |= set([7])
+    >>> c -= [4]
+    >>> list(c), bool(c), bool(Bitmap())
+    ([3, 7], True, False)
+
+    >>> c.as_set() == set([3, 7])
+    True
+
+    Negative numbers cannot be stored:
+    >>> Bitmap([-1, 3])
+    Traceback (most recent call last):
+      ...
+    ValueError: Negative value in bitmap: -1
+    """
+    __slots__ = ('bits', )
+
+    def __init__(self, ints=None, bits=0):
+        self.bits = self._Bits(ints) if ints else bits
+
+    @classmethod
+    def Range(cls, end, start=0):
+        """Create a bitmap with all the bits from start to end-1 set."""
+        if end <= start:
+            return cls()
+        return cls(bits=((1 << end) - 1) ^ ((1 << start) - 1))
+
+    @classmethod
+    def _Bits(cls, ints):
+        if isinstance(ints, Bitmap):
+            return ints.bits
+        if not isinstance(ints, (list, tuple, set, frozenset)):
+            ints = list(ints)
+        if not ints:
+            return 0
+        if min(ints) < 0:
+            raise ValueError('Negative value in bitmap: %s' % min(ints))
+        ba = bytearray(max(ints) // 8 + 1)
+        for i in ints:
+            ba[i >> 3] |= (1 << (i & 7))
+        ba.reverse()
+        return long(binascii.hexlify(ba), 16)
+
+    def as_list(self):
+        """Return the members of this bitmap as a sorted list."""
+        if not self.bits:
+            return []
+        hexed = '%x' % self.bits
+        if len(hexed) % 2:
+            hexed = '0' + hexed
+        ba = bytearray(binascii.unhexlify(hexed))
+        ba.reverse()
+        out = []
+        extend, byte_bits, base = out.extend, _BYTE_BITS, 0
+        for v in ba:
+            if v:
+                extend(map(base.__add__, byte_bits[v]))
+            base += 8
+        return out
+
+    def as_set(self):
+        return set(self.as_list())
+
+    def copy(self):
+        return Bitmap(bits=self.bits)
+
+    def update(self, ints):
+        self.bits |= self._Bits(ints)
+
+    def add(self, i):
+        if i < 0:
+            raise ValueError('Negative value in bitmap: %s' % i)
+        self.bits |= (1 << i)
+
+    def discard(self, i):
+        self.bits &= ~(1 << i)
+
+    def __iter__(self):
+        return iter(self.as_list())
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __nonzero__(self):
+        return (self.bits != 0)
+
+    def __contains__(self, i):
+        return (i >= 0) and bool((self.bits >> i) & 1)
+
+    def __eq__(self, other):
+        return self.bits == self._Bits(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __and__(self, other):
+        return Bitmap(bits=(self.bits & self._Bits(other)))
+
+    def __or__(self, other):
+        return Bitmap(bits=(self.bits | self._Bits(other)))
+
+    def __sub__(self, other):
+        return Bitmap(bits=(self.bits & ~self._Bits(other)))
+
+    def __xor__(self, other):
+        return Bitmap(bits=(self.bits ^ self._Bits(other)))
+
+    def __iand__(self, other):
+        self.bits &= self._Bits(other)
+        return self
+
+    def __ior__(self, other):
+        self.bits |= self._Bits(other)
+        return self
+
+    def __isub__(self, other):
+        self.bits &= ~self._Bits(other)
+        return self
+
+    def __repr__(self):
+        return '<Bitmap(%d members)>' % len(self)
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,459 @@
+from __future__ import print_function
+import unicodedata
+from array import array
+
+from mailpile.index.msginfo import MessageInfoConstants
+from mailpile.util import b36
+
+
+class StringTable(object):
+    """
+    Interns repeated strings (senders, tag lists), mapping them to small
+    integers so each distinct value is only stored once.
+
+    >>> st = StringTable()
+    >>> st.intern(u'Bjarni <bre@example.com>'), st.intern(u'a,b')
+    (1, 2)
+    >>> st.intern(u'Bjarni <bre@example.com>'), st[2]
+    (1, u'a,b')
+    """
+    def __init__(self):
+        self.strings = [u'']
+        self.ids = {u'': 0}
+
+    def intern(self, string):
+        sid = self.ids.get(string)
+        if sid is None:
+            sid = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return sid
+
+    def __getitem__(self, sid):
+        return self.strings[sid]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class RankTable(object):
+    """
+    Maps strings to small integer IDs, and keeps a rank for each ID which
+    sorts the same way the (normalized) string does. Sort orders can then
+    store one integer per message instead of a copy of the string.
+
+    Strings are compared by a collation key: the first KEY_BYTES bytes of
+    the normalized string. The keys are packed into one bytearray, sorted,
+    next to arrays of IDs and ranks, so each distinct sender or subject
+    costs a fixed KEY_BYTES plus three machine words and no Python
+    objects. Strings which only differ after the prefix share an ID.
+
+    In a tiny rank space, to keep the numbers readable:
+    >>> rt = RankTable()
+    >>> rt.MAX_RANK = 63
+    >>> [rt.intern(s) for s in
+    ...  (u'Bob', u'alice', u'\\u00c1lice ', u'Zo\\u00eb')]
+    [0, 1, 1, 2]
+    >>> rt.prefixes(), list(rt.ranks)
+    (['alice', 'bob', 'zoe'], [31, 15, 47])
+
+    Byte strings, as found in metadata lines, are assumed to be UTF-8:
+    >>> rt.intern('ZO\\xc3\\x8b')
+    2
+
+    New keys are ranked between their neighbours. When there is no room,
+    a range of neighbouring ranks is spread out; IDs never change, so
+    whoever stored an ID need not do anything:
+    >>> [rt.intern(u'b%d' % i) for i in range(0, 6)]
+    [3, 4, 5, 6, 7, 8]
+    >>> rt.prefixes()
+    ['alice', 'b0', 'b1', 'b2', 'b3', 'b4', 'b5', 'bob', 'zoe']
+    >>> [rt.ranks[sid] for sid in rt.order]
+    [15, 17, 19, 21, 23, 25, 27, 29, 47]
+
+    While deferred, new keys get IDs but no rank, until finish() sorts
+    everything in one go (much faster than inserting one at a time):
+    >>> rt.defer()
+    >>> rt.intern(u'Carol'), rt.intern(u'bob'), rt.intern(u'Adam')
+    (9, 0, 10)
+    >>> rt.finish()
+    >>> rt.prefixes()[:3], [rt.ranks[sid] for sid in rt.order]
+    (['adam', 'alice', 'b0'], [2, 7, 12, 17, 22, 27, 32, 37, 42, 47, 52])
+    >>> RankTable.loads(rt.dumps()).prefixes() == rt.prefixes()
+    True
+
+    >>> rt.intern(u'x' * 40) == rt.intern(u'x' * 32 + u'y')
+    True
+    """
+    KEY_BYTES = 32
+    DENSITY = 1.75
+    MAX_RANK = (1 << (8 * array('l').itemsize - 1)) - 1
+
+    def __init__(self):
+        self.keys = bytearray()  # Sorted collation keys
+        self.order = array('i')  # The ID of each key in self.keys
+        self.ranks = array('l')  # The rank of each ID
+        self.pending = None
+
+    def __len__(self):
+        return len(self.order)
+
+    @classmethod
+    def normalize(cls, string):
+        """Ignore case, accents and redundant whitespace when sorting."""
+        if isinstance(string, str):
+            string = string.decode('utf-8', 'replace')
+        string = unicodedata.normalize('NFKD', unicode(string).lower())
+        return u' '.join(u''.join(c for c in string
+                                  if not unicodedata.combining(c)).split())
+
+    @classmethod
+    def collation_key(cls, string):
+        # UTF-8 sorts like the code points do, and padding with NULs sorts
+        # shorter strings first.
+        key = cls.normalize(string).replace(u'\0', u'').encode('utf-8')
+        key = key[:cls.KEY_BYTES]
+        return key + '\0' * (cls.KEY_BYTES - len(key))
+
+    def _key(self, i):
+        return self.keys[i * self.KEY_BYTES:(i + 1) * self.KEY_BYTES]
+
+    def prefixes(self):
+        return [str(self._key(i)).rstrip('\0') for i in range(0, len(self))]
+
+    def _find(self, key):
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self._key(lo) == key:
+            return lo, self.order[lo]
+        return lo, None
+
+    def intern(self, string):
+        """Return the ID of a string, ranking it if it is new."""
+        key = self.collation_key(string)
+        i, sid = self._find(key)
+        if sid is not None:
+            return sid
+
+        if self.pending is not None:
+            sid = self.pending.get(key)
+            if sid is None:
+                sid = self.pending[key] = len(self.ranks)
+                self.ranks.append(0)
+            return sid
+
+        sid = len(self.ranks)
+        self.ranks.append(0)
+        self._place(i, sid)
+        self.keys[i * self.KEY_BYTES:i * self.KEY_BYTES] = key
+        return sid
+
+    def _position(self, rank):
+        """Return the position of the first key ranked at or above rank."""
+        ranks, order = self.ranks, self.order
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ranks[order[mid]] < rank:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _place(self, i, sid):
+        """
+        Insert sid at position i, ranked halfway between its neighbours.
+
+        If there is no room, we look for the smallest aligned range of
+        ranks around the predecessor which is not too crowded, and spread
+        out the ranks within it. The allowed density drops as the ranges
+        grow, so each renumbering makes room for many later insertions
+        (see Bender et al., "Two Simplified Algorithms for Maintaining
+        Order in a List"); this takes O(log N) amortized work, even if
+        new strings keep arriving at the same spot.
+        """
+        ranks, order = self.ranks, self.order
+        lo = ranks[order[i - 1]] if (i > 0) else -1
+        hi = ranks[order[i]] if (i < len(order)) else (self.MAX_RANK + 1)
+        if hi - lo > 1:
+            order.insert(i, sid)
+            ranks[sid] = lo + (hi - lo) // 2
+            return
+
+        base, size, limit = max(0, lo), 1, 1.0
+        while size <= self.MAX_RANK:
+            size *= 2
+            limit *= self.DENSITY
+            base -= base % size
+            first = self._position(base)
+            last = self._position(base + size)
+            if last - first + 1 <= limit:
+                break
+        else:
+            first, last, base, size = 0, len(order), 0, self.MAX_RANK + 1
+        order.insert(i, sid)
+        self._spread(first, last + 1, base, size)
+
+    def _spread(self, first, last, base, size):
+        ranks, order = self.ranks, self.order
+        spacing = size // (last - first)
+        for j in range(first, last):
+            ranks[order[j]] = base + (j - first) * spacing + spacing // 2
+
+    def defer(self):
+        """Hand out IDs to new strings, but only rank them in finish()."""
+        if self.pending is None:
+            self.pending = {}
+
+    def finish(self):
+        """Rank the deferred strings, renumbering everything."""
+        pending, self.pending = self.pending, None
+        if not pending:
+            return
+        ranked = [(str(self._key(i)), self.order[i])
+                  for i in range(0, len(self))]
+        ranked.extend(pending.iteritems())
+        ranked.sort()
+        self.keys = bytearray(''.join(k for k, sid in ranked))
+        self.order = array('i', (sid for k, sid in ranked))
+        self._spread(0, len(self.order), 0, self.MAX_RANK + 1)
+
+    def dumps(self):
+        return ''.join(['%d\n' % len(self.order), self.ranks.tostring(),
+                        self.order.tostring(), str(self.keys)])
+
+    @classmethod
+    def loads(cls, data):
+        rt = cls()
+        count, data = data.split('\n', 1)
+        count = int(count)
+        for arr in (rt.ranks, rt.order):
+            size = count * arr.itemsize
+            arr.fromstring(data[:size])
+            data = data[size:]
+        rt.keys = bytearray(data)
+        if (len(rt.keys) != count * cls.KEY_BYTES or
+                len(rt.order) != count or
+                sorted(rt.order) != range(0, count)):
+            raise ValueError('Bad rank table')
+        return rt
+
+
+class MetadataColumns(MessageInfoConstants):
+    """
+    Columnar storage for the metadata index.
+
+    This behaves like a list of UTF-8 encoded, tab-separated metadata lines
+    (which is what MailIndex.INDEX used to be), but internally the date and
+    size live in integer arrays, sender and tags are interned in a shared
+    StringTable, and only the remaining (mostly unique) fields are kept as
+    a shorter joined string. The hot fields can then be read in O(1)
+    without splitting or decoding anything.
+
+    >>> line = u'\\t'.join([u'A', u'ptr', u'msgid', b36(1400000000),
+    ...                    u'Bjarni <bre@example.com>', u'', u'', u'2',
+    ...                    u'Subject \\u00e1', u'Snippet', u'1,4', u'', u'A'
+    ...                    ]).encode('utf-8')
+    >>> mc = MetadataColumns()
+    >>> mc.append(line)
+    >>> mc.append('')
+    >>> len(mc), mc[0] == line, mc[1]
+    (2, True, '')
+    >>> mc.get_date(0), mc.get_from(0), mc.get_tags(0)
+    (1400000000, u'Bjarni <bre@example.com>', u'1,4')
+    >>> mc.get_fields(0)[MetadataColumns.MSG_SUBJECT]
+    u'Subject \\xe1'
+    >>> mc.get_field(0, MetadataColumns.MSG_KB)
+    u'2'
+    >>> mc.get_field(0, MetadataColumns.MSG_SUBJECT)
+    u'Subject \\xe1'
+
+    If the lines are also kept in a random-access backing store, the
+    bulky fields of a row can be evicted and will be loaded on demand:
+    >>> mc.loader = lambda pos: line
+    >>> mc.evict(0)
+    >>> mc[0] == line, mc.get_from(0), mc.get_fields(0)[mc.MSG_BODY]
+    (True, u'Bjarni <bre@example.com>', u'Snippet')
+    >>> mc.get_field(0, mc.MSG_BODY)
+    u'Snippet'
+
+    The columns which stay in RAM can be written out without loading the
+    evicted fields again, leaving the others blank:
+    >>> mc.get_columns(0, {mc.MSG_MID: 'A'}).split('\\t')[:9]
+    ['A', '', '', 'N5IUWW', 'Bjarni <bre@example.com>', '', '', '2', '']
+
+    Lines which do not fit the columns are stored verbatim:
+    >>> mc[1] = 'bogus\\tline'
+    >>> mc[1]
+    'bogus\\tline'
+    >>> mc.get_fields(1)
+    Traceback (most recent call last):
+      ...
+    ValueError: Bogus metadata at 1
+    """
+    NUMERIC = (MessageInfoConstants.MSG_DATE,
+               MessageInfoConstants.MSG_KB)
+    INTERNED = (MessageInfoConstants.MSG_FROM,
+                MessageInfoConstants.MSG_TAGS)
+    REST = [f for f in range(0, MessageInfoConstants.MSG_FIELDS_V2)
+            if f not in NUMERIC + INTERNED]
+    REST_INDEX = dict((f, i) for i, f in enumerate(REST))
+    EVICTED = object()  # Placeholder for uncommon fields left on disk
+
+    def __init__(self, loader=None):
+        self.loader = loader
+        self.strings = StringTable()
+        self.dates = array('l')
+        self.sizes = array('l')
+        self.froms = array('i')
+        self.tags = array('i')
+        self.rest = []
+        self.raw = {}
+
+    def __len__(self):
+        return len(self.rest)
+
+    def append(self, line):
+        self.dates.append(0)
+        self.sizes.append(0)
+        self.froms.append(0)
+        self.tags.append(0)
+        self.rest.append(None)
+        self[len(self.rest) - 1] = line
+
+    def __setitem__(self, pos, line):
+        if pos < 0 or pos >= len(self.rest):
+            raise IndexError('Out of range: %s' % pos)
+        words = line.split('\t')
+        try:
+            if len(words) != self.MSG_FIELDS_V2:
+                raise ValueError('Wrong number of fields')
+            date = long(words[self.MSG_DATE], 36)
+            size = long(words[self.MSG_KB], 36)
+            if (b36(date) != words[self.MSG_DATE] or
+                    b36(size) != words[self.MSG_KB]):
+                raise ValueError('Non-canonical number')
+            self.dates[pos] = date
+            self.sizes[pos] = size
+            self.froms[pos] = self.strings.intern(
+                words[self.MSG_FROM].decode('utf-8'))
+            self.tags[pos] = self.strings.intern(
+                words[self.MSG_TAGS].decode('utf-8'))
+            self.rest[pos] = '\t'.join(words[f] for f in self.REST)
+            self.raw.pop(pos, None)
+        except (ValueError, OverflowError, UnicodeDecodeError):
+            self.rest[pos] = None
+            self.raw[pos] = line
+
+    def evict(self, pos):
+        """Drop the uncommon fields of a row, if we can load them again."""
+        if self.loader is not None and self.rest[pos] is not None:
+            self.rest[pos] = self.EVICTED
+
+    def _load_words(self, pos):
+        words = self.loader(pos).split('\t')
+        if len(words) != self.MSG_FIELDS_V2:
+            raise ValueError('Bogus metadata at %s' % pos)
+        return words
+
+    def __getitem__(self, pos):
+        rest = self.rest[pos]
+        if rest is None:
+            return self.raw[pos]
+        elif rest is self.EVICTED:
+            return self.loader(pos)
+        words = [None] * self.MSG_FIELDS_V2
+        for f, v in zip(self.REST, rest.split('\t')):
+            words[f] = v
+        words[self.MSG_DATE] = b36(self.dates[pos])
+        words[self.MSG_KB] = b36(self.sizes[pos])
+        words[self.MSG_FROM] = self.strings[self.froms[pos]].encode('utf-8')
+        words[self.MSG_TAGS] = self.strings[self.tags[pos]].encode('utf-8')
+        return '\t'.join(words)
+
+    def get_fields(self, pos):
+        """Return the metadata for a message as a list of unicode fields."""
+        rest = self.rest[pos]
+        if rest is None:
+            raise ValueError('Bogus metadata at %s' % pos)
+        elif rest is self.EVICTED:
+            words = self._load_words(pos)
+            rest = '\t'.join(words[f] for f in self.REST)
+        fields = [None] * self.MSG_FIELDS_V2
+        for f, v in zip(self.REST, rest.decode('utf-8').split(u'\t')):
+            fields[f] = v
+        fields[self.MSG_DATE] = unicode(b36(self.dates[pos]))
+        fields[self.MSG_KB] = unicode(b36(self.sizes[pos]))
+        fields[self.MSG_FROM] = self.strings[self.froms[pos]]
+        fields[self.MSG_TAGS] = self.strings[self.tags[pos]]
+        return fields
+
+    def get_field(self, pos, field):
+        """Return a single metadata field, without decoding the others."""
+        if field == self.MSG_DATE:
+            return unicode(b36(self.get_date(pos)))
+        elif field == self.MSG_KB:
+            self._check(pos)
+            return unicode(b36(self.sizes[pos]))
+        elif field == self.MSG_FROM:
+            return self.get_from(pos)
+        elif field == self.MSG_TAGS:
+            return self.get_tags(pos)
+
+        rest = self.rest[pos]
+        if rest is None:
+            raise ValueError('Bogus metadata at %s' % pos)
+        elif rest is self.EVICTED:
+            value = self._load_words(pos)[field]
+        else:
+            idx = self.REST_INDEX[field]
+            value = rest.split('\t', idx + 1)[idx]
+        return value.decode('utf-8')
+
+    def get_columns(self, pos, fields):
+        """
+        Return a line with only the fields kept in RAM, plus any given in
+        the fields dict; the rest are left blank. Lines which do not fit
+        the columns are returned as they are.
+        """
+        rest = self.rest[pos]
+        if rest is None:
+            return self.raw[pos]
+        words = [''] * self.MSG_FIELDS_V2
+        for f, v in fields.iteritems():
+            words[f] = v.encode('utf-8') if isinstance(v, unicode) else v
+        words[self.MSG_DATE] = b36(self.dates[pos])
+        words[self.MSG_KB] = b36(self.sizes[pos])
+        words[self.MSG_FROM] = self.strings[self.froms[pos]].encode('utf-8')
+        words[self.MSG_TAGS] = self.strings[self.tags[pos]].encode('utf-8')
+        return '\t'.join(words)
+
+    def _check(self, pos):
+        if self.rest[pos] is None:
+            raise ValueError('Bogus metadata at %s' % pos)
+
+    def get_date(self, pos):
+        self._check(pos)
+        return self.dates[pos]
+
+    def get_from(self, pos):
+        self._check(pos)
+        return self.strings[self.froms[pos]]
+
+    def get_tags(self, pos):
+        self._check(pos)
+        return self.strings[self.tags[pos]]
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,166 @@
+from __future__ import print_function
+import cPickle
+import gc
+import multiprocessing
+import os
+import select
+import signal
+import time
+import traceback
+
+
+MAXFD = 1024
+
+
+def _close_inherited_fds(keep):
+    """
+    Close the files a forked child inherited from its parent, except for
+    stdio and those in keep. Otherwise the child holds on to the parent's
+    pipes and sockets; a GnuPG process the parent is feeding, for example,
+    would never see the end of its input.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except (OSError, ValueError):
+        fds = range(3, MAXFD)
+    for fd in fds:
+        if fd > 2 and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class ForkedMap(object):
+    """
+    Run a function over batches of arguments in forked worker processes,
+    returning the results in order.
+
+    Each batch is split between a few processes, forked for that batch.
+    They inherit the function and whatever state it needs, so only the
+    arguments and results cross the process boundary. They also inherit
+    any locks other threads held at that moment, still held, so the
+    function must not take any. Inherited files are closed right away.
+
+    If a call fails or its result cannot be pickled, its result is None;
+    if a worker dies or stalls, all results are None and no more workers
+    are forked. Either way the caller can fall back to doing the work
+    itself, so this is only ever an optimization.
+
+    >>> fm = ForkedMap(lambda a, b: a * b, processes=2)
+    >>> fm.map([(1, 2), (3, 4), (5, 'x')])
+    [2, 12, 'xxxxx']
+    >>> fm.map([(1, None), (2, 2)])
+    [None, 4]
+    >>> fm.close()
+
+    Small batches are not worth the overhead, they are not mapped at all:
+    >>> fm = ForkedMap(lambda a, b: a * b, processes=2)
+    >>> fm.map([(1, 2)])
+    [None]
+    """
+    MIN_BATCH = 2
+    MAX_PROCESSES = 8
+    TIMEOUT = 600
+
+    def __init__(self, func, processes=None, debug=False):
+        self.func = func
+        self.processes = processes or min(self.MAX_PROCESSES,
+                                          multiprocessing.cpu_count())
+        self.debug = debug
+        self.broken = not hasattr(os, 'fork')
+
+    def _child(self, args_list, wfd):
+        results = []
+        for args in args_list:
+            try:
+                results.append(cPickle.dumps(self.func(*args), 2))
+            except:
+                if self.debug:
+                    traceback.print_exc()
+                results.append(None)
+        data = cPickle.dumps(results, 2)
+        while data:
+            data = data[os.write(wfd, data):]
+
+    def _fork(self, args_list):
+        rfd, wfd = os.pipe()
+        try:
+            pid = os.fork()
+        except OSError:
+            os.close(rfd)
+            os.close(wfd)
+            raise
+        if pid == 0:
+            try:
+                # Don't let the garbage collector run destructors of things
+                # the parent owns (subprocesses, for example).
+                gc.disable()
+                os.close(rfd)
+                _close_inherited_fds([wfd])
+                self._child(args_list, wfd)
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        return pid, rfd
+
+    def _collect(self, children):
+        data = dict((rfd, []) for pid, rfd in children)
+        pending = set(data.keys())
+        deadline = time.time() + self.TIMEOUT
+        while pending:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise IOError('Timed out waiting for workers')
+            for rfd in select.select(list(pending), [], [], timeout)[0]:
+                chunk = os.read(rfd, 65536)
+                if chunk:
+                    data[rfd].append(chunk)
+                else:
+                    pending.discard(rfd)
+        return [cPickle.loads(''.join(data[rfd])) for pid, rfd in children]
+
+    def map(self, args_list):
+        if len(args_list) < self.MIN_BATCH or self.broken:
+            return [None for args in args_list]
+
+        size = (len(args_list) + self.processes - 1) // self.processes
+        children = []
+        try:
+            for i in range(0, len(args_list), size):
+                children.append(self._fork(args_list[i:i + size]))
+            results = []
+            for chunk in self._collect(children):
+                results.extend(cPickle.loads(r) if r else None
+                               for r in chunk)
+            if len(results) == len(args_list):
+                return results
+            raise ValueError('Lost some results')
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            if self.debug:
+                traceback.print_exc()
+            self.broken = True
+            return [None for args in args_list]
+        finally:
+            for pid, rfd in children:
+                os.close(rfd)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                os.waitpid(pid, 0)
+
+    def close(self):
+        self.broken = True
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,128 @@
+from __future__ import print_function
+import glob
+import os
+import threading
+from urllib import quote, unquote
+
+from mailpile.crypto.records import EncryptedBlobStore
+
+
+class MetadataRecordStore(object):
+    """
+    Random-access, encrypted on-disk storage for the metadata index.
+
+    Each message's metadata line lives in its own fixed-size encrypted
+    record (see mailpile.crypto.records), at the position matching its
+    index position. Changing the tags of a message rewrites just that
+    one record in place, instead of appending the whole line to a log
+    which must periodically be rewritten from scratch. Reading a single
+    message's metadata is one seek and one record decryption, so the
+    in-memory index need not keep everything loaded.
+
+    The e-mail address table is stored in a second, smaller store.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> base = os.path.join(tmpdir, 'metadata')
+    >>> MetadataRecordStore.Exists(base)
+    False
+
+    >>> mrs = MetadataRecordStore(base, 'secret')
+    >>> mrs.save_message(0, 'A\\tline\\twith\\ttabs')
+    >>> mrs.save_message(2, 'C' * 2000)
+    >>> mrs.save_email(0, u'bre@example.com Bjarni \\u00e1')
+    >>> mrs.flush()
+    >>> MetadataRecordStore.Exists(base), mrs.message_count()
+    (True, 3)
+
+    Records can be read back at random, holes are skipped when iterating:
+    >>> mrs = MetadataRecordStore(base, 'secret')
+    >>> mrs.load_message(0)
+    'A\\tline\\twith\\ttabs'
+    >>> [(pos, len(line)) for pos, line in mrs.messages()]
+    [(0, 16), (2, 2000)]
+    >>> list(mrs.emails())
+    [(0, u'bre@example.com Bjarni \\xe1')]
+    >>> mrs.load_message(1)
+    Traceback (most recent call last):
+      ...
+    KeyError: ...
+
+    >>> mrs.close()
+    >>> shutil.rmtree(tmpdir)
+    """
+    MESSAGE_BYTES = 640
+    EMAIL_BYTES = 100
+    SHARD_SIZE = 50000
+
+    def __init__(self, base_fn, key):
+        self._base_fn = base_fn
+        self._lock = threading.RLock()
+        self._messages = EncryptedBlobStore('%s-m' % base_fn, key,
+                                            max_bytes=self.MESSAGE_BYTES,
+                                            shard_size=self.SHARD_SIZE)
+        self._emails = EncryptedBlobStore('%s-e' % base_fn, key,
+                                          max_bytes=self.EMAIL_BYTES,
+                                          shard_size=self.SHARD_SIZE)
+
+    @classmethod
+    def Exists(cls, base_fn):
+        return os.path.exists('%s-m-1' % base_fn)
+
+    def message_count(self):
+        return len(self._messages)
+
+    def load_message(self, pos):
+        return self._messages[pos]
+
+    def save_message(self, pos, line):
+        self._messages[pos] = line
+
+    def messages(self):
+        """
+        Iterate through all the (pos, line) pairs in the store. This
+        decrypts every record, so MailIndex only does it when its column
+        cache is missing or stale.
+        """
+        for pos in range(0, len(self._messages)):
+            line = self._messages.get(pos)
+            if line:
+                yield pos, line
+
+    def save_email(self, pos, email):
+        self._emails[pos] = quote(email.encode('utf-8'))
+
+    def emails(self):
+        for pos in range(0, len(self._emails)):
+            email = self._emails.get(pos)
+            if email:
+                yield pos, unquote(email).decode('utf-8')
+
+    def stamp(self):
+        """A stamp which changes whenever the stored data changes."""
+        size = mtime = 0
+        for fn in glob.glob('%s-*' % self._base_fn):
+            st = os.stat(fn)
+            size += st.st_size
+            mtime = max(mtime, int(st.st_mtime * 1000))
+        return '%x.%x' % (size, mtime)
+
+    def flush(self):
+        with self._lock:
+            self._messages.flush()
+            self._emails.flush()
+
+    def close(self):
+        with self._lock:
+            self._messages.close()
+            self._emails.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
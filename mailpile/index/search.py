@@ -3,11 +3,13 @@ import time
 
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.bitmap import Bitmap
 
 
 class SearchResultSet:
     """
-    Search results!
+    Search results! These are stored as bitmaps, and only converted to
+    Python sets on demand.
     """
     def __init__(self, idx, terms, results, exclude):
         self.terms = set(terms)
@@ -15,18 +17,22 @@ class SearchResultSet:
         self.set_results(results, exclude)
 
     def set_results(self, results, exclude):
+        raw = Bitmap(results)
         self._results = {
-            'raw': set(results),
-            'excluded': set(exclude) & set(results)
+            'raw': raw,
+            'excluded': raw & exclude
         }
         return self
 
     def __len__(self):
         return len(self._results.get('raw', []))
 
-    def as_set(self, order='raw'):
+    def as_bitmap(self, order='raw'):
         return self._results[order] - self._results['excluded']
 
+    def as_set(self, order='raw'):
+        return self.as_bitmap(order=order).as_set()
+
     def excluded(self):
         return self._results['excluded']
 
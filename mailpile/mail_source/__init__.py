@@ -1,7 +1,9 @@
 import datetime
 import os
+import Queue
 import random
 import re
+import sys
 import thread
 import threading
 import traceback
@@ -30,6 +32,8 @@ class BaseMailSource(threading.Thread):
     SAVE_STATE_INTERVAL = 3600  # How frequently we pickle our state
     INTERNAL_ERROR_SLEEP = 900  # Pause time on error, in seconds
     RESCAN_BATCH_SIZE = 200     # Index at most this many new e-mails at once
+    COPY_BATCH_SIZE = 100       # Download this many e-mails at once, if we can
+    COPY_QUEUE_SIZE = 20        # Max e-mails waiting between copy stages
     MAX_PATHS = 2000            # Limit how many directories we scan at once
 
     # This is a helper for the events.
@@ -115,7 +119,8 @@ class BaseMailSource(threading.Thread):
         self._state = 'Idle'
         self._sleeping = None
         self._interrupt = None
-        self._rescanning = False
+        self._rescanning = set()
+        self._scan_lock = MSrcLock()
         self._rescan_waiters = []
         self._rescan_forced = False
         self._loop_count = 0
@@ -252,17 +257,24 @@ class BaseMailSource(threading.Thread):
                 if self.event:
                     self.event.data['name'] = self.name
 
+    def _sync_workers(self):
+        """How many mailboxes the default sync_mail may rescan at once."""
+        return 1
+
     def sync_mail(self):
         """Iterates through all the mailboxes and scans if necessary."""
         config = self.session.config
-        rescanned = messages = errors = 0
         self._last_rescan_count = (0, 0)
         self._last_rescan_completed = False
         self._last_rescan_failed = False
         self._interrupt = None
-        batch = min(self._loop_count * 20, self.RESCAN_BATCH_SIZE)
-        errors = rescanned = 0
-        all_completed = True
+        totals = {
+            'batch': min(self._loop_count * 20, self.RESCAN_BATCH_SIZE),
+            'messages': 0,
+            'rescanned': 0,
+            'errors': 0,
+            'all_completed': True}
+        totals_lock = threading.Lock()
         ostate = self._state
 
         if not self._check_interrupt(clear=False):
@@ -279,13 +291,14 @@ class BaseMailSource(threading.Thread):
         else:
             random_plan = []
 
-        for mbx_cfg in plan:
+        def sync_mailbox(mbx_cfg):
+            # Returns False if the sync should stop here.
             if not self._rescan_forced:
                 play_nice_with_threads(weak=True)
 
             if self._check_interrupt(clear=False):
-                all_completed = False
-                break
+                totals['all_completed'] = False
+                return False
             try:
                 with self._lock:
                     mbx_key = FormatMbxId(mbx_cfg._key)
@@ -294,13 +307,15 @@ class BaseMailSource(threading.Thread):
                     if (path in ('/dev/null', '', None)
                             or policy in ('ignore', 'unknown')):
                         event_plan[mbx_cfg._key][1] = _('Skipped')
-                        continue
+                        return True
 
                 # Generally speaking, we only rescan if a mailbox looks like
                 # it has changed. However, every once in a while (see logic
                 # around random_mailboxes above) we check anyway just in case
                 # looks are deceiving.
                 state = {}
+                with totals_lock:
+                    batch = totals['batch']
                 if batch < 1:
                     event_plan[mbx_cfg._key][1] = _('Postponed')
 
@@ -313,30 +328,34 @@ class BaseMailSource(threading.Thread):
                     this_batch = max(5, int(0.7 * batch))
                     self._state = 'Waiting... (rescan)'
                     if self._check_interrupt(clear=False):
-                        all_completed = False
-                        break
+                        totals['all_completed'] = False
+                        return False
+                    status = {}
                     count = self.rescan_mailbox(mbx_key, mbx_cfg, path,
-                                                stop_after=this_batch)
+                                                stop_after=this_batch,
+                                                status=status)
 
                     if count >= 0:
-                        self.event.data['counters'
-                                        ]['indexed_messages'] += count
-                        batch -= count
+                        with totals_lock:
+                            self.event.data['counters'
+                                            ]['indexed_messages'] += count
+                            totals['batch'] -= count
+                            totals['messages'] += count
                         this_batch -= count
-                        messages += count
                         complete = ((count == 0 or this_batch > 0) and
                                     not self._interrupt and
                                     not mailpile.util.QUITTING)
                         if complete:
-                            rescanned += 1
+                            with totals_lock:
+                                totals['rescanned'] += 1
 
                         # If there was a copy, check if it completed
-                        cstate = self.event.data.get('copying') or {}
+                        cstate = status.get('copying') or {}
                         if not cstate.get('complete', True):
                             complete = False
 
                         # If there was a rescan, check if it completed
-                        rstate = self.event.data.get('rescan') or {}
+                        rstate = status.get('rescan') or {}
                         if not rstate.get('complete', True):
                             complete = False
 
@@ -347,14 +366,15 @@ class BaseMailSource(threading.Thread):
                         else:
                             event_plan[mbx_cfg._key][1] = _('Indexed %d'
                                                             ) % count
-                            all_completed = False
+                            totals['all_completed'] = False
                             if count == 0 and ('sources' in config.sys.debug):
                                 time.sleep(60)
                     else:
                         event_plan[mbx_cfg._key][1] = _('Failed')
                         self._last_rescan_failed = True
-                        all_completed = False
-                        errors += 1
+                        totals['all_completed'] = False
+                        with totals_lock:
+                            totals['errors'] += 1
 
                 else:
                     event_plan[mbx_cfg._key][1] = _('Unchanged')
@@ -362,7 +382,8 @@ class BaseMailSource(threading.Thread):
             except (NoSuchMailboxError, IOError, OSError) as e:
                 event_plan[mbx_cfg._key][1] = '%s: %s' % (_('Error'), e)
                 self._last_rescan_failed = True
-                errors += 1
+                with totals_lock:
+                    totals['errors'] += 1
             except Exception as e:
                 event_plan[mbx_cfg._key][1] = '%s: %s' % (
                     _('Internal error'), e)
@@ -370,27 +391,63 @@ class BaseMailSource(threading.Thread):
                 self._last_rescan_failed = True
                 self._log_status(_('Internal error'))
                 raise
+            return True
 
-        self._last_rescan_completed = all_completed
+        workers = min(self._sync_workers(), len(plan))
+        if workers > 1:
+            # Each worker takes the next mailbox from the plan, so the
+            # mailboxes are still started in order of priority.
+            pending, halted = list(plan), []
+
+            def sync_worker():
+                while not halted:
+                    with totals_lock:
+                        if not pending:
+                            return
+                        mbx_cfg = pending.pop(0)
+                    try:
+                        if not sync_mailbox(mbx_cfg):
+                            halted.append(None)
+                    except:
+                        halted.append(sys.exc_info())
+
+            threads = [threading.Thread(target=sync_worker,
+                                        name='%s/sync-%d' % (self.name, i))
+                       for i in range(0, workers)]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            for t in threads:
+                t.join()
+            for exc_info in halted:
+                if exc_info is not None:
+                    et, ev, etb = exc_info
+                    raise et, ev, etb
+        else:
+            for mbx_cfg in plan:
+                if not sync_mailbox(mbx_cfg):
+                    break
+
+        self._last_rescan_completed = totals['all_completed']
 
         self._state = 'Done'
         status = []
         if discovered > 0:
             status.append(_('Discovered %d mailboxes') % discovered)
             self._last_rescan_completed = False
-        if rescanned > 0:
-            status.append(_('Processed %d mailboxes') % rescanned)
-        if errors:
-            status.append(_('Failed to process %d') % errors)
+        if totals['rescanned'] > 0:
+            status.append(_('Processed %d mailboxes') % totals['rescanned'])
+        if totals['errors']:
+            status.append(_('Failed to process %d') % totals['errors'])
         if not status:
             status.append(_('No new mail at %s'
                             ) % datetime.datetime.today().strftime('%H:%M'))
 
         self._rescan_forced = False
         self._log_status(', '.join(status))
-        self._last_rescan_count = (messages, rescanned)
+        self._last_rescan_count = (totals['messages'], totals['rescanned'])
         self._state = ostate
-        return rescanned
+        return totals['rescanned']
 
     def _jitter(self, seconds):
         return seconds + random.randint(0, self.jitter)
@@ -779,11 +836,39 @@ class BaseMailSource(threading.Thread):
         return ProcessNew(self.session, msg, msg_metadata_kws, msg_ts,
                           keywords, snippet)
 
+    def _update_metadata_keywords(self, mbx_key, mbx_cfg, loc, changes):
+        """
+        Messages we have already indexed may have their flags changed at
+        the source. Bring their tags up to date, reading the metadata
+        keywords the way ProcessNew does when a message is first indexed:
+        messages which have been seen or replied to are no longer new.
+        The changes map local mailbox keys to metadata keywords.
+        """
+        session, config = self.session, self.session.config
+        if not mbx_cfg.process_new or not config.index:
+            return
+
+        index = config.index
+        seen, unseen = set(), set()
+        for loc_key, mkws in changes.iteritems():
+            msg_idx = index.PTRS.get(loc.get_msg_ptr(mbx_key, loc_key))
+            if msg_idx is None:
+                continue
+            if 's:maildir' in mkws or 'r:maildir' in mkws:
+                seen.add(msg_idx)
+            else:
+                unseen.add(msg_idx)
+
+        for tag in config.get_tags(type='unread'):
+            index.remove_tag(session, tag._key, msg_idxs=seen)
+            index.add_tag(session, tag._key, msg_idxs=unseen)
+
     def _msg_key_order(self, key):
         return key
 
     def _copy_new_messages(self, mbx_key, mbx_cfg, src,
-                           stop_after=-1, scan_args=None, deadline=None):
+                           stop_after=-1, scan_args=None, deadline=None,
+                           status=None):
         session, config = self.session, self.session.config
         self.event.data['copying'] = progress = {
             'running': True,
@@ -792,6 +877,8 @@ class BaseMailSource(threading.Thread):
             'copied_bytes': 0,
             'deleting': False,
             'complete': False}
+        if status is not None:
+            status['copying'] = progress
         scan_args = scan_args or {}
         policy = self._policy(mbx_cfg)
         count = 0
@@ -851,64 +938,131 @@ class BaseMailSource(threading.Thread):
             if src == loc:
                 return count
 
-            # Perform housekeeping on the source_map, to make sure it does
-            # not grow without bounds or misrepresent things.
-            gone = []
-            src_keys = set(src.keys())
-            loc_keys = set(loc.keys())
-            for key, val in loc.source_map.iteritems():
-                if (val not in loc_keys) or (key not in src_keys):
-                    gone.append(key)
-            for key in gone:
-                del loc.source_map[key]
-
             # Figure out what actually needs to be downloaded, log it
-            keys = list(src_keys - set(loc.source_map.keys()))
+            loc_keys = set(loc.keys())
+            src_total, keys = self._uncopied_keys(mbx_cfg, src, loc, loc_keys)
             keys.sort(key=self._msg_key_order)
             progress.update({
-                'total': len(src_keys),
+                'total': src_total,
                 'total_local': len(loc_keys),
                 'uncopied': len(keys),
                 'batch_size': stop_after if (stop_after > 0) else len(keys)})
 
-            # Go download!
-            key_errors = []
-            for key in reversed(keys):
-                if self._check_interrupt(log=False, clear=False):
-                    progress['interrupted'] = True
-                    return count
-
-                session.ui.mark(_('Copying message: %s') % key)
-                progress['copying_src_id'] = key
-                try:
-                    mkws = src.get_metadata_keywords(key)
-                    data = src.get_bytes(key)
-                except KeyError:
-                    progress['key_errors'] = key_errors
-                    key_errors.append(key)
-                    # Ignore, in case this is a problem with just this
-                    # individual message...
-                    continue
-
+            # Go download! This is a three stage pipeline: messages are
+            # fetched in this thread, stored in the local mailbox by a
+            # second and indexed by a third. The queues between the stages
+            # are bounded, so if storing or indexing falls behind, fetching
+            # waits instead of piling message data up in memory.
+            stages = progress['stages'] = dict(
+                (stage, {'messages': 0, 'bytes': 0, 'seconds': 0.0})
+                for stage in ('fetch', 'store', 'index'))
+            store_queue = Queue.Queue(self.COPY_QUEUE_SIZE)
+            index_queue = Queue.Queue(self.COPY_QUEUE_SIZE)
+            failed, halted = [], []
+
+            def tally(stage, nbytes, t0):
+                stages[stage]['messages'] += 1
+                stages[stage]['bytes'] += nbytes
+                stages[stage]['seconds'] += time.time() - t0
+
+            def store_message(key, mkws, data):
                 loc_key = loc.add_from_source(key, mkws, data)
                 self.event.data['counters']['copied_messages'] += 1
-                del progress['copying_src_id']
                 progress['copied_messages'] += 1
                 progress['copied_bytes'] += len(data)
                 progress['uncopied'] -= 1
-                count += 1
+                return (loc_key, mkws, data)
 
-                # This forks off a scan job to index the message
+            def index_message(loc_key, mkws, data):
                 config.index.scan_one_message(
                     session, mbx_key, loc, loc_key,
-                    wait=False, msg_data=data, msg_metadata_kws=mkws,
+                    wait=True, msg_data=data, msg_metadata_kws=mkws,
                     **scan_args)
 
-                stop_after -= 1
-                if (stop_after == 0) or (deadline and time.time() > deadline):
-                    maybe_delete_from_server(loc, src)
-                    progress['stopped'] = True
-                    return count
+            def run_stage(stage, work, inq, outq):
+                # After a failure we keep draining our queue, so the
+                # stages upstream never block forever on a full queue. If
+                # we were interrupted, we skip indexing; the rescan of the
+                # local mailbox will catch up later.
+                try:
+                    while True:
+                        item = inq.get()
+                        if item is None:
+                            break
+                        if failed or (halted and stage == 'index'):
+                            continue
+                        t0 = time.time()
+                        try:
+                            result = work(*item)
+                        except:
+                            failed.append(sys.exc_info())
+                            continue
+                        tally(stage, len(item[-1]), t0)
+                        if outq is not None:
+                            outq.put(result)
+                finally:
+                    if outq is not None:
+                        outq.put(None)
+
+            workers = [
+                threading.Thread(target=run_stage, args=(
+                    'store', store_message, store_queue, index_queue)),
+                threading.Thread(target=run_stage, args=(
+                    'index', index_message, index_queue, None))]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+
+            key_errors = []
+            keys.reverse()
+            batch_size = self.COPY_BATCH_SIZE
+            if stop_after > 0:
+                batch_size = min(batch_size, stop_after)
+            stopped = False
+            try:
+                t0 = time.time()
+                for key, mkws, data in self._fetch_messages(src, keys,
+                                                            batch_size):
+                    if failed:
+                        break
+                    if self._check_interrupt(log=False, clear=False):
+                        halted.append(True)
+                        break
+
+                    session.ui.mark(_('Copying message: %s') % key)
+                    if data is None:
+                        progress['key_errors'] = key_errors
+                        key_errors.append(key)
+                        # Ignore, in case this is a problem with just this
+                        # individual message...
+                        t0 = time.time()
+                        continue
+
+                    tally('fetch', len(data), t0)
+                    store_queue.put((key, mkws, data))
+
+                    stop_after -= 1
+                    if ((stop_after == 0) or
+                            (deadline and time.time() > deadline)):
+                        stopped = True
+                        break
+                    t0 = time.time()
+            finally:
+                store_queue.put(None)
+                for worker in workers:
+                    worker.join()
+                count = stages['store']['messages']
+
+            if failed:
+                et, ev, etb = failed[0]
+                raise et, ev, etb
+            if halted:
+                progress['interrupted'] = True
+                return count
+            if stopped:
+                maybe_delete_from_server(loc, src)
+                progress['stopped'] = True
+                return count
             progress['complete'] = True
 
         except IOError:
@@ -929,13 +1083,52 @@ class BaseMailSource(threading.Thread):
         maybe_delete_from_server(loc, src)
         return count
 
-    def rescan_mailbox(self, mbx_key, mbx_cfg, path, stop_after=None):
+    def _uncopied_keys(self, mbx_cfg, src, loc, loc_keys):
+        """
+        Return the number of messages in src and a list of the keys which
+        have not been copied to loc yet.
+        """
+        # Perform housekeeping on the source_map, to make sure it does
+        # not grow without bounds or misrepresent things.
+        gone = []
+        src_keys = set(src.keys())
+        for key, val in loc.source_map.iteritems():
+            if (val not in loc_keys) or (key not in src_keys):
+                gone.append(key)
+        for key in gone:
+            del loc.source_map[key]
+
+        return len(src_keys), list(src_keys - set(loc.source_map.keys()))
+
+    def _fetch_messages(self, src, keys, batch_size):
+        """
+        Yield (key, metadata keywords, data) for each of the keys, in order.
+        Mailboxes which can download many messages at once (get_many) are
+        asked for batch_size messages at a time. The data is None if a
+        message could not be found.
+        """
+        if hasattr(src, 'get_many'):
+            for i in range(0, len(keys), batch_size):
+                for result in src.get_many(keys[i:i + batch_size]):
+                    yield result
+        else:
+            for key in keys:
+                try:
+                    mkws = src.get_metadata_keywords(key)
+                    data = src.get_bytes(key)
+                except KeyError:
+                    mkws = data = None
+                yield key, mkws, data
+
+    def rescan_mailbox(self, mbx_key, mbx_cfg, path, stop_after=None,
+                       status=None):
         session, config = self.session, self.session.config
+        status = {} if (status is None) else status
 
         with self._lock:
-            if self._rescanning:
+            if mbx_key in self._rescanning:
                 return -1
-            self._rescanning = True
+            self._rescanning.add(mbx_key)
 
         mailboxes = min(1, len([m for m in self.my_config.mailbox.values()
                                 if self._policy(m) not in ('ignore',
@@ -985,7 +1178,8 @@ class BaseMailSource(threading.Thread):
                                    ) % (max_copy, self._mailbox_name(path)))
                 copied = self._copy_new_messages(mbx_key, mbx_cfg, mbox,
                                                  stop_after=max_copy,
-                                                 scan_args=scan_mailbox_args)
+                                                 scan_args=scan_mailbox_args,
+                                                 status=status)
                 count += copied
 
             if self._check_interrupt(clear=False):
@@ -999,21 +1193,26 @@ class BaseMailSource(threading.Thread):
             # Wait for background message scans to complete...
             config.scan_worker.do(session, 'Wait:%s' % path, lambda: 1)
 
-            if 'rescans' in self.event.data:
-                self.event.data['rescans'][:-mailboxes] = []
-
-            return count + config.index.scan_mailbox(session,
-                                                     mbx_key,
-                                                     mbx_cfg.local or path,
-                                                     config.open_mailbox,
-                                                     force=self._rescan_forced,
-                                                     **scan_mailbox_args)
+            # Downloads may run in parallel, but the scan progress lives
+            # in our event, so we update the search engine one at a time.
+            with self._scan_lock:
+                if 'rescans' in self.event.data:
+                    self.event.data['rescans'][:-mailboxes] = []
+
+                count += config.index.scan_mailbox(session,
+                                                   mbx_key,
+                                                   mbx_cfg.local or path,
+                                                   config.open_mailbox,
+                                                   force=self._rescan_forced,
+                                                   **scan_mailbox_args)
+                status['rescan'] = self.event.data.get('rescan')
+            return count
         except ValueError:
             session.ui.debug(traceback.format_exc())
             return -1
         finally:
             self._state = ostate
-            self._rescanning = False
+            self._rescanning.discard(mbx_key)
 
     def open_mailbox(self, mbx_id, fn):
         # This allows mail sources to override the default mailbox
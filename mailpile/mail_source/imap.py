@@ -49,6 +49,7 @@ import select
 import ssl
 import traceback
 import time
+import zlib
 from imaplib import IMAP4_SSL, CRLF
 from mailbox import Mailbox, Message
 from urllib import quote, unquote
@@ -78,6 +79,11 @@ from mailpile.vfs import FilePath
 # Real World (no matter what the RFCs say).
 imaplib._MAXLINE = 10 * 1024 * 1024
 
+# Python's imaplib does not know about the ENABLE command (RFC 5161), which
+# we need to turn on QRESYNC. It is only valid once we have logged in.
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
 
 IMAP_TOKEN = re.compile('("[^"]*"'
                         '|[\\(\\)]'
@@ -93,6 +99,11 @@ BLACKLISTED_MAILBOXES = (
     '[gmail]/starred',
     'openpgp_keys')
 
+# All the connections of a source count towards the same compression
+# stats (see _count_compressed). We don't use the source's own lock for
+# this, as it is held during network operations on those connections.
+COMPRESSION_STATS_LOCK = threading.Lock()
+
 
 class IMAP_IOError(IOError):
     pass
@@ -145,6 +156,186 @@ def _parse_imap(reply):
     return (reply[0].upper() == 'OK'), pdata
 
 
+def _uid_set(uids):
+    """
+    Format a list of UIDs as a compact IMAP sequence set.
+
+    >>> _uid_set([5, 1, 2, 3, 7, 9, 10])
+    '1:3,5,7,9:10'
+    """
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join((('%d:%d' % (a, b)) if (a != b) else ('%d' % a))
+                    for a, b in ranges)
+
+
+def _parse_uid_set(uid_set):
+    """
+    Expand an IMAP sequence set (as found in a VANISHED response) into
+    a list of UIDs.
+
+    >>> _parse_uid_set('1:3,5,9:8')
+    [1, 2, 3, 5, 8, 9]
+    """
+    uids = []
+    for part in uid_set.split(','):
+        if ':' in part:
+            a, b = sorted(int(i) for i in part.split(':', 1))
+            uids.extend(range(a, b + 1))
+        elif part:
+            uids.append(int(part))
+    return uids
+
+
+def _parse_fetch_literals(data):
+    """
+    Extract the message data from a raw UID FETCH BODY[] response, as a
+    dictionary keyed by UID. Servers may send the UID before or after the
+    literal.
+
+    >>> sorted(_parse_fetch_literals([
+    ...     ('1 (UID 5 BODY[] {5}', 'Hello'), ')',
+    ...     ('2 (BODY[] {6}', 'World!'), ' UID 7)']).iteritems())
+    [(5, 'Hello'), (7, 'World!')]
+    """
+    results = {}
+    for i, item in enumerate(data):
+        if not isinstance(item, tuple) or len(item) < 2:
+            continue
+        m = re.search(r'\bUID (\d+)', item[0])
+        if not m and i + 1 < len(data) and isinstance(data[i + 1], str):
+            m = re.search(r'\bUID (\d+)', data[i + 1])
+        if m:
+            results[int(m.group(1))] = item[1]
+    return results
+
+
+class _DeflateReader(object):
+    """
+    A file-like object which inflates an RFC 4978 COMPRESS=DEFLATE stream
+    read from a socket, so imaplib can keep calling read() and readline().
+    Byte counts are recorded in the stats dictionary.
+
+    >>> deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+    >>> stream = [deflater.compress('* OK Hello\\r\\n* 1 EXISTS\\r\\nabc') +
+    ...           deflater.flush(zlib.Z_SYNC_FLUSH), '']
+    >>> stats = {}
+    >>> reader = _DeflateReader(lambda bufsize: stream.pop(0), None, stats)
+    >>> reader.readline(), reader.pending(), reader.read(10), reader.read(5)
+    ('* OK Hello\\r\\n', True, '* 1 EXISTS', '\\r\\nabc')
+    >>> stats['received']
+    27
+    """
+    BUFSIZE = 64 * 1024
+
+    def __init__(self, recv, fd, stats):
+        self.recv = recv
+        self.fd = fd
+        self.stats = stats
+        self.inflater = zlib.decompressobj(-15)
+        self.buffer = ''
+
+    def _inflate(self):
+        data = self.recv(self.BUFSIZE)
+        if not data:
+            return None
+        inflated = self.inflater.decompress(data)
+        _count_compressed(self.stats, 'received', len(inflated), len(data))
+        return inflated
+
+    def pending(self):
+        return bool(self.buffer)
+
+    def read(self, size):
+        parts, have = [self.buffer], len(self.buffer)
+        while have < size:
+            data = self._inflate()
+            if data is None:
+                break
+            parts.append(data)
+            have += len(data)
+        data = ''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, limit=-1):
+        while True:
+            eol = self.buffer.find('\n')
+            if eol >= 0 and (limit < 0 or eol < limit):
+                cut = eol + 1
+                break
+            if limit >= 0 and len(self.buffer) >= limit:
+                cut = limit
+                break
+            data = self._inflate()
+            if data is None:
+                cut = len(self.buffer)
+                break
+            self.buffer += data
+        line, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return line
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+
+
+def _count_compressed(stats, which, size, compressed_size):
+    """
+    Add to the byte counts and compression ratio in stats, which may be
+    shared by many connections at once.
+
+    >>> stats = {}
+    >>> def count():
+    ...     for i in range(1000):
+    ...         _count_compressed(stats, 'sent', 10, 4)
+    >>> threads = [threading.Thread(target=count) for i in range(4)]
+    >>> _ = [t.start() for t in threads] + [t.join() for t in threads]
+    >>> stats['sent'], stats['sent_compressed'], stats['ratio']
+    (40000, 16000, 0.4)
+    """
+    with COMPRESSION_STATS_LOCK:
+        stats[which] = stats.get(which, 0) + size
+        stats[which + '_compressed'] = (stats.get(which + '_compressed', 0)
+                                        + compressed_size)
+        total = stats.get('received', 0) + stats.get('sent', 0)
+        if total:
+            stats['ratio'] = round(
+                float(stats.get('received_compressed', 0) +
+                      stats.get('sent_compressed', 0)) / total, 3)
+
+
+def _start_compression(conn, stats):
+    """
+    Switch an authenticated imaplib connection to RFC 4978 DEFLATE
+    compression, by wrapping its read and send paths.
+    """
+    typ, data = conn._simple_command('COMPRESS', 'DEFLATE')
+    if typ != 'OK':
+        return False
+
+    sslobj = getattr(conn, 'sslobj', None)
+    recv = sslobj.read if (sslobj is not None) else conn.sock.recv
+    conn.file = _DeflateReader(recv, conn.file, stats)
+
+    raw_send = conn.send
+    deflater = zlib.compressobj(6, zlib.DEFLATED, -15)
+    def send(data):
+        compressed = (deflater.compress(data) +
+                      deflater.flush(zlib.Z_SYNC_FLUSH))
+        _count_compressed(stats, 'sent', len(data), len(compressed))
+        return raw_send(compressed)
+    conn.send = send
+
+    with COMPRESSION_STATS_LOCK:
+        stats['method'] = 'deflate'
+    return True
+
+
 class ImapMailboxIndex(MailboxIndex):
     pass
 
@@ -172,7 +363,7 @@ class SharedImapConn(threading.Thread):
         self._selected = None
 
         for meth in ('append', 'add', 'authenticate', 'capability', 'fetch',
-                     'noop', 'store', 'expunge', 'close',
+                     'noop', 'store', 'expunge', 'close', 'response',
                      'list', 'login', 'logout', 'namespace', 'search', 'uid'):
             self.__setattr__(meth, self._mk_proxy(meth))
 
@@ -238,12 +429,13 @@ class SharedImapConn(threading.Thread):
             self.name += ' (closed)'
         return self._conn.close()
 
-    def select(self, mailbox='INBOX', readonly=False):
+    def select(self, mailbox='INBOX', readonly=False, refresh=False):
         # This routine caches the SELECT operations, because we will be
         # making lots and lots of superfluous ones "just in case" as part
         # of multiplexing one IMAP connection for multiple mailboxes.
         safe_assert(self._lock.locked())
-        if self._selected and self._selected[0] == (mailbox, readonly):
+        if (self._selected and self._selected[0] == (mailbox, readonly)
+                and not refresh):
             return self._selected[1]
         elif self._selected:
             try:
@@ -254,7 +446,8 @@ class SharedImapConn(threading.Thread):
         rv = self._conn.select(mailbox='"%s"' % mailbox, readonly=readonly)
         if rv[0].upper() == 'OK':
             info = dict(self._conn.response(f) for f in
-                        ('FLAGS', 'EXISTS', 'RECENT', 'UIDVALIDITY'))
+                        ('FLAGS', 'EXISTS', 'RECENT', 'UIDVALIDITY',
+                         'HIGHESTMODSEQ'))
             self._selected = ((mailbox, readonly), rv, info)
         else:
             info = '(error)'
@@ -268,6 +461,15 @@ class SharedImapConn(threading.Thread):
             return default
         return self._selected[2].get(k, default)
 
+    def selected_mailbox(self):
+        return self._selected and self._selected[0][0]
+
+    def connected(self):
+        return self._conn is not None
+
+    def busy(self):
+        return self._lock.locked()
+
     def _update_name(self):
         name = self._conn and self._conn.host
         if name:
@@ -320,7 +522,11 @@ class SharedImapConn(threading.Thread):
             while True:
                 rl = wl = xl = None
                 try:
-                    rl, wl, xl = select.select([self._conn.sock], [], [], 1)
+                    if getattr(self._conn.file, 'pending', lambda: False)():
+                        rl = True
+                    else:
+                        rl, wl, xl = select.select([self._conn.sock],
+                                                   [], [], 1)
                 except socket.error:
                     pass
                 if mailpile.util.QUITTING or not self._can_idle:
@@ -397,7 +603,8 @@ class SharedImapMailbox(Mailbox):
         self._broken = None
 
     def open_imap(self):
-        return self.source.open(throw=IMAP_IOError, conn_cls=self.conn_cls)
+        return self.source.open(throw=IMAP_IOError, conn_cls=self.conn_cls,
+                                mailbox=self.path)
 
     def timed_imap(self, *args, **kwargs):
         return self.source.timed_imap(*args, **kwargs)
@@ -440,10 +647,10 @@ class SharedImapMailbox(Mailbox):
             self._assert(ok, _('Failed to remove message'))
         self._broken = False
 
-    def mailbox_info(self, k, default=None):
+    def mailbox_info(self, k, default=None, refresh=False):
         self._broken = None
         with self.open_imap() as imap:
-            imap.select(self.path)
+            imap.select(self.path, refresh=refresh)
             return imap.mailbox_info(k, default=default)
         self._broken = False
 
@@ -468,45 +675,134 @@ class SharedImapMailbox(Mailbox):
         self._broken = False
         return info
 
-    def get(self, key, _bytes=None):
-        info = self.get_info(key)
+    def get(self, key, _bytes=None, _info=None):
+        info = _info or self.get_info(key)
         if 'UID' not in info:
             raise KeyError(key)
 
-        # FIXME: This will hard fail to download mail, if our internet
-        #        connection averages 8 kbps or worse. Better would be to
-        #        adapt the chunk size here to actual network performance.
-        #
-        chunk_size = self.source.timeout * 1024
-        chunk = 0
-        msg_data = []
-        if _bytes and chunk_size > _bytes:
-            chunk_size = _bytes
-
         # Some IMAP servers misreport RFC822.SIZE, so we cannot really know
         # how much data to expect. So we just FETCH chunk until one comes up
-        # short or empty and assume that's it...
-        while chunk >= 0:
-            req = '(BODY.PEEK[]<%d.%d>)' % (chunk * chunk_size, chunk_size)
+        # short or empty and assume that's it... The chunk size adapts to
+        # the speed of our connection as we go.
+        chunk = offset = 0
+        msg_data = []
+        while True:
+            chunk_size = self.source.fetch_chunk_size()
+            if _bytes:
+                chunk_size = min(chunk_size, _bytes - offset)
+            req = '(BODY.PEEK[]<%d.%d>)' % (offset, chunk_size)
             with self.open_imap() as imap:
                 # Note: use the raw method, not the convenient parsed version.
-                typ, data = self.source.timed(imap.uid,
-                                              'FETCH', info['UID'], req,
-                                              mailbox=self.path)
+                typ, data, elapsed = self._timed_fetch(
+                    imap.uid, 'FETCH', info['UID'], req, mailbox=self.path)
             self._assert(typ == 'OK',
                          _('Fetching chunk %d failed') % chunk)
             msg_data.append(data[0][1])
+            self.source.record_fetch(len(data[0][1]), elapsed)
+            offset += len(data[0][1])
+            chunk += 1
             if len(data[0][1]) < chunk_size:
-                chunk = -1
-            else:
-                chunk += 1
-            if _bytes and chunk * chunk_size > _bytes:
-                chunk = -1
+                break
+            if _bytes and offset >= _bytes:
+                break
 
         # FIXME: Should we add a sanity check and complain if we got
         #        significantly less data than expected via. RFC822.SIZE?
         return info, ''.join(msg_data)
 
+    def get_many(self, keys):
+        """
+        Yield (key, metadata keywords, message data) for a batch of
+        messages, in order, using as few round trips as possible: one
+        FETCH for the flags and sizes of them all, then one FETCH for each
+        group of messages which together fit in a single download chunk.
+        Bigger messages are downloaded chunk by chunk, as in get().
+
+        Messages which no longer exist are yielded with None as their data.
+        """
+        uids, validities = {}, set()
+        for key in keys:
+            uidv, uid = (int(k, 36) for k in key.split('.'))
+            uids[key] = uid
+            validities.add(str(uidv))
+
+        self._broken = None
+        infos = {}
+        with self.open_imap() as imap:
+            ok, data = self.timed_imap(imap.uid, 'FETCH',
+                                       _uid_set(uids.values()),
+                                       '(UID RFC822.SIZE FLAGS)',
+                                       mailbox=self.path)
+            self._assert(ok, _('Failed to list mailbox contents'))
+            self._assert(validities <= set(imap.mailbox_info('UIDVALIDITY',
+                                                             ['0'])),
+                         _('Mailbox is out of sync'))
+        for item in data:
+            if isinstance(item, list):
+                info = dict(zip(*[iter(item)]*2))
+                if 'UID' in info and 'RFC822.SIZE' in info:
+                    info['UID'] = int(info['UID'])
+                    infos[info['UID']] = info
+        self._broken = False
+
+        chunk_size = self.source.fetch_chunk_size()
+        group, group_bytes = [], 0
+        for key in keys:
+            info = infos.get(uids[key])
+            size = long(info['RFC822.SIZE']) if info else 0
+            if info and size < chunk_size:
+                group.append(key)
+                group_bytes += size
+                if group_bytes < chunk_size:
+                    continue
+
+            for item in self._get_group(group, uids, infos):
+                yield item
+            group, group_bytes = [], 0
+            if info is None:
+                yield key, None, None
+            elif size >= chunk_size:
+                info, msg_data = self.get(key, _info=info)
+                yield key, self._metadata_keywords(info), msg_data
+
+        for item in self._get_group(group, uids, infos):
+            yield item
+
+    def _get_group(self, keys, uids, infos):
+        if not keys:
+            return
+        with self.open_imap() as imap:
+            # Note: use the raw method, not the convenient parsed version.
+            typ, data, elapsed = self._timed_fetch(
+                imap.uid, 'FETCH', _uid_set(uids[k] for k in keys),
+                '(UID BODY.PEEK[])', mailbox=self.path)
+        self._assert(typ == 'OK', _('Fetching messages failed'))
+        msg_datas = _parse_fetch_literals(data)
+        self.source.record_fetch(sum(len(d) for d in msg_datas.values()),
+                                 elapsed)
+        for key in keys:
+            info = infos[uids[key]]
+            msg_data = msg_datas.get(uids[key])
+            if msg_data is None:
+                # Server didn't give us this one; try again the slow way
+                try:
+                    info, msg_data = self.get(key, _info=info)
+                except KeyError:
+                    yield key, None, None
+                    continue
+            yield key, self._metadata_keywords(info), msg_data
+
+    def _timed_fetch(self, *args, **kwargs):
+        # Run a FETCH, returning the raw response and the time it took,
+        # so the source can adapt its chunk size.
+        t0 = time.time()
+        try:
+            typ, data = self.source.timed(*args, **kwargs)
+        except TimedOut:
+            self.source.record_fetch(0, time.time() - t0, timed_out=True)
+            raise
+        return typ, data, time.time() - t0
+
     def get_message(self, key):
         info, payload = self.get(key)
         return Message(payload)
@@ -533,6 +829,46 @@ class SharedImapMailbox(Mailbox):
     def keys(self):
         return list(self.iterkeys())
 
+    def changes_since(self, modseq):
+        """
+        Use QRESYNC (RFC 7162) to ask which messages have been added or had
+        their flags changed since modseq, and which have been expunged,
+        without listing the whole mailbox. Returns a dictionary mapping the
+        keys of changed messages to their metadata keywords, and a list of
+        vanished keys.
+        """
+        self._broken = None
+        with self.open_imap() as imap:
+            # Note: use the raw method, not the convenient parsed version;
+            #       imaplib returns [None] if nothing has changed.
+            typ, data = self.source.timed(imap.uid, 'FETCH', '1:*',
+                                          '(UID FLAGS)',
+                                          '(CHANGEDSINCE %s VANISHED)' % modseq,
+                                          mailbox=self.path)
+            self._assert(typ == 'OK', _('Failed to list mailbox changes'))
+            validity = imap.mailbox_info('UIDVALIDITY', ['0'])[0]
+            vtyp, vanished = imap.response('VANISHED')
+        self._broken = False
+
+        def key(uid):
+            return '%s.%s' % (b36(int(validity)), b36(int(uid)))
+
+        changed = {}
+        ok, data = _parse_imap((typ, [d for d in data if d]))
+        for item in data:
+            if isinstance(item, list):
+                info = dict(zip(*[iter(item)]*2))
+                if 'UID' in info:
+                    changed[key(info['UID'])] = self._metadata_keywords(info)
+
+        gone = []
+        for line in vanished:
+            if line:
+                uid_set = line.split()[-1]
+                gone.extend(key(uid) for uid in _parse_uid_set(uid_set))
+
+        return changed, gone
+
     def update_toc(self):
         self._last_updated = time.time()
 
@@ -549,8 +885,11 @@ class SharedImapMailbox(Mailbox):
         return long(self.get_info(key).get('RFC822.SIZE', 0))
 
     def get_metadata_keywords(self, key):
+        return self._metadata_keywords(self.get_info(key))
+
+    def _metadata_keywords(self, info):
         # Translate common IMAP flags into the maildir vocabulary
-        flags = [f.lower() for f in self.get_info(key).get('FLAGS', '')]
+        flags = [f.lower() for f in info.get('FLAGS', '')]
         mkws = []
         for char, flag in (('s', '\\seen'),
                            ('r', '\\answered'),
@@ -611,7 +950,7 @@ class SharedImapMailbox(Mailbox):
 
 def _connect_imap(session, settings, event,
                   conn_cls=None, timeout=30, throw=False,
-                  logged_in_cb=None, source=None):
+                  logged_in_cb=None, source=None, compression=None):
 
     def timed(*args, **kwargs):
         if source is not None:
@@ -626,7 +965,7 @@ def _connect_imap(session, settings, event,
     conn = None
     try:
         # Prepare the data section of our event, for keeping state.
-        for d in ('mailbox_state',):
+        for d in ('mailbox_state', 'mailbox_modseq'):
             if d not in event.data:
                 event.data[d] = {}
         ev = event.data['connection'] = {
@@ -721,6 +1060,20 @@ def _connect_imap(session, settings, event,
                 raise throw(ev['error'][1])
             return WithaBool(False)
 
+        # Servers often advertise more once we are logged in.
+        ok, data = timed_imap(conn.capability)
+        if ok:
+            capabilities = set(' '.join(data).upper().split())
+
+        # Mail is mostly text, so compression is a big win on slow links.
+        if 'COMPRESS=DEFLATE' in capabilities:
+            try:
+                ev['compressed'] = timed(_start_compression, conn,
+                                         {} if (compression is None)
+                                         else compression)
+            except IMAP4.error:
+                ev['compressed'] = False
+
         if logged_in_cb is not None:
             logged_in_cb(conn, ev, capabilities)
 
@@ -762,15 +1115,22 @@ class ImapMailSource(BaseMailSource):
     """
     This is a mail source that connects to an IMAP server.
 
-    A single connection is made to the IMAP server, which is then shared
-    between the ImapMailSource job and individual mailbox instances.
+    A primary connection is made to the IMAP server, which is shared
+    between the ImapMailSource job and individual mailbox instances and
+    does IDLE on the INBOX. If the configuration allows more than one
+    connection, mailboxes are downloaded in parallel using a small pool
+    of additional connections, one per mailbox being synced.
     """
     # This is a helper for the events.
     __classname__ = 'mailpile.mail_source.imap.ImapMailSource'
 
     TIMEOUT_INITIAL = 60
     TIMEOUT_LIVE = 120
+    FETCH_TARGET_SECONDS = 10        # Aim for FETCHes that take this long
+    FETCH_CHUNK_MIN = 8 * 1024       # ... but never fetch less than this
+    FETCH_CHUNK_MAX = 8 * 1024 * 1024  # ... or more than this at once
     CONN_ERRORS = (IOError, IMAP_IOError, IMAP4.error, TimedOut)
+    CONN_LIMIT_TTL = 3600            # Forget learned connection limits
 
 
     class MailSourceVfs(BaseMailSource.MailSourceVfs):
@@ -835,11 +1195,19 @@ class ImapMailSource(BaseMailSource):
         self.last_op = 0
         self.watching = -1
         self.capabilities = set()
+        self.enabled = set()
         self.logged_in_at = None
         self.namespaces = {'private': []}
         self.flag_cache = {}
         self.conn = None
         self.conn_id = ''
+        self.conn_pool = []
+        self.conn_leases = {}
+        self.conn_limit = None
+        self.conn_limit_expires = 0
+        self.conn_opening = 0
+        self.conn_pool_gen = 0
+        self._local_transfer_stats = {}
 
     @classmethod
     def Tester(cls, conn_cls, *args, **kwargs):
@@ -863,6 +1231,8 @@ class ImapMailSource(BaseMailSource):
 
     def close(self):
         with self._lock:
+            self._close_pool()
+            self.conn_limit = None
             if self.conn:
                 self.event.data['connection'] = {
                     'live': False,
@@ -871,7 +1241,200 @@ class ImapMailSource(BaseMailSource):
                 self.conn.quit()
                 self.conn = None
 
-    def open(self, conn_cls=None, throw=False):
+    def _close_pool(self):
+        with self._lock:
+            pool, self.conn_pool = self.conn_pool, []
+            self.conn_leases = {}
+            self.conn_pool_gen += 1
+        for conn in pool:
+            conn.quit()
+
+    def _max_pool_size(self):
+        limit = self.my_config.connections
+        if self.conn_limit is not None:
+            if self.conn_limit_expires > time.time():
+                limit = min(limit, self.conn_limit)
+            else:
+                self.conn_limit = None
+        return max(0, limit - 1)
+
+    def _sync_workers(self):
+        return max(1, self._max_pool_size())
+
+    def _transfer_stats(self):
+        # These live in our event, so they survive restarts.
+        if not self.event:
+            return self._local_transfer_stats
+        return self.event.data.setdefault('transfer', {})
+
+    def fetch_chunk_size(self):
+        """How many bytes of message data to request in one FETCH."""
+        return int(self._transfer_stats().get('chunk_size') or
+                   (self.timeout * 1024))
+
+    def record_fetch(self, nbytes, elapsed, timed_out=False):
+        """
+        Update our throughput estimate after a FETCH and adjust the chunk
+        size so a FETCH takes about FETCH_TARGET_SECONDS. Small transfers
+        say more about latency than bandwidth, so we ignore them. After a
+        timeout we halve the chunk size.
+        """
+        with self._lock:
+            stats = self._transfer_stats()
+            chunk_size = self.fetch_chunk_size()
+            if timed_out:
+                chunk_size //= 2
+                stats['timeouts'] = stats.get('timeouts', 0) + 1
+            elif nbytes >= self.FETCH_CHUNK_MIN:
+                bps = nbytes / max(elapsed, 0.001)
+                if stats.get('bytes_per_second'):
+                    bps = (0.7 * stats['bytes_per_second']) + (0.3 * bps)
+                stats['bytes_per_second'] = int(bps)
+                stats['samples'] = stats.get('samples', 0) + 1
+                # Shrink right away, but grow gradually.
+                chunk_size = min(2 * chunk_size,
+                                 bps * self.FETCH_TARGET_SECONDS)
+            else:
+                return
+            stats['chunk_size'] = int(max(self.FETCH_CHUNK_MIN,
+                                          min(self.FETCH_CHUNK_MAX,
+                                              chunk_size)))
+
+    def _compression_stats(self):
+        # All our connections count towards the same totals, so the
+        # event shows the overall compression ratio (compressed/raw).
+        if not self.event:
+            return {}
+        return self.event.data.setdefault('compression', {})
+
+    def _open_pool_conn(self, conn_cls=None):
+        """
+        Open an extra connection for downloading a mailbox. If the server
+        refuses (says BYE or NO, rather than the network failing), we
+        assume we have hit its connection limit and stop growing the pool
+        for a while.
+        """
+        def logged_in_cb(conn, ev, capabilities):
+            self._enable_extensions(conn, capabilities)
+
+        # A scratch event, so errors don't mask the state of our primary
+        # connection in the UI.
+        event = Event(source=self, flags=Event.RUNNING, data={})
+        conn = _connect_imap(self.session, self.my_config, event,
+                             conn_cls=conn_cls,
+                             timeout=self.timeout,
+                             logged_in_cb=logged_in_cb,
+                             source=self,
+                             compression=self._compression_stats())
+        if not conn:
+            error = event.data['connection']['error']
+            if error[0] in ('protocol', 'auth'):
+                with self._lock:
+                    self.conn_limit = 1 + len(self.conn_pool)
+                    self.conn_limit_expires = time.time() + self.CONN_LIMIT_TTL
+                if 'imap' in self.session.config.sys.debug:
+                    self.session.ui.debug('Connection limit is %d: %s'
+                                          % (self.conn_limit, error))
+            return None
+        return SharedImapConn(self.session, conn)
+
+    def _lease_conn(self, mailbox, conn_cls=None):
+        """
+        Dedicate a pool connection to a mailbox while we sync it, opening
+        a new one if we are below our limits.
+
+        Connecting and logging in is slow, so we do that without holding
+        our lock, to not hold up the primary connection or other workers.
+        """
+        with self._lock:
+            self.conn_pool = [c for c in self.conn_pool if c.connected()]
+            leased = set(self.conn_leases.values())
+            free = [c for c in self.conn_pool if c not in leased]
+            if free:
+                # Prefer a connection which has this mailbox selected.
+                conn = ([c for c in free if c.selected_mailbox() == mailbox]
+                        or free)[0]
+                self.conn_leases[mailbox] = conn
+                return conn
+            if (len(self.conn_pool) + self.conn_opening
+                    >= self._max_pool_size()):
+                return None
+            self.conn_opening += 1
+            pool_gen = self.conn_pool_gen
+
+        conn = None
+        try:
+            conn = self._open_pool_conn(conn_cls=conn_cls)
+        finally:
+            with self._lock:
+                self.conn_opening -= 1
+                if conn and pool_gen == self.conn_pool_gen:
+                    self.conn_pool.append(conn)
+                    self.conn_leases[mailbox] = conn
+                    new_conn = conn
+                else:
+                    new_conn = None
+        if conn and not new_conn:
+            # The pool was closed while we were connecting
+            conn.quit()
+        return new_conn
+
+    def _release_conn(self, mailbox):
+        with self._lock:
+            self.conn_leases.pop(mailbox, None)
+
+    def _mailbox_conn(self, mailbox):
+        """
+        Choose a pool connection for working with a mailbox: the one leased
+        to it if it is being synced, or an idle unleased one. Returns None
+        if the primary connection should be used.
+        """
+        with self._lock:
+            conn = self.conn_leases.get(mailbox)
+            if conn is not None and conn.connected():
+                return conn
+            leased = set(self.conn_leases.values())
+            free = [c for c in self.conn_pool if c.connected()
+                    and c not in leased and not c.busy()]
+            if free:
+                return ([c for c in free if c.selected_mailbox() == mailbox]
+                        or free)[0]
+        return None
+
+    def rescan_mailbox(self, mbx_key, mbx_cfg, path, **kwargs):
+        mailbox = self._mailbox_path(path)
+        self._lease_conn(mailbox)
+        try:
+            return BaseMailSource.rescan_mailbox(self, mbx_key, mbx_cfg, path,
+                                                 **kwargs)
+        finally:
+            self._release_conn(mailbox)
+
+    def _enable_extensions(self, conn, capabilities):
+        """Turn on the IMAP extensions we know how to use."""
+        enabled = set()
+
+        # If the server can tell us what changed since our last visit
+        # (RFC 7162), we want to hear about expunged messages as well as
+        # new messages and changed flags.
+        if 'QRESYNC' in capabilities and 'ENABLE' in capabilities:
+            try:
+                typ, data = self.timed(conn._simple_command,
+                                       'ENABLE', 'QRESYNC')
+                if typ == 'OK':
+                    typ, data = conn._untagged_response(typ, data, 'ENABLED')
+                    enabled |= set(' '.join(d for d in data if d
+                                            ).upper().split())
+            except IMAP4.error:
+                pass
+
+        return enabled
+
+    def open(self, conn_cls=None, throw=False, mailbox=None):
+        if mailbox is not None:
+            conn = self.open(conn_cls=conn_cls, throw=throw)
+            return (conn and self._mailbox_conn(mailbox)) or conn
+
         conn = self.conn
         conn_id = self._conn_id()
         if conn:
@@ -894,6 +1457,7 @@ class ImapMailSource(BaseMailSource):
                 if self.conn == conn:
                     self.conn = None
             conn.quit()
+            self._close_pool()
 
         my_config = self.my_config
 
@@ -908,6 +1472,7 @@ class ImapMailSource(BaseMailSource):
                 if self.conn is not None:
                     raise IOError('Woah, we lost a race.')
                 self.capabilities = capabilities
+                self.enabled = self._enable_extensions(conn, capabilities)
 
                 if 'NAMESPACE' in capabilities:
                     ok, data = self.timed_imap(conn.namespace)
@@ -933,6 +1498,7 @@ class ImapMailSource(BaseMailSource):
             if 'imap' in self.session.config.sys.debug:
                 self.session.ui.debug('CONNECTED %s' % self.conn)
                 self.session.ui.debug('CAPABILITIES %s' % self.capabilities)
+                self.session.ui.debug('ENABLED %s' % self.enabled)
                 self.session.ui.debug('NAMESPACES %s' % self.namespaces)
 
             self.conn_id = conn_id
@@ -943,7 +1509,8 @@ class ImapMailSource(BaseMailSource):
                              timeout=self.timeout,
                              throw=throw,
                              logged_in_cb=logged_in_cb,
-                             source=self)
+                             source=self,
+                             compression=self._compression_stats())
         if conn:
             self.logged_in_at = time.time()
             return self.conn
@@ -980,13 +1547,23 @@ class ImapMailSource(BaseMailSource):
 
     def _has_mailbox_changed(self, mbx_cfg, state):
         shared_mbox = self.open_mailbox(*self._get_mbx_id_and_mfn(mbx_cfg))
-        uv = state['uv'] = shared_mbox.mailbox_info('UIDVALIDITY', ['0'])[0]
+        # Pool connections may keep a mailbox selected for a long time, so
+        # make sure we are not looking at a stale SELECT response.
+        uv = state['uv'] = shared_mbox.mailbox_info('UIDVALIDITY', ['0'],
+                                                    refresh=True)[0]
         ex = state['ex'] = shared_mbox.mailbox_info('EXISTS', ['0'])[0]
+        ms = state['ms'] = shared_mbox.mailbox_info('HIGHESTMODSEQ', [None])[0]
         uvex = '%s/%s' % (uv, ex)
         if uvex == '0/0':
             return True
-        return (uvex != self.event.data.get('mailbox_state',
-                                            {}).get(mbx_cfg._key))
+        if (uvex != self.event.data.get('mailbox_state',
+                                        {}).get(mbx_cfg._key)):
+            return True
+        # With CONDSTORE, flag changes made elsewhere bump HIGHESTMODSEQ
+        # even if the message count stays the same.
+        return (ms is not None and
+                '%s/%s' % (uv, ms) != self.event.data.get('mailbox_modseq',
+                                                          {}).get(mbx_cfg._key))
 
     def _mark_mailbox_rescanned(self, mbx, state):
         uvex = '%s/%s' % (state['uv'], state['ex'])
@@ -994,6 +1571,54 @@ class ImapMailSource(BaseMailSource):
             self.event.data['mailbox_state'][mbx._key] = uvex
         else:
             self.event.data['mailbox_state'] = {mbx._key: uvex}
+        if state.get('ms') is not None:
+            uvms = '%s/%s' % (state['uv'], state['ms'])
+            if 'mailbox_modseq' in self.event.data:
+                self.event.data['mailbox_modseq'][mbx._key] = uvms
+            else:
+                self.event.data['mailbox_modseq'] = {mbx._key: uvms}
+
+    def _synced_modseq(self, mbx_cfg, src):
+        """
+        Return the HIGHESTMODSEQ of our last complete sync of this mailbox,
+        if QRESYNC lets us ask the server what changed since then.
+        """
+        if ('QRESYNC' not in self.enabled or self._rescan_forced or
+                not hasattr(src, 'changes_since')):
+            return None
+        uvms = self.event.data.get('mailbox_modseq', {}).get(mbx_cfg._key)
+        if not uvms:
+            return None
+        uv, ms = uvms.split('/')
+        if uv != src.mailbox_info('UIDVALIDITY', ['0'])[0]:
+            return None
+        return ms
+
+    def _uncopied_keys(self, mbx_cfg, src, loc, loc_keys):
+        modseq = self._synced_modseq(mbx_cfg, src)
+        if modseq is None:
+            return BaseMailSource._uncopied_keys(self, mbx_cfg, src, loc,
+                                                 loc_keys)
+
+        changed, vanished = src.changes_since(modseq)
+        gone = [key for key, val in loc.source_map.iteritems()
+                if val not in loc_keys]
+        for key in gone + vanished:
+            loc.source_map.pop(key, None)
+
+        # Messages we already have just get their flags and tags updated.
+        keys, updated = [], {}
+        for key, mkws in changed.iteritems():
+            loc_key = loc.source_map.get(key)
+            if loc_key is None:
+                keys.append(key)
+            else:
+                loc.set_metadata_keywords(loc_key, mkws)
+                updated[loc_key] = mkws
+        if updated:
+            self._update_metadata_keywords(FormatMbxId(mbx_cfg._key),
+                                           mbx_cfg, loc, updated)
+        return int(src.mailbox_info('EXISTS', ['0'])[0]), keys
 
     def _namespace_info(self, path):
         for which, nslist in self.namespaces.iteritems():
@@ -1194,6 +1819,30 @@ class _Mocks(object):
 
     >>> ImapMailSource.Tester(_Mocks.BadLogin, session, imap_config)
     False
+
+    Flag changes reported by QRESYNC update the tags of messages we have
+    already downloaded and indexed:
+
+    >>> import mailpile.plugins.tags
+    >>> session.config.tags['n'] = {'name': 'New', 'type': 'unread'}
+    >>> session.config.index = _Mocks.Index({'0001loc5': 5, '0001loc6': 6})
+    >>> imap_config.mailbox['0001'] = {'path': 'INBOX'}
+    >>> imap = ImapMailSource(session, imap_config)
+    >>> imap.open(conn_cls=_Mocks.QResync)
+    <SharedImapConn(mock, started ...)>
+    >>> sorted(imap.enabled)
+    ['QRESYNC']
+    >>> imap.event = Event(data={'mailbox_modseq': {'0001': '7/90'}})
+    >>> src = SharedImapMailbox(session, imap, conn_cls=_Mocks.QResync)
+    >>> loc = _Mocks.LocalMailbox({'7.5': 'loc5', '7.6': 'loc6'})
+    >>> imap._uncopied_keys(imap_config.mailbox['0001'], src, loc,
+    ...                     set(['loc5', 'loc6']))
+    remove_tag(n, [5])
+    add_tag(n, [6])
+    (2, [])
+    >>> sorted(loc.keywords.items())
+    [('loc5', ['s:maildir']), ('loc6', [])]
+    >>> session.config.index = None
     """
     class NoDns(_MockImap):
         def __init__(self, *args, **kwargs):
@@ -1202,6 +1851,49 @@ class _Mocks(object):
     class BadLogin(_MockImap):
         RESULTS = {'login': ('BAD', ['"Sorry dude"'])}
 
+    class QResync(_MockImap):
+        # Message UID 5 was marked as read, UID 6 as unread.
+        RESULTS = {
+            'capability': ('OK', ['IMAP4rev1 ENABLE QRESYNC']),
+            'select': ('OK', ['2']),
+            'uid': ('OK', ['1 (UID 5 FLAGS (\\Seen))', '2 (UID 6 FLAGS ())'])}
+        RESPONSES = {
+            'EXISTS': ['2'],
+            'UIDVALIDITY': ['7'],
+            'HIGHESTMODSEQ': ['91']}
+
+        def _simple_command(self, *args):
+            return ('OK', [])
+
+        def _untagged_response(self, typ, data, name):
+            return (typ, ['QRESYNC'])
+
+        def response(self, name):
+            return (name, self.RESPONSES.get(name, [None]))
+
+    class Index(object):
+        def __init__(self, ptrs):
+            self.PTRS = ptrs
+
+        def add_tag(self, session, tag_id, msg_idxs=None):
+            if msg_idxs:
+                print('add_tag(%s, %s)' % (tag_id, sorted(msg_idxs)))
+
+        def remove_tag(self, session, tag_id, msg_idxs=None):
+            if msg_idxs:
+                print('remove_tag(%s, %s)' % (tag_id, sorted(msg_idxs)))
+
+    class LocalMailbox(object):
+        def __init__(self, source_map):
+            self.source_map = source_map
+            self.keywords = {}
+
+        def get_msg_ptr(self, mboxid, key):
+            return '%s%s' % (mboxid, key)
+
+        def set_metadata_keywords(self, key, mkws):
+            self.keywords[key] = mkws
+
 
 if __name__ == "__main__":
     import doctest
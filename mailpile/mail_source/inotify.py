@@ -0,0 +1,189 @@
+"""
+A minimal ctypes wrapper around the Linux inotify API.
+
+This lets the local mail source learn which mailboxes changed, instead of
+stat()-ing every mailbox on every pass. It is strictly optional: if the
+platform or libc does not support inotify, creating a watcher raises
+OSError and callers should fall back to polling.
+
+>>> import tempfile, shutil
+>>> tmpdir = tempfile.mkdtemp()
+>>> iw = InotifyWatcher()
+>>> iw.watch(tmpdir, 'mbx1')
+True
+>>> iw.changed(timeout=0)
+set([])
+>>> open(os.path.join(tmpdir, 'msg'), 'w').write('Hello')
+>>> sorted(iw.changed(timeout=1))
+['mbx1']
+>>> iw.watched()
+1
+>>> iw.forget('mbx1')
+>>> iw.watched()
+0
+>>> iw.close()
+>>> shutil.rmtree(tmpdir)
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+import mailpile.platforms
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE |
+              IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+_LIBC = None
+
+
+def _libc():
+    global _LIBC
+    if _LIBC is None:
+        if not mailpile.platforms.SupportsInotify():
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _LIBC = libc
+    return _LIBC
+
+
+class InotifyWatcher(object):
+    """
+    Watch a set of paths, each of which is associated with a key (the
+    mailbox ID, in practice). The changed() method reports which keys
+    have seen activity since it was last called.
+
+    If the kernel event queue overflows, or a watched path is deleted or
+    moved, we can no longer trust what we know. In that case the key
+    (or, on overflow, every key) is reported as changed and forgotten,
+    so the caller can re-establish its watches.
+    """
+    def __init__(self):
+        self.libc = _libc()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.wd_keys = {}
+        self.key_wds = {}
+
+    def watch(self, path, key):
+        """Add a watch on path, returning False if that fails."""
+        if self.fd is None:
+            return False
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            return False
+        self.wd_keys.setdefault(wd, set()).add(key)
+        self.key_wds.setdefault(key, set()).add(wd)
+        return True
+
+    def forget(self, key):
+        """Remove all the watches associated with a key."""
+        for wd in self.key_wds.pop(key, []):
+            keys = self.wd_keys.get(wd, set())
+            keys.discard(key)
+            if not keys:
+                self.wd_keys.pop(wd, None)
+                if self.fd is not None:
+                    self.libc.inotify_rm_watch(self.fd, wd)
+
+    def watched(self):
+        return len(self.key_wds)
+
+    def is_watching(self, key):
+        return key in self.key_wds
+
+    def _read_events(self):
+        data = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            if not chunk:
+                break
+            data.append(chunk)
+        data = ''.join(data)
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, nlen = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + nlen
+            yield wd, mask
+
+    def changed(self, timeout=0):
+        """
+        Return the set of keys whose paths changed, waiting up to timeout
+        seconds for something to happen.
+        """
+        if self.fd is None:
+            return set()
+        try:
+            readable = select.select([self.fd], [], [], timeout)[0]
+        except (select.error, IOError, OSError):
+            readable = [self.fd]
+        if not readable:
+            return set()
+
+        changed, lost = set(), set()
+        for wd, mask in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                lost |= set(self.key_wds.keys())
+            keys = self.wd_keys.get(wd, set())
+            changed |= keys
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                lost |= keys
+        for key in lost:
+            self.forget(key)
+        return changed | lost
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+        self.fd = None
+        self.wd_keys = {}
+        self.key_wds = {}
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print('%s' % (results, ))
+    if results.failed:
+        sys.exit(1)
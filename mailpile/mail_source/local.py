@@ -2,6 +2,7 @@ import time
 import os
 
 from mailpile.mail_source import BaseMailSource
+from mailpile.mail_source.inotify import InotifyWatcher
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.vfs import FilePath
@@ -14,6 +15,10 @@ class LocalMailSource(BaseMailSource):
     # This is a helper for the events.
     __classname__ = 'mailpile.mail_source.local.LocalMailSource'
 
+    # When inotify tells us what changed, we only fall back to stat()-ing
+    # every single mailbox once every this many passes.
+    POLL_FALLBACK_LOOPS = 12
+
     def __init__(self, *args, **kwargs):
         BaseMailSource.__init__(self, *args, **kwargs)
         if not self.my_config.name:
@@ -22,8 +27,21 @@ class LocalMailSource(BaseMailSource):
         self.my_config.protocol = 'local'  # We may be upgrading an old
                                            # mbox or maildir source.
         self.watching = -1
+        self.watcher = None
+        self.dirty = set()
+        self.unsettled = set()
 
     def _sleeping_is_ok(self, slept):
+        if self.watcher:
+            try:
+                self.dirty |= self.watcher.changed(timeout=0)
+            except (OSError, IOError):
+                self._stop_watcher()
+                return True
+            # As with polling, give writers a few seconds to finish up
+            # before we wake up and go look at what they did.
+            return not (slept > 5 and self.dirty)
+
         if slept > 5:
             #
             # If any of the most recently changed mailboxes has changed
@@ -42,10 +60,74 @@ class LocalMailSource(BaseMailSource):
         return True
 
     def close(self):
+        with self._lock:
+            self._stop_watcher()
+
+    def _check_keepalive(self):
+        # There is no connection to drop between passes, and closing would
+        # throw away our inotify watches (forcing a stat() of every mailbox
+        # on the next pass). We only close on shutdown or when disabled.
         pass
 
+    def _stop_watcher(self):
+        if self.watcher:
+            self.watcher.close()
+        self.watcher = None
+        self.watching = -1  # Make open() try again
+
+    def _start_watcher(self, mailboxes):
+        if self.watcher is None:
+            try:
+                self.watcher = InotifyWatcher()
+            except (OSError, AttributeError):
+                # Not Linux, or an ancient libc: just poll.
+                self.watcher = False
+        if not self.watcher:
+            return
+        keys = set(mbx._key for mbx in mailboxes)
+        for key in self.watcher.key_wds.keys():
+            if key not in keys:
+                self.watcher.forget(key)
+        for mbx in mailboxes:
+            if not self.watcher.is_watching(mbx._key):
+                self._watch_mailbox(mbx)
+
+    def _watch_mailbox(self, mbx):
+        # Until we have checked the mailbox by hand with the watch in place,
+        # we cannot know whether it changed before the watch began.
+        self.unsettled.add(mbx._key)
+        self.watcher.forget(mbx._key)
+        paths = list(self._data_paths(mbx))
+        if not paths:
+            return
+        for p in paths:
+            if not self.watcher.watch(p, mbx._key):
+                # A partial watch is worse than none, as we would trust
+                # it; leave this one to the polling fallback instead.
+                self.watcher.forget(mbx._key)
+                return
+
+    def _trust_watcher(self, mbx):
+        """
+        Returns True if inotify is watching this mailbox and has not seen
+        anything happen to it, so there is no need to check by hand.
+        """
+        return (self.watcher and
+                self._loop_count % self.POLL_FALLBACK_LOOPS != 1 and
+                self.watcher.is_watching(mbx._key) and
+                mbx._key not in self.dirty and
+                mbx._key not in self.unsettled)
+
     def open(self):
         with self._lock:
+            if self.watcher:
+                # Catch up on anything which happened while we were not
+                # sleeping, e.g. during the last pass or a forced rescan.
+                try:
+                    self.dirty |= self.watcher.changed(timeout=0)
+                except (OSError, IOError):
+                    self._stop_watcher()
+
             mailboxes = self.my_config.mailbox.values()
             if self.watching == len(mailboxes):
                 return True
@@ -57,6 +139,8 @@ class LocalMailSource(BaseMailSource):
                 if d not in self.event.data:
                     self.event.data[d] = {}
 
+            self._start_watcher(mailboxes)
+
         self._log_status(_('Watching %d mbox mailboxes') % self.watching)
         return True
 
@@ -83,6 +167,10 @@ class LocalMailSource(BaseMailSource):
                 yield sub_path
 
     def _mailbox_sort_key(self, mbx):
+        # Mailboxes inotify says are unchanged go last, without a stat().
+        if self._trust_watcher(mbx):
+            return 'unchanged-%s' % BaseMailSource._mailbox_sort_key(self, mbx)
+
         # Sort mailboxes so the most recently modified get scanned first.
         mt = 0
         for p in self._data_paths(mbx):
@@ -96,6 +184,15 @@ class LocalMailSource(BaseMailSource):
             return BaseMailSource._mailbox_sort_key(self, mbx)
 
     def _has_mailbox_changed(self, mbx, state):
+        if self._trust_watcher(mbx):
+            return False
+        if self.watcher:
+            # Re-establish the watch before we look, so changes made while
+            # we are looking get noticed next time around. This also picks
+            # up Maildir subdirectories which did not exist before.
+            self.dirty.discard(mbx._key)
+            self._watch_mailbox(mbx)
+
         mtszs = []
         for p in self._data_paths(mbx):
             try:
@@ -115,11 +212,14 @@ class LocalMailSource(BaseMailSource):
             while mbx in self.recently_changed:
                 self.recently_changed.remove(mbx)
             self.recently_changed.append(mbx)
+            self.unsettled.add(mbx._key)
             return True
         else:
+            self.unsettled.discard(mbx._key)
             return False
 
     def _mark_mailbox_rescanned(self, mbx, state):
+        self.unsettled.discard(mbx._key)
         if 'mailbox_state' in self.event.data:
             self.event.data['mailbox_state'][mbx._key] = state['mtsz']
         else:
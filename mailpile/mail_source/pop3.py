@@ -18,7 +18,7 @@ GMAIL_TLDS = ('gmail.com', 'googlemail.com')
 
 def _open_pop3_mailbox(session, event, host, port,
                        username, password, auth_type,
-                       protocol, debug, throw=False):
+                       protocol, debug, throw=False, uidl_cache=None):
     cev = event.data['connection'] = {
         'live': False,
         'error': [False, _('Nothing is wrong')]
@@ -44,7 +44,8 @@ def _open_pop3_mailbox(session, event, host, port,
                                         auth_type=auth_type,
                                         use_ssl=('ssl' in protocol),
                                         session=session,
-                                        debug=debug)
+                                        debug=debug,
+                                        uidl_cache=uidl_cache)
     except AccessError:
         cev['error'] = ['auth', _('Invalid username or password'),
                         username, sha1b64(password)]
@@ -75,6 +76,28 @@ class Pop3MailSource(BaseMailSource):
     def __init__(self, *args, **kwargs):
         BaseMailSource.__init__(self, *args, **kwargs)
         self.watching = -1
+        self.uidl_cache = None
+        self._saved_uidl_stat = None
+
+    def _uidl_cache(self):
+        # The UIDL and LIST results for our maildrop, so we can skip
+        # listing it when nothing has changed; see POP3Mailbox.
+        with self._lock:
+            if self.uidl_cache is None:
+                try:
+                    self.uidl_cache = self.session.config.load_pickle(
+                        self._pfn())
+                except (IOError, EOFError):
+                    self.uidl_cache = {}
+                self._saved_uidl_stat = self.uidl_cache.get('stat')
+            return self.uidl_cache
+
+    def _save_uidl_cache(self):
+        with self._lock:
+            if (self.uidl_cache and
+                    self.uidl_cache.get('stat') != self._saved_uidl_stat):
+                self.session.config.save_pickle(self.uidl_cache, self._pfn())
+                self._saved_uidl_stat = self.uidl_cache.get('stat')
 
     def close(self):
         mbx = self.my_config.mailbox.values()[0]
@@ -121,6 +144,7 @@ class Pop3MailSource(BaseMailSource):
             self.event.data['mailbox_state'][mbx._key] = state['stat']
         else:
             self.event.data['mailbox_state'] = {mbx._key: state['stat']}
+        self._save_uidl_cache()
 
     def _fmt_path(self):
         return 'src:%s' % (self.my_config._key,)
@@ -135,7 +159,8 @@ class Pop3MailSource(BaseMailSource):
                                       my_cfg.username, password,
                                       my_cfg.auth_type,
                                       my_cfg.protocol, debug,
-                                      throw=POP3_IOError)
+                                      throw=POP3_IOError,
+                                      uidl_cache=self._uidl_cache())
         return None
 
     def discover_mailboxes(self, paths=None):
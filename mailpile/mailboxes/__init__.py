@@ -107,6 +107,7 @@ def UnorderedPicklable(parent, editable=False):
             with self._lock:
                 self._index = None
                 self._save_to = None
+                self._last_updated = None
                 self._encryption_key_func = lambda: None
                 self._decryption_key_func = lambda: None
                 if not hasattr(self, 'source_map'):
@@ -114,7 +115,8 @@ def UnorderedPicklable(parent, editable=False):
                 if (len(self.source_map) > 0 and
                         not hasattr(self, 'is_local') or not self.is_local):
                     self.is_local = True
-                self.update_toc()
+                # The TOC gets refreshed when the mailbox is opened, not
+                # here; unpickling should stay cheap.
 
         def __getstate__(self):
             odict = self.__dict__.copy()
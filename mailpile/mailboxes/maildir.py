@@ -1,14 +1,19 @@
 import mailbox
 import os
 import sys
+import time
+import zlib
 
 import mailpile.mailboxes
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
-from mailpile.mailboxes import UnorderedPicklable
+from mailpile.mailboxes import UnorderedPicklable, MBX_ID_LEN
 
 
-class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
+_MaildirBase = UnorderedPicklable(mailbox.Maildir, editable=True)
+
+
+class MailpileMailbox(_MaildirBase):
     """A Maildir class that supports pickling and a few mailpile specifics."""
     supported_platform = None
 
@@ -22,12 +27,86 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
             return (fn, )
         raise ValueError('Not a Maildir: %s' % fn)
 
+    def _ignore_toc_key(self, key):
+        # Dotfiles are not mail. Ignore them.
+        return key.startswith('.')
+
     def _refresh(self):
+        """
+        Update the table of contents, but only relist the subdirectories
+        whose mtimes have changed since we last looked. Files we already
+        know about are not stat()-ed again.
+        """
         with self._lock:
-            mailbox.Maildir._refresh(self)
-            # Dotfiles are not mail. Ignore them.
-            for t in [k for k in self._toc.keys() if k.startswith('.')]:
-                del self._toc[t]
+            now = time.time()
+            window = 2 + self._skewfactor
+            listed = getattr(self, '_toc_listed', None) or {}
+            for subdir in self._toc_mtimes:
+                path = self._paths[subdir]
+                mtime = os.path.getmtime(path)
+                # Changes made within the mtime resolution of our last
+                # listing may not have bumped the mtime, so relist those.
+                if (mtime == self._toc_mtimes[subdir] and
+                        listed.get(subdir, 0) - mtime > window):
+                    continue
+
+                prefix = os.path.join(subdir, '')
+                known = dict((fn[len(prefix):], key)
+                             for key, fn in self._toc.iteritems()
+                             if fn.startswith(prefix))
+                for entry in os.listdir(path):
+                    if known.pop(entry, None) is not None:
+                        continue
+                    uniq = entry.split(self.colon)[0]
+                    if (self._ignore_toc_key(uniq) or
+                            os.path.isdir(os.path.join(path, entry))):
+                        continue
+                    self._toc[uniq] = os.path.join(subdir, entry)
+                for entry, key in known.iteritems():
+                    if self._toc.get(key) == prefix + entry:
+                        del self._toc[key]
+
+                self._toc_mtimes[subdir] = mtime
+                listed[subdir] = now
+            self._toc_listed = listed
+            self._last_read = now
+
+    def _pack_toc(self, toc):
+        # Almost every TOC entry is keyed by the start of its own filename,
+        # so we only store the paths, NUL-separated and compressed.
+        paths, other = [], {}
+        for key, fn in toc.iteritems():
+            if os.path.basename(fn).split(self.colon)[0] == key:
+                paths.append(fn)
+            else:
+                other[key] = fn
+        paths.sort()
+        return (zlib.compress('\0'.join(paths)), other)
+
+    def _unpack_toc(self, packed):
+        data, toc = packed
+        toc = dict(toc)
+        for fn in zlib.decompress(data).split('\0'):
+            if fn:
+                toc[os.path.basename(fn).split(self.colon)[0]] = fn
+        return toc
+
+    def __getattr__(self, attr):
+        # A freshly unpickled TOC stays packed until somebody needs it,
+        # which _refresh() only does if a subdirectory has changed.
+        if attr == '_toc' and '_toc_packed' in self.__dict__:
+            with self._lock:
+                if '_toc_packed' in self.__dict__:
+                    self._toc = self._unpack_toc(
+                        self.__dict__.pop('_toc_packed'))
+            return self._toc
+        raise AttributeError(attr)
+
+    def __getstate__(self):
+        odict = _MaildirBase.__getstate__(self)
+        if '_toc' in odict:
+            odict['_toc_packed'] = self._pack_toc(odict.pop('_toc'))
+        return odict
 
     def __unicode__(self):
         return _("Maildir at %s") % self._path
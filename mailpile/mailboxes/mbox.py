@@ -23,6 +23,9 @@ class MailpileMailbox(mailbox.mbox):
     RE_STATUS = re.compile(
         '^(X-)?Status:\s*\S+', flags=re.IGNORECASE|re.MULTILINE)
 
+    # How many messages to spot-check before trusting the existing TOC.
+    TOC_VERIFY_SAMPLES = 8
+
     @classmethod
     def parse_path(cls, config, fn, create=False, allow_empty=False):
         try:
@@ -126,10 +129,20 @@ class MailpileMailbox(mailbox.mbox):
             pass
 
         with self._lock:
-            fd.seek(0)
-            self._next_key = 0
-            self._toc = {}
-            self._cs = {}
+            resume = self._toc_resume_offset(fd, cur_length)
+            if resume is None:
+                fd.seek(0)
+                self._next_key = 0
+                self._toc = {}
+                self._cs = {}
+            else:
+                # Forget the last message, we will parse it again.
+                self._next_key -= 1
+                del self._toc[self._next_key]
+                last_cs = self._cs.pop(self._next_key, None)
+                if self._cs.get(last_cs) == self._next_key:
+                    del self._cs[last_cs]
+                fd.seek(resume)
             data = ''
             start = None
             len_nl = 1
@@ -162,6 +175,42 @@ class MailpileMailbox(mailbox.mbox):
             self._mtime = cur_mtime
         self.save(None)
 
+    def _toc_resume_offset(self, fd, cur_length):
+        """
+        If mail has only been appended since the TOC was built, return the
+        offset from which to parse the new data: the start of the last
+        message, which may have been incomplete.
+
+        The TOC is trusted if the checksums of a sample of messages still
+        match; otherwise this returns None and we start over.
+        """
+        try:
+            if not self._toc or cur_length < self._file_length:
+                return None
+            toc = sorted((s, e, k) for k, (s, e) in self._toc.iteritems())
+            last_start, last_end, last_key = toc[-1]
+            if last_key != self._next_key - 1:
+                return None
+
+            complete = len(toc) - 1
+            step = max(1, complete // self.TOC_VERIFY_SAMPLES)
+            samples = set(range(0, complete, step))
+            samples |= set(i for i in (complete - 2, complete - 1) if i >= 0)
+            for i in sorted(samples):
+                start, end, key = toc[i]
+                fd.seek(start)
+                data = fd.read(min(4096, end - start))
+                if (not data.startswith('From ') or
+                        self._cs.get(key) != self.get_msg_cs4k(0, 0, data)):
+                    return None
+
+            fd.seek(last_start)
+            if not fd.readline().startswith('From '):
+                return None
+        except (IOError, OSError, TypeError, ValueError):
+            return None
+        return last_start
+
     def _generate_toc(self):
         self.update_toc()
 
@@ -440,6 +489,31 @@ Content-Length: %(length)s
              tests += 1
              ptrs.append([msg_ptr, f2size])
 
+        # Append a message, bypassing MailpileMailbox. The TOC should be
+        # updated incrementally and existing pointers must not change.
+        tests += 1
+        tf.write(MSG_TEMPLATE % {
+            'subject': 'Appended message',
+            'msgid': 'appended@example.com',
+            'length': 6,
+            'content': 'Hello!'})
+        tf.write("\n")
+        tf.flush()
+        resume = mmbx._toc_resume_offset(mmbx._get_fd(),
+                                         os.path.getsize(tf.name))
+        keys = mmbx.keys()
+        fresh = MailpileMailbox(tf.name)
+        fresh.update_toc()
+        if ((resume != mmbx._toc[keys[len(ptrs) - 1]][0]) or
+                (fresh._toc, fresh._cs) != (mmbx._toc, mmbx._cs) or
+                (len(keys) != len(ptrs) + 1) or
+                ([mmbx.get_msg_ptr('0000', k) for k in keys[:len(ptrs)]] !=
+                 [msg_ptr for msg_ptr, f2size in ptrs])):
+            problems += 1
+            print('BAD Incremental TOC update failed')
+        elif verbose:
+            print('ok  Incremental TOC update, resumed at %d' % resume)
+
         # Remove some messages, bypassing MailpileMailbox
         deletions = [0, 5, 10, 15, 34]
         for d in reversed(sorted(deletions)):
@@ -44,11 +44,17 @@ class UnsupportedProtocolError(Exception):
 class POP3Mailbox(Mailbox):
     """
     Basic implementation of POP3 Mailbox.
+
+    If a uidl_cache dictionary is given, the results of UIDL and LIST are
+    kept there. Callers may persist it, so we can skip listing a maildrop
+    which has not changed since we last saw it.
     """
+    PIPELINE_WINDOW = 50  # Max commands we send before reading responses
+
     def __init__(self, host,
                  user=None, password=None, auth_type='password',
                  use_ssl=True, port=None, debug=False, conn_cls=None,
-                 session=None):
+                 session=None, uidl_cache=None):
         """Initialize a Mailbox instance."""
         Mailbox.__init__(self, '/')
         self.host = host
@@ -60,9 +66,11 @@ class POP3Mailbox(Mailbox):
         self.debug = debug
         self.conn_cls = conn_cls
         self.session = session
+        self.uidl_cache = uidl_cache
 
         self._lock = MboxRLock()
         self._pop3 = None
+        self._capabilities = None
         self._connect()
 
     def lock(self):
@@ -100,6 +108,7 @@ class POP3Mailbox(Mailbox):
                 self._pop3.set_debuglevel(self.debug)
 
             self._keys = None
+            self._capabilities = None
             try:
                 if self.auth_type.lower() == 'oauth2':
                     from mailpile.plugins.oauth import OAuth2
@@ -120,24 +129,138 @@ class POP3Mailbox(Mailbox):
             self._keys = None
             self.iterkeys()
 
+    def _pipelining(self):
+        # Python 2's poplib has no CAPA (RFC 2449) support, so we do it
+        # ourselves.
+        if self._capabilities is None:
+            try:
+                resp, lines, octets = self._pop3._longcmd('CAPA')
+                self._capabilities = set(l.split()[0].upper()
+                                         for l in lines if l.strip())
+            except poplib.error_proto:
+                self._capabilities = set()
+        return 'PIPELINING' in self._capabilities
+
+    def _pipelined(self, commands):
+        """
+        Send a list of multi-line commands and return a list of their
+        responses, or None for those which failed. If the server supports
+        it, the commands are sent in batches without waiting for replies.
+        """
+        results = []
+        if not self._pipelining():
+            for cmd in commands:
+                try:
+                    results.append(self._pop3._longcmd(cmd))
+                except poplib.error_proto:
+                    results.append(None)
+            return results
+
+        for i in range(0, len(commands), self.PIPELINE_WINDOW):
+            window = commands[i:i + self.PIPELINE_WINDOW]
+            for cmd in window:
+                self._pop3._putcmd(cmd)
+            # Note: Always read every response, or we lose sync.
+            for cmd in window:
+                try:
+                    results.append(self._pop3._getlongresp())
+                except poplib.error_proto:
+                    results.append(None)
+        return results
+
+    def _load_keys(self):
+        stat = list(self._pop3.stat())
+        cache = self.uidl_cache
+        if (cache is not None and cache.get('stat') == stat and
+                self._cache_looks_valid(cache)):
+            keys, sizes = cache['keys'], cache['sizes']
+        else:
+            # Note: POP3 *without UIDL* is useless.  We don't support it.
+            uidl, listing = self._pipelined(['UIDL', 'LIST'])
+            if uidl is None:
+                raise UnsupportedProtocolError()
+            keys = [tuple(k.split(' ', 1)) for k in uidl[1]]
+            km = dict(keys)
+            sizes = {}
+            for line in (listing[1] if listing else []):
+                num, octets = line.split()[:2]
+                if num in km:
+                    sizes[km[num]] = int(octets)
+            if cache is not None:
+                cache.clear()
+                cache.update({'stat': stat, 'keys': keys, 'sizes': sizes})
+        self._keys = keys
+        self._km = dict([reversed(k) for k in keys])
+        self._sizes = sizes
+
+    def _cache_looks_valid(self, cache):
+        # An unchanged STAT is not proof the maildrop is unchanged, so we
+        # also check the last message is still the one we remember.
+        if not cache['keys']:
+            return True
+        num, uid = cache['keys'][-1]
+        try:
+            return (self._pop3.uidl(num).split()[1:] == [num, uid])
+        except poplib.error_proto:
+            return False
+
+    def _ensure_keys(self):
+        if self._keys is None:
+            self._connect()
+            self._load_keys()
+
+    def _msg_num(self, key):
+        self._ensure_keys()
+        if key not in self._km:
+            raise KeyError('Invalid key: %s' % key)
+        return self._km[key]
+
     def __setitem__(self, key, message):
         """Replace the keyed message; raise KeyError if it doesn't exist."""
         raise NotImplementedError('Method must be implemented by subclass')
 
     def _get(self, key, _bytes=None):
         with self._lock:
-            if key not in self.iterkeys():
-                raise KeyError('Invalid key: %s' % key)
+            msg_num = self._msg_num(key)
 
             self._connect()
             if _bytes is not None:
                 lines = max(10, _bytes//30)  # A wild guess!
-                ok, lines, octets = self._pop3.top(self._km[key], lines)
+                ok, lines, octets = self._pop3.top(msg_num, lines)
             else:
-                ok, lines, octets = self._pop3.retr(self._km[key])
+                ok, lines, octets = self._pop3.retr(msg_num)
             if not ok.startswith('+OK'):
                 raise KeyError('Invalid key: %s' % key)
 
+        data = self._join_lines(key, lines, octets)
+        if _bytes is not None:
+            return data[:_bytes]
+        else:
+            return data
+
+    def get_many(self, keys):
+        """
+        Yield (key, metadata keywords, message data) for a batch of
+        messages, in order. If the server supports PIPELINING, the RETR
+        commands are sent in batches. Messages which no longer exist are
+        yielded with None as their data.
+        """
+        with self._lock:
+            self._connect()
+            self._ensure_keys()
+            known = [k for k in keys if k in self._km]
+            responses = dict(zip(known, self._pipelined(
+                ['RETR %s' % self._km[k] for k in known])))
+
+        for key in keys:
+            response = responses.get(key)
+            if response is None or not response[0].startswith('+OK'):
+                yield key, None, None
+            else:
+                ok, lines, octets = response
+                yield key, [], self._join_lines(key, lines, octets)
+
+    def _join_lines(self, key, lines, octets):
         # poplib is stupid in that it loses the linefeeds, so we need to
         # do some guesswork to bring them back to what the server provided.
         # If we don't do this jiggering, then sizes don't match up, which
@@ -157,10 +280,7 @@ class POP3Mailbox(Mailbox):
         else:
             raise ValueError('Length mismatch in message %s' % key)
 
-        if _bytes is not None:
-            return data[:_bytes]
-        else:
-            return data
+        return data
 
     def get_message(self, key):
         """Return a Message representation or raise a KeyError."""
@@ -176,10 +296,11 @@ class POP3Mailbox(Mailbox):
 
     def get_msg_size(self, key):
         with self._lock:
+            msg_num = self._msg_num(key)
+            if key in self._sizes:
+                return self._sizes[key]
             self._connect()
-            if key not in self.iterkeys():
-                raise KeyError('Invalid key: %s' % key)
-            ok, info, octets = self._pop3.list(self._km[key]).split()
+            ok, info, octets = self._pop3.list(msg_num).split()
             return int(octets)
 
     def remove(self, key):
@@ -187,9 +308,7 @@ class POP3Mailbox(Mailbox):
         #        messages at once.
         with self._lock:
             self._connect()
-            if key not in self.iterkeys():
-                raise KeyError('Invalid key: %s' % key)
-            ok = self._pop3.dele(self._km[key])
+            ok = self._pop3.dele(self._msg_num(key))
             self._refresh()
 
     def stat(self):
@@ -199,21 +318,15 @@ class POP3Mailbox(Mailbox):
 
     def iterkeys(self):
         """Return an iterator over keys."""
-        # Note: POP3 *without UIDL* is useless.  We don't support it.
         with self._lock:
-            if self._keys is None:
-                self._connect()
-                try:
-                    stat, key_list, octets = self._pop3.uidl()
-                except poplib.error_proto:
-                    raise UnsupportedProtocolError()
-                self._keys = [tuple(k.split(' ', 1)) for k in key_list]
-                self._km = dict([reversed(k) for k in self._keys])
+            self._ensure_keys()
             return [k[1] for k in self._keys]
 
     def __contains__(self, key):
         """Return True if the keyed message exists, False otherwise."""
-        return key in self.iterkeys()
+        with self._lock:
+            self._ensure_keys()
+            return key in self._km
 
     def __len__(self):
         """Return a count of messages in the mailbox."""
@@ -234,7 +347,7 @@ class POP3Mailbox(Mailbox):
 
 
 class MailpileMailbox(UnorderedPicklable(POP3Mailbox)):
-    UNPICKLABLE = ['_pop3', '_debug']
+    UNPICKLABLE = ['_pop3', '_debug', 'uidl_cache']
 
     @classmethod
     def parse_path(cls, config, path, create=False, allow_empty=False):
@@ -326,7 +439,9 @@ if __name__ == "__main__":
             'list_': lambda s: ('+OK 2 messages:',
                                 ['1 %d' % len(s.TEST_MSG.replace('\r', '')),
                                  '2 %d' % len(s.TEST_MSG)], 0),
-            'uidl': ('+OK', ['1 evil', '2 good'], 0),
+            'uidl': lambda s, *w: (('+OK %s %s' % (w[0], s.UIDS[w[0]]))
+                                   if w else
+                                   ('+OK', ['1 evil', '2 good'], 0)),
             'retr': lambda s, m: ('+OK',
                                   s.TEST_MSG.replace('N', m).splitlines(),
                                   len(s.TEST_MSG)
@@ -337,8 +452,11 @@ if __name__ == "__main__":
                                     len(''.join(s.TEST_MSG.splitlines(1)[:n]))),
         }
         RESULTS = {}
+        UIDS = {'1': 'evil', '2': 'good'}
+        CAPABILITIES = ['USER', 'UIDL', 'TOP']
 
         def __init__(self, *args, **kwargs):
+            self.sent = []
             def mkcmd(rval):
                 def r(rv):
                     if isinstance(rv, (str, unicode)) and rv[0] != '+':
@@ -362,6 +480,12 @@ if __name__ == "__main__":
                 return '+OK ' + msgs[1][1-int(which)]
             return msgs
 
+        def _longcmd(self, line):
+            cmd, args = line.split()[0].lower(), line.split()[1:]
+            if cmd == 'capa':
+                return ('+OK', self.CAPABILITIES, 0)
+            return getattr(self, cmd)(*args)
+
         def __getattr__(self, attr):
             return self.__getattribute__(attr)
 
@@ -378,6 +502,43 @@ if __name__ == "__main__":
         """
         RESULTS = {'uidl': '-ERR'}
 
+    class _MockPOP3_Pipelining(_MockPOP3):
+        """
+        Mock that supports PIPELINING.
+
+        >>> pm = POP3Mailbox('localhost', user='a', password='b',
+        ...                  conn_cls=_MockPOP3_Pipelining)
+        >>> [(k, d and len(d)) for k, kws, d in
+        ...  pm.get_many(['good', 'bogon', 'evil'])]
+        [('good', 51), ('bogon', None), ('evil', 47)]
+        """
+        CAPABILITIES = ['USER', 'UIDL', 'PIPELINING']
+
+        def _putcmd(self, line):
+            self.sent.append(line)
+
+        def _getlongresp(self):
+            return self._longcmd(self.sent.pop(0))
+
+    class _MockPOP3_No_Listing(_MockPOP3):
+        """
+        Mock that refuses to list the maildrop, so we can check that we
+        rely on the UIDL cache when the maildrop has not changed.
+
+        >>> cache = {}
+        >>> pm = POP3Mailbox('localhost', user='a', password='b',
+        ...                  conn_cls=_MockPOP3, uidl_cache=cache)
+        >>> pm.iterkeys(), sorted(cache['sizes'].items())
+        (['evil', 'good'], [('evil', 47), ('good', 51)])
+
+        >>> pm = POP3Mailbox('localhost', user='a', password='b',
+        ...                  conn_cls=_MockPOP3_No_Listing, uidl_cache=cache)
+        >>> pm.iterkeys(), pm.get_msg_size('good')
+        (['evil', 'good'], 51)
+        """
+        RESULTS = {'uidl': lambda s, *w: ('+OK 2 good' if w else '-ERR'),
+                   'list_': '-ERR'}
+
     results = doctest.testmod(optionflags=doctest.ELLIPSIS,
                               extraglobs={})
     print('%s' % (results, ))
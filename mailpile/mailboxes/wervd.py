@@ -5,14 +5,15 @@ import StringIO
 import sys
 
 import mailpile.mailboxes
+import mailpile.mailboxes.maildir as maildir
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
-from mailpile.mailboxes import UnorderedPicklable, MBX_ID_LEN
+from mailpile.mailboxes import MBX_ID_LEN
 from mailpile.crypto.streamer import *
 from mailpile.util import safe_remove
 
 
-class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
+class MailpileMailbox(maildir.MailpileMailbox):
     """A Maildir class that supports pickling and a few mailpile specifics."""
     supported_platform = None
     colon = '!'  # Works on both Windows and Unix
@@ -67,12 +68,12 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
 #               else:
 #                   break
 
+    def _ignore_toc_key(self, key):
+        # WERVD mail names don't have dots in them
+        return '.' in key
+
     def _refresh(self):
-        with self._lock:
-            mailbox.Maildir._refresh(self)
-            # WERVD mail names don't have dots in them
-            for t in [k for k in self._toc.keys() if '.' in k]:
-                del self._toc[t]
+        maildir.MailpileMailbox._refresh(self)
         safe_remove()  # Try to remove any postponed removals
 
     def _get_fd(self, key):
@@ -29,7 +29,8 @@ from platform import system
 from urllib import quote, unquote
 from datetime import datetime, timedelta
 
-from mailpile.crypto.gpgi import GnuPG
+from mailpile.crypto.gpgi import GnuPG, GnuPGSignatureCollector
+from mailpile.crypto.gpgi import GNUPG_VERIFIED
 from mailpile.crypto.mime import UnwrapMimeCrypto, MessageAsString
 from mailpile.crypto.state import EncryptionInfo, SignatureInfo
 from mailpile.eventlog import GetThreadEvent
@@ -148,6 +149,48 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
     return message
 
 
+
+def VerifyMessageSignatures(msg_datas, config=None, event=None):
+    """
+    Check the PGP signatures in a batch of raw messages all at once, so
+    parsing them afterwards with ParseMessage() finds the results waiting,
+    instead of running GnuPG once per signature. Returns a list of the
+    (key, result) pairs for each message, so other processes can be given
+    the results as well (see GNUPG_VERIFIED).
+    """
+    results = [[] for msg_data in msg_datas]
+    if not GnuPG:
+        return results
+
+    ev = event or GetThreadEvent()
+    items, owners = [], []
+    for i, msg_data in enumerate(msg_datas):
+        if not msg_data or GnuPG.ARMOR_BEGIN_SIGNATURE not in msg_data:
+            continue
+        collected = []
+        try:
+            message = ParseMessage(StringIO.StringIO(msg_data),
+                                   pgpmime=False, config=config)
+            if message is not None:
+                UnwrapMimeCrypto(message,
+                    protocols={'openpgp': lambda: GnuPGSignatureCollector(
+                        collected, config, event=ev)},
+                    unwrap_attachments=False)
+        except (IOError, OSError, ValueError, IndexError, KeyError):
+            continue
+        items.extend(collected)
+        owners.extend(i for c in collected)
+
+    if items:
+        gnupg = GnuPG(config, event=ev)
+        for i, item, si in zip(owners, items, gnupg.verify_batch(items)):
+            if si is not None:
+                key = GNUPG_VERIFIED.key(gnupg, *item)
+                GNUPG_VERIFIED.put(key, si)
+                results[i].append((key, si))
+    return results
+
+
 def GetTextPayload(part):
     mimetype = part.get_content_type() or 'text/plain'
     cte = part.get('content-transfer-encoding', '').lower()
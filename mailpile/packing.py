@@ -1,7 +1,9 @@
 from __future__ import print_function
+import bisect
 import struct
 import time
 import zlib
+from array import array
 
 from mailpile.util import *
 
@@ -48,6 +50,166 @@ def UnpackIntSet(data):
         return set(struct.unpack('<' + 'I' * (len(data)//4), data))
 
 
+def PackIntList(ints):
+    """
+    Pack a sorted list of unique non-negative ints to a compact string,
+    unpackable by UnpackIntList.
+
+    The gaps between consecutive values are stored as variable-length
+    integers (7 bits per byte), so dense lists of message IDs cost
+    roughly one byte per entry.
+
+    >>> intlist = [0, 1, 5, 9, 10000]
+    >>> intliststr = PackIntList(intlist)
+    >>> type(intliststr), len(intliststr)
+    (<type 'str'>, 6)
+
+    >>> list(UnpackIntList(intliststr)) == intlist
+    True
+
+    >>> len(PackIntList(range(1000, 50000)))
+    49001
+    """
+    out = bytearray()
+    last = -1
+    for i in ints:
+        d = i - last - 1
+        last = i
+        while d > 0x7f:
+            out.append((d & 0x7f) | 0x80)
+            d >>= 7
+        out.append(d)
+    return str(out)
+
+
+def UnpackIntList(data):
+    """
+    Unpack a list of ints previously packed using PackIntList. The result
+    is a sorted array('i'), which uses 4 bytes of RAM per entry.
+    """
+    out = array('i')
+    append = out.append
+    val = shift = 0
+    last = -1
+    for b in bytearray(data):
+        if b & 0x80:
+            val |= (b & 0x7f) << shift
+            shift += 7
+        else:
+            last += (val | (b << shift)) + 1
+            append(last)
+            val = shift = 0
+    return out
+
+
+def SortedIntList(ints):
+    """
+    Convert an iterable of ints (or base36 strings) to a sorted array of
+    unique ints, suitable for the *IntLists functions below.
+
+    >>> list(SortedIntList(['a', '1', 10, 3]))
+    [1, 3, 10]
+    """
+    if isinstance(ints, array):
+        return ints
+    return array('i', sorted(set((int(i, 36) if isinstance(i, basestring)
+                                  else i) for i in ints)))
+
+
+def IntersectIntLists(a, b):
+    """
+    Intersect two sorted lists of ints, without building sets. If one of
+    the lists is much shorter than the other, we binary search for its
+    members instead of walking both lists.
+
+    >>> list(IntersectIntLists([1, 2, 3, 8], [2, 3, 4, 8, 9]))
+    [2, 3, 8]
+    >>> list(IntersectIntLists([5], range(0, 1000)))
+    [5]
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    out = array('i')
+    if not a:
+        return out
+
+    lb = len(b)
+    if len(a) * 8 < lb:
+        lo = 0
+        for v in a:
+            lo = bisect.bisect_left(b, v, lo)
+            if lo >= lb:
+                break
+            if b[lo] == v:
+                out.append(v)
+        return out
+
+    ia = ib = 0
+    la = len(a)
+    while ia < la and ib < lb:
+        va, vb = a[ia], b[ib]
+        if va == vb:
+            out.append(va)
+            ia += 1
+            ib += 1
+        elif va < vb:
+            ia += 1
+        else:
+            ib += 1
+    return out
+
+
+def MergeIntLists(a, b):
+    """
+    Merge two sorted lists of ints, returning a sorted array of unique ints.
+
+    >>> list(MergeIntLists([1, 3, 5], [2, 3, 6]))
+    [1, 2, 3, 5, 6]
+    """
+    if not a:
+        return array('i', b)
+    if not b:
+        return array('i', a)
+    out = array('i')
+    ia = ib = 0
+    la, lb = len(a), len(b)
+    while ia < la and ib < lb:
+        va, vb = a[ia], b[ib]
+        if va == vb:
+            out.append(va)
+            ia += 1
+            ib += 1
+        elif va < vb:
+            out.append(va)
+            ia += 1
+        else:
+            out.append(vb)
+            ib += 1
+    out.extend(a[ia:])
+    out.extend(b[ib:])
+    return out
+
+
+def SubtractIntLists(a, b):
+    """
+    Remove all members of the sorted list b from the sorted list a.
+
+    >>> list(SubtractIntLists([1, 2, 3, 5, 8], [2, 5, 6]))
+    [1, 3, 8]
+    """
+    out = array('i')
+    if not b:
+        out.extend(a)
+        return out
+    ib, lb = 0, len(b)
+    for va in a:
+        while ib < lb and b[ib] < va:
+            ib += 1
+        if ib >= lb or b[ib] != va:
+            out.append(va)
+    return out
+
+
 def PackLongList(longs):
     """
     Pack a list of longs to a compact string, unpackable by UnpackLongList.
@@ -149,6 +149,13 @@ def WindowsPopenSemantics():
     return sys.platform.startswith('win')
 
 
+def SupportsInotify():
+    """
+    Returns True if we can watch the filesystem for changes using inotify.
+    """
+    return sys.platform.startswith('linux')
+
+
 def GetAppDataDirectory():
     if sys.platform.startswith('win'):
         # Obey Windows conventions (more or less?)
@@ -13,7 +13,7 @@ import zipfile
 from mailpile.auth import VerifyAndStorePassphrase
 from mailpile.config.defaults import APPVER
 from mailpile.commands import Command
-from mailpile.crypto.streamer import EncryptingStreamer, DecryptingStreamer
+from mailpile.crypto.streamer import EncryptingStreamer, decrypt_buffer
 from mailpile.plugins import PluginManager
 from mailpile.plugins.core import Quit
 from mailpile.i18n import ActivateTranslation
@@ -42,11 +42,7 @@ def _gunzip(data):
 
 
 def _decrypt(data, config):
-    with DecryptingStreamer(cStringIO.StringIO(data),
-                            mep_key=config.get_master_key()) as fd:
-        data = fd.read()
-        fd.verify(_raise=IOError)
-    return data
+    return decrypt_buffer(data, mep_key=config.get_master_key())
 
 
 class MakeBackup(Command):
@@ -756,12 +756,16 @@ class AddressSearch(VCardCommand):
         if len(matches) < (count * 5):
             for msg_idx in xrange(max(0, len(index.INDEX)-5000),
                                   len(index.INDEX)):
-                msg_info = index.get_msg_at_idx_pos(msg_idx)
-                tags = set(msg_info[index.MSG_TAGS].split(','))
+                try:
+                    tags = set(index.INDEX.get_tags(msg_idx).split(','))
+                except ValueError:
+                    continue
                 match = not (tags & invisible)
                 if match:
-                    frm = msg_info[index.MSG_FROM]
-                    search = (frm + ' ' + msg_info[index.MSG_SUBJECT]).lower()
+                    frm = index.INDEX.get_from(msg_idx)
+                    subject = index.get_msg_field_at_idx_pos(
+                        msg_idx, index.MSG_SUBJECT)
+                    search = (frm + ' ' + subject).lower()
                     for term in terms:
                         if term not in search:
                             match = False
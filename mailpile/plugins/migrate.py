@@ -1,4 +1,6 @@
+import mailpile.crypto.streamer as streamer
 import mailpile.security as security
+import mailpile.util
 from mailpile.commands import Command
 from mailpile.config.defaults import APPVER
 from mailpile.i18n import gettext as _
@@ -189,12 +191,88 @@ def migrate_cleanup(session):
     return True
 
 
+def migrate_encryption(session, min_age=3600):
+    """
+    Rewrite any encrypted data at rest which uses an obsolete format (such
+    as AES-256-CBC, as written by older versions using OpenSSL), so it can
+    be read using our preferred cipher.
+
+    We only consider files which begin with encrypted data, and skip any
+    which have changed recently or change while we work, as they may be
+    in use by someone else.
+    """
+    config = session.config
+    mep_key = config.get_master_key()
+    if not mep_key:
+        return True
+
+    tempdir = config.tempfile_dir()
+    migrated = failed = 0
+    for dirpath, dirnames, filenames in os.walk(config.workdir):
+        dirnames[:] = [d for d in dirnames
+                       if os.path.join(dirpath, d) != tempdir]
+        for fn in filenames:
+            if mailpile.util.QUITTING:
+                return False
+            play_nice_with_threads(weak=True)
+
+            path = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(path)
+                if st.st_mtime > time.time() - min_age:
+                    continue
+                with open(path, 'rb') as fd:
+                    line = fd.readline()
+                    if not (streamer.DecryptingStreamer.StartEncrypted(line)
+                            and not line.startswith(
+                                streamer.DecryptingStreamer.BEGIN_PGP)):
+                        continue
+                    fd.seek(0)
+                    if not streamer.obsolete_formats(fd):
+                        continue
+                    fd.seek(0)
+                    data = streamer.reencrypt_obsolete(fd, mep_key,
+                                                       dir=tempdir,
+                                                       name='Migrate')
+
+                # The dot keeps mailboxes from mistaking this for mail
+                with tempfile.NamedTemporaryFile(dir=dirpath,
+                                                 prefix='.migrate-',
+                                                 delete=False) as tmp:
+                    tmp.write(data)
+                st2 = os.stat(path)
+                if (st.st_size, st.st_mtime) == (st2.st_size, st2.st_mtime):
+                    os.rename(tmp.name, path)
+                    migrated += 1
+                else:
+                    safe_remove(tmp.name)
+            except (IOError, OSError) as e:
+                session.ui.warning(_('Failed to migrate %s: %s') % (path, e))
+                failed += 1
+
+    if migrated:
+        session.ui.notify(_n('Migrated %d file to the new encryption format',
+                             'Migrated %d files to the new encryption format',
+                             migrated) % migrated)
+    return (failed == 0)
+
+
+def migrate_encryption_in_background(session):
+    # Decrypting data in an obsolete format is what tells us there is
+    # work to do; files we never read will not slow anything down.
+    detected = set(streamer.DETECTED_OBSOLETE_FORMATS)
+    if detected and migrate_encryption(session):
+        streamer.DETECTED_OBSOLETE_FORMATS -= detected
+    return True
+
+
 MIGRATIONS_BEFORE_SETUP = [migrate_routes]
 MIGRATIONS_AFTER_SETUP = [migrate_cleanup]
 MIGRATIONS = {
     'routes': migrate_routes,
     'sources': migrate_mailboxes,
-    'cleanup': migrate_cleanup
+    'cleanup': migrate_cleanup,
+    'encryption': migrate_encryption
 }
 
 
@@ -239,3 +317,6 @@ class Migrate(Command):
 
 
 _plugins.register_commands(Migrate)
+
+_plugins.register_slow_periodic_job('migrate_encryption', 6 * 3600,
+                                    migrate_encryption_in_background)
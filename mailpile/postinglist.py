@@ -1,15 +1,21 @@
 from __future__ import print_function
 import os
+import struct
 import sys
 import random
+import re
+import shutil
 import threading
 import traceback
 import time
 
 import mailpile.util
+from mailpile.crypto.records import EncryptedDict
 from mailpile.crypto.streamer import EncryptingStreamer
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.packing import PackIntList, UnpackIntList, SortedIntList
+from mailpile.packing import MergeIntLists, SubtractIntLists
 from mailpile.util import *
 
 
@@ -19,9 +25,20 @@ GLOBAL_OPTIMIZE_LOCK = PListLock()
 GLOBAL_GPL_LOCK = PListRLock()
 GLOBAL_GPL = None
 
+# Keyword journal lines waiting to be written to disk, and the time the
+# oldest of them was added. Protected by GLOBAL_GPL_LOCK.
+GPL_JOURNAL_BUFFER = []
+GPL_JOURNAL_BUFFER_TS = 0
+
 PLC_CACHE_LOCK = PListLock()
 PLC_CACHE = {}
 
+# The posting list engine in use, and the EncryptedDict used by the
+# DictPostingList engine (if enabled).
+GLOBAL_PL_ENGINE = None
+GLOBAL_PL_DICT_LOCK = PListRLock()
+GLOBAL_PL_DICT = None
+
 TIMERS = {
     'render': 0,
     'save': 0,
@@ -36,6 +53,13 @@ TIMERS = {
 GPL_MSGID_TRACKER = '_MAX_MSGID_'
 GPL_NEVER_MIGRATE = (GPL_MSGID_TRACKER, )
 
+B36_HIT_RE = re.compile('^[a-zA-Z0-9]{1,8}$')
+
+
+def _valid_b36(hits):
+    # Corrupt data should not prevent us from loading the rest.
+    return [h for h in hits if B36_HIT_RE.match(h)]
+
 
 def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
     def save(plc):
@@ -76,10 +100,22 @@ def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
 
 
 class PostingListContainer(object):
-    """A container for posting lists mapping search terms to message IDs."""
+    """
+    A container for posting lists mapping search terms to message IDs.
+
+    In RAM, each term maps to a sorted array of msg_idx integers. On disk,
+    containers use a binary format: a magic header followed by records of
+    the form <sig length><sig><data length><data>, where data is a
+    delta-encoded list as produced by PackIntList.
+
+    Containers in the older tab-separated text format are still read; they
+    are marked as changed on load so the next flush rewrites them in the
+    binary format.
+    """
 
     MAX_ITEMS = int((60 * 1024) / 5)  # Target size of about 60KB
     MAX_HASH_LEN = 24
+    FORMAT_MAGIC = 'PLC:2\n'
 
     @classmethod
     def Load(cls, session, sig, uncached_cb=None):
@@ -108,7 +144,7 @@ class PostingListContainer(object):
         self.lock = PListRLock()
         self.sig = sig
         self.fd = fd
-        self.words = {sig: set()}
+        self.words = {sig: SortedIntList([])}
 
         self.changes = 0
         self._load()
@@ -125,13 +161,16 @@ class PostingListContainer(object):
             self.changed = True
             return self._unlocked_remove(*args, **kwargs)
 
-    def purge_deleted(self, deleted_sig, deleted_set):
+    def purge_deleted(self, deleted_sig, deleted_list):
         changes = 0
-        for sig in self.words:
-	    overlap = (self.words[sig] & deleted_set)
-            if (sig != deleted_sig) and overlap:
-                self.words[sig] -= overlap
-                changes += len(overlap)
+        with self.lock:
+            for sig in self.words:
+                if (sig == deleted_sig) or not self.words[sig]:
+                    continue
+                remaining = SubtractIntLists(self.words[sig], deleted_list)
+                if len(remaining) != len(self.words[sig]):
+                    changes += len(self.words[sig]) - len(remaining)
+                    self.words[sig] = remaining
         self.changes += changes
         return changes
 
@@ -150,10 +189,7 @@ class PostingListContainer(object):
         outfile = self._SaveFile(self.config, self.sig)
         with self.lock:
             # Optimizing for fast loads, so deletion only happens on save.
-            output = '\n'.join('\t'.join(l) for l
-                               in ([sig] + [str(v) for v in vals]
-                                   for sig, vals in self.words.iteritems())
-                               if len(l) > 1)
+            output = self._render()
             t.append(time.time())
 
             if not output:
@@ -168,7 +204,7 @@ class PostingListContainer(object):
                                         dir=self.config.tempfile_dir(),
                                         header_data={'subject': subj},
                                         name='PLC/%s' % self.sig) as fd:
-                    fd.write(output.encode('utf-8'))
+                    fd.write(output)
                     fd.save(outfile)
             else:
                 with open(outfile, 'wb') as fd:
@@ -219,6 +255,31 @@ class PostingListContainer(object):
 
         return splits
 
+    def _render(self):
+        output = []
+        for sig, vals in self.words.iteritems():
+            if len(vals) > 0:
+                data = PackIntList(vals)
+                output.append(struct.pack('<B', len(sig)) + sig +
+                              struct.pack('<I', len(data)) + data)
+        if output:
+            return self.FORMAT_MAGIC + ''.join(output)
+        return ''
+
+    def _unlocked_parse_binary(self, data):
+        pos = len(self.FORMAT_MAGIC)
+        while pos < len(data):
+            sl = struct.unpack('<B', data[pos])[0]
+            sig = data[pos+1:pos+1+sl]
+            pos += 1 + sl
+            dl = struct.unpack('<I', data[pos:pos+4])[0]
+            vals = UnpackIntList(data[pos+4:pos+4+dl])
+            pos += 4 + dl
+            if sig in self.words and self.words[sig]:
+                self.words[sig] = MergeIntLists(self.words[sig], vals)
+            else:
+                self.words[sig] = vals
+
     def _load(self):
         t0 = time.time()
         if not self.fd:
@@ -229,11 +290,24 @@ class PostingListContainer(object):
                 return
         with self.lock, self.fd:
             try:
-                decrypt_and_parse_lines(self.fd,
-                                        self._unlocked_parse_lines,
-                                        self.config)
-                self.changes = 0
-            except (ValueError, IOError):
+                chunks = []
+                first = self.fd.readline()
+                if first == self.FORMAT_MAGIC:
+                    chunks = [first, self.fd.read()]
+                else:
+                    self.fd.seek(0)
+                    decrypt_and_parse_lines(self.fd, chunks.extend,
+                                            self.config,
+                                            newlines=True, decode=False)
+                data = ''.join(chunks)
+                if data.startswith(self.FORMAT_MAGIC):
+                    self._unlocked_parse_binary(data)
+                    self.changes = 0
+                else:
+                    # Legacy text format: parse, then flag for rewriting.
+                    self._unlocked_parse_lines(data.splitlines())
+                    self.changes = 1 if any(self.words.values()) else 0
+            except (ValueError, IOError, struct.error):
                 self.session.ui.warning('load(%s) %s'
                                         % (self.sig, sys.exc_info()))
                 if self.config.sys.debug:
@@ -246,21 +320,21 @@ class PostingListContainer(object):
         for line in lines:
             words = line.strip().split('\t')
             if len(words) > 1:
-                self._unlocked_add(words[0], words[1:])
+                self._unlocked_add(words[0], _valid_b36(words[1:]))
 
     def _unlocked_add(self, sig, values):
-        wset = set(values)
-        self.changes += len(wset)
-        if sig in self.words:
-            self.words[sig] |= wset
+        vals = SortedIntList(values)
+        self.changes += len(vals)
+        if sig in self.words and self.words[sig]:
+            self.words[sig] = MergeIntLists(self.words[sig], vals)
         else:
-            self.words[sig] = wset
+            self.words[sig] = vals
 
     def _unlocked_remove(self, sig, values):
-        wset = set(values)
-        self.changes += len(wset)
+        vals = SortedIntList(values)
+        self.changes += len(vals)
         if sig in self.words:
-            self.words[sig] -= wset
+            self.words[sig] = SubtractIntLists(self.words[sig], vals)
             if not self.words[sig]:
                 del self.words[sig]
 
@@ -313,7 +387,8 @@ class PostingList(object):
             self.plc = PostingListContainer.Load(self.session, self.sig)
 
     def hits(self):
-        return self.plc.get(self.sig) or set()
+        """Returns a sorted array of msg_idx integers."""
+        return self.plc.get(self.sig) or SortedIntList([])
 
     def append(self, *eids):
         self.plc.add(self.sig, eids)
@@ -330,6 +405,234 @@ class PostingList(object):
                                    config.prefs.encrypt_index) and
                                   config.get_master_key()))
 
+    @classmethod
+    def PurgeDeleted(cls, session, sig, deleted_sig, deleted_list):
+        plc = PostingListContainer.Load(session, sig)
+        return plc.purge_deleted(deleted_sig, deleted_list)
+
+    @classmethod
+    def Flush(cls, session):
+        PLC_CACHE_FlushAndClean(session)
+
+    @classmethod
+    def Keys(cls, session):
+        # FIXME: Scan the posting list directory tree for keys as well
+        return []
+
+
+class DictPostingList(PostingList):
+    """
+    A posting list engine which stores every keyword in one EncryptedDict,
+    instead of in a tree of prefix-named container files.
+
+    Each value is the keyword's sig followed by its delta-encoded hits.
+    Rare keywords (the vast majority) fit in the hash record itself, so
+    looking one up is a single seek and no file system walk. Popular
+    keywords bump rare ones to later keysets, so the hot keys cluster
+    together at the start of the dict.
+
+    This is enabled by the 'postinglist_dict' experiment; the existing
+    posting list files are imported the first time it runs, and exported
+    back if the experiment is disabled again.
+    """
+    SHARD_SIZE = 128 * 1024
+
+    @classmethod
+    def Enabled(cls, config):
+        return bool('postinglist_dict' in config.sys.experiments and
+                    config.get_master_key())
+
+    @classmethod
+    def DictBase(cls, config):
+        return os.path.join(config.workdir, 'search-dict', 'postings')
+
+    @classmethod
+    def Exists(cls, config):
+        return os.path.exists(cls.DictBase(config) + '-k-1')
+
+    @classmethod
+    def _Dict(cls, session):
+        global GLOBAL_PL_DICT
+        with GLOBAL_PL_DICT_LOCK:
+            if GLOBAL_PL_DICT is None:
+                config = session.config
+                base = cls.DictBase(config)
+                if not os.path.exists(os.path.dirname(base)):
+                    os.mkdir(os.path.dirname(base))
+                GLOBAL_PL_DICT = EncryptedDict(base, config.get_master_key(),
+                                               shard_size=cls.SHARD_SIZE,
+                                               sparse=True,
+                                               cluster_hot_keys=True)
+                # The tree is moved away once imported; if it is still
+                # here, we have not finished importing it.
+                cls._ImportTree(session, GLOBAL_PL_DICT)
+            return GLOBAL_PL_DICT
+
+    @classmethod
+    def _ImportTree(cls, session, pl_dict):
+        search_dir = os.path.join(session.config.workdir, 'search')
+        if not os.path.isdir(search_dir):
+            return
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(search_dir):
+            for fn in filenames:
+                plc = PostingListContainer(session, fn)
+                for sig, hits in plc.words.iteritems():
+                    if hits:
+                        cls._Save(pl_dict, sig, MergeIntLists(
+                            cls._Load(pl_dict, sig), hits))
+                        count += 1
+                        if (count % 1000) == 0:
+                            session.ui.mark(_('Importing search index... %d'
+                                              ) % count)
+        pl_dict.flush()
+
+        # The old tree is now stale: move it out of the way.
+        _ReplaceBackup(search_dir, search_dir + '.old')
+
+    @classmethod
+    def ExportToTree(cls, session):
+        """Write the dict back to posting list files, then retire it."""
+        with GLOBAL_PL_DICT_LOCK:
+            config = session.config
+            base = cls.DictBase(config)
+            pl_dict = EncryptedDict(base, config.get_master_key(),
+                                    shard_size=cls.SHARD_SIZE, sparse=True)
+            def save_all():
+                # Saving directly, not via the save worker; we may be
+                # running on it already.
+                with PLC_CACHE_LOCK:
+                    plcs = [plc for ts, plc in PLC_CACHE.values()]
+                    PLC_CACHE.clear()
+                for plc in plcs:
+                    plc.save()
+
+            count = 0
+            for sig in cls._Keys(pl_dict):
+                hits = cls._Load(pl_dict, sig)
+                if hits:
+                    PostingListContainer.Load(session, sig).add(sig, hits)
+                    count += 1
+                    if (count % 1000) == 0:
+                        session.ui.mark(_('Exporting search index... %d'
+                                          ) % count)
+                        save_all()
+            save_all()
+            pl_dict.close()
+            _ReplaceBackup(os.path.dirname(base),
+                           os.path.dirname(base) + '.old')
+
+    @classmethod
+    def _Parse(cls, value):
+        sig, data = value.split('\t', 1)
+        return sig, UnpackIntList(data)
+
+    @classmethod
+    def _Load(cls, pl_dict, sig):
+        value = pl_dict.get(sig)
+        if value:
+            vsig, hits = cls._Parse(value)
+            if vsig == sig:
+                return hits
+        return SortedIntList([])
+
+    @classmethod
+    def _Save(cls, pl_dict, sig, hits):
+        if len(hits):
+            pl_dict[sig] = '%s\t%s' % (sig, PackIntList(hits))
+        else:
+            del pl_dict[sig]
+
+    @classmethod
+    def Append(cls, session, word, values, compact=False, sig=None):
+        sig = sig or cls._WordSig(word, session.config)
+        pl_dict = cls._Dict(session)
+        with GLOBAL_PL_DICT_LOCK:
+            cls._Save(pl_dict, sig, MergeIntLists(cls._Load(pl_dict, sig),
+                                                  SortedIntList(values)))
+
+    @classmethod
+    def Optimize(cls, session, index, lazy=False, quick=False):
+        cls.Flush(session)
+
+    @classmethod
+    def PurgeDeleted(cls, session, sig, deleted_sig, deleted_list):
+        if sig == deleted_sig:
+            return 0
+        pl_dict = cls._Dict(session)
+        with GLOBAL_PL_DICT_LOCK:
+            hits = cls._Load(pl_dict, sig)
+            remaining = SubtractIntLists(hits, deleted_list)
+            if len(remaining) != len(hits):
+                cls._Save(pl_dict, sig, remaining)
+            return len(hits) - len(remaining)
+
+    @classmethod
+    def Flush(cls, session):
+        with GLOBAL_PL_DICT_LOCK:
+            if GLOBAL_PL_DICT is not None:
+                GLOBAL_PL_DICT.flush()
+
+    @classmethod
+    def _Keys(cls, pl_dict):
+        # Note: values() includes stale copies, so we deduplicate.
+        return sorted(set(cls._Parse(v)[0] for v in pl_dict.values()
+                          if '\t' in v))
+
+    @classmethod
+    def Keys(cls, session):
+        return cls._Keys(cls._Dict(session))
+
+    def __init__(self, session, word):
+        self.config = session.config
+        self.session = session
+        if word:
+            self.word = word
+            self.sig = self._WordSig(word, self.config)
+            self.pl_dict = self._Dict(session)
+
+    def hits(self):
+        """Returns a sorted array of msg_idx integers."""
+        with GLOBAL_PL_DICT_LOCK:
+            return self._Load(self.pl_dict, self.sig)
+
+    def append(self, *eids):
+        with GLOBAL_PL_DICT_LOCK:
+            self._Save(self.pl_dict, self.sig,
+                       MergeIntLists(self._Load(self.pl_dict, self.sig),
+                                     SortedIntList(eids)))
+        return self
+
+    def remove(self, eids):
+        with GLOBAL_PL_DICT_LOCK:
+            self._Save(self.pl_dict, self.sig,
+                       SubtractIntLists(self._Load(self.pl_dict, self.sig),
+                                        SortedIntList(eids)))
+        return self
+
+
+def _ReplaceBackup(path, backup):
+    if os.path.exists(backup):
+        shutil.rmtree(backup)
+    os.rename(path, backup)
+
+
+def PostingListEngine(session):
+    """
+    Return the posting list class in use. If the dict experiment has been
+    disabled since it last ran, this migrates its contents back first.
+    """
+    global GLOBAL_PL_ENGINE
+    if GLOBAL_PL_ENGINE is None:
+        config = session.config
+        if DictPostingList.Enabled(config):
+            GLOBAL_PL_ENGINE = DictPostingList
+        else:
+            if DictPostingList.Exists(config) and config.get_master_key():
+                DictPostingList.ExportToTree(session)
+            GLOBAL_PL_ENGINE = PostingList
+    return GLOBAL_PL_ENGINE
+
 
 ##############################################################################
 
@@ -538,15 +841,22 @@ class OldPostingList(object):
 
 class GlobalPostingList(OldPostingList):
 
+    # Keyword appends are buffered in RAM and written to the journal in
+    # one go, when either of these thresholds is crossed or FlushJournal
+    # is called (which happens before the metadata index gets saved).
+    JOURNAL_FLUSH_BYTES = 64 * 1024
+    JOURNAL_FLUSH_SECONDS = 5
+
     @classmethod
     def _Optimize(cls, session, idx,
                   force=False, lazy=False, quick=False, ratio=1.0, runtime=0):
 
         # Record the largest known msg_mid here so it doesn't get lost
         cls.UpdateMaxMsgMid(session, [b36(cls.GetMaxMsgIdxPos())])
+        cls.FlushJournal(session)
 
         deleted = GlobalPostingList(session, 'deleted:is')
-        deleted_set = deleted.hits()
+        deleted_list = deleted.hits()
         deleted_sig = deleted.sig
 
         starttime = time.time()
@@ -558,7 +868,9 @@ class GlobalPostingList(OldPostingList):
             # Why sort? Processing keys in order is more efficient, as it lets
             # things accumulate in the PLC_CACHE.
             keys = sorted(GLOBAL_GPL.keys())
-            if not quick and not lazy:
+            if force and not quick and not lazy:
+                # Listing every key may mean decrypting the whole posting
+                # list store, so we only purge everything when asked to.
                 keys = sorted(keys + pls.plc_keys())
 
             if ratio and keys:
@@ -572,9 +884,9 @@ class GlobalPostingList(OldPostingList):
 
             for sig in keys:
                 if pls._migrate(sig):
-                    pls._purge_deleted(sig, deleted_sig, deleted_set)
+                    pls._purge_deleted(sig, deleted_sig, deleted_list)
                     count += 1
-                elif pls._purge_deleted(sig, deleted_sig, deleted_set):
+                elif pls._purge_deleted(sig, deleted_sig, deleted_list):
                     count += 1
 
                 if (count % 97) == 0:
@@ -587,7 +899,7 @@ class GlobalPostingList(OldPostingList):
                 if mailpile.util.QUITTING:
                     break
 
-            PLC_CACHE_FlushAndClean(session)
+            PostingListEngine(session).Flush(session)
             pls.save()
 
         return count
@@ -606,17 +918,86 @@ class GlobalPostingList(OldPostingList):
 
     @classmethod
     def _Append(cls, session, word, mail_ids, compact=True):
-        super(GlobalPostingList, cls)._Append(session, word, mail_ids,
-                                              compact=compact)
+        sig = cls.WordSig(word, session.config)
         with GLOBAL_GPL_LOCK:
             global GLOBAL_GPL
-            sig = cls.WordSig(word, session.config)
             if GLOBAL_GPL is None:
                 GLOBAL_GPL = {}
             if sig not in GLOBAL_GPL:
                 GLOBAL_GPL[sig] = set()
             for mail_id in mail_ids:
                 GLOBAL_GPL[sig].add(mail_id)
+            cls._JournalAppend(sig, mail_ids)
+        cls._MaybeFlushJournal(session, compact=compact)
+
+    @classmethod
+    def _JournalAppend(cls, sig, mail_ids):
+        global GPL_JOURNAL_BUFFER_TS
+        with GLOBAL_GPL_LOCK:
+            if not GPL_JOURNAL_BUFFER:
+                GPL_JOURNAL_BUFFER_TS = time.time()
+            GPL_JOURNAL_BUFFER.append('%s\t%s\n' % (sig, '\t'.join(mail_ids)))
+
+    @classmethod
+    def _MaybeFlushJournal(cls, session, compact=True):
+        with GLOBAL_GPL_LOCK:
+            if not GPL_JOURNAL_BUFFER:
+                return
+            buffered = sum(len(l) for l in GPL_JOURNAL_BUFFER)
+            if (buffered < cls.JOURNAL_FLUSH_BYTES and
+                    GPL_JOURNAL_BUFFER_TS > time.time() -
+                                            cls.JOURNAL_FLUSH_SECONDS):
+                return
+        cls._FlushJournal(session, compact=compact)
+
+    @classmethod
+    def FlushJournal(cls, session, compact=False):
+        return cls.Lock(GLOBAL_POSTING_LOCK, cls._FlushJournal, session,
+                        compact=compact)
+
+    @classmethod
+    def _FlushJournal(cls, session, compact=False):
+        """
+        Write all buffered keyword appends to the journal with a single
+        write (and a single encryption pass, if the index is encrypted).
+        """
+        global GPL_JOURNAL_BUFFER
+        config = session.config
+        with GLOBAL_GPL_LOCK:
+            lines, GPL_JOURNAL_BUFFER = GPL_JOURNAL_BUFFER, []
+        if not lines:
+            return 0
+
+        fn_path = cls.SaveFile(session, None)
+        try:
+            if compact and os.path.exists(fn_path):
+                # Rewriting the journal from GLOBAL_GPL removes duplicates
+                # and includes everything that was buffered.
+                max_size = ((1024 * config.sys.postinglist_kb) -
+                            (cls.HASH_LEN * 6))
+                if os.path.getsize(fn_path) > max_size:
+                    cls(session, '').save()
+                    return len(lines)
+
+            output = ''.join(lines)
+            encryption_key = config.get_master_key()
+            if config.prefs.encrypt_index and encryption_key:
+                with EncryptingStreamer(encryption_key,
+                                        delimited=True,
+                                        dir=config.tempfile_dir(),
+                                        name='PostingList') as efd:
+                    efd.write(output)
+                    efd.save(fn_path, mode='ab')
+            else:
+                with open(fn_path, 'ab') as fd:
+                    fd.write(output)
+            return len(lines)
+        except (IOError, OSError):
+            # Put the lines back, so we try again next time.
+            with GLOBAL_GPL_LOCK:
+                GPL_JOURNAL_BUFFER[:0] = lines
+            session.ui.warning('%s: %s' % (fn_path, sys.exc_info()))
+            return 0
 
     @classmethod
     def GetMaxMsgIdxPos(cls):
@@ -656,9 +1037,8 @@ class GlobalPostingList(OldPostingList):
                 GLOBAL_GPL = {}
             GLOBAL_GPL[GPL_MSGID_TRACKER] = [b36(msg_idx_pos)]
 
-        super(GlobalPostingList, cls)._Append(
-            session, '', GLOBAL_GPL[GPL_MSGID_TRACKER],
-            sig=GPL_MSGID_TRACKER, compact=False)
+            cls._JournalAppend(GPL_MSGID_TRACKER,
+                               GLOBAL_GPL[GPL_MSGID_TRACKER])
 
     def __init__(self, *args, **kwargs):
         with GLOBAL_GPL_LOCK:
@@ -687,28 +1067,34 @@ class GlobalPostingList(OldPostingList):
             if sig in GPL_NEVER_MIGRATE:
                 return False
             if sig in self.WORDS and len(self.WORDS[sig]) > 0:
-                PostingList.Append(self.session, sig, self.WORDS[sig],
-                                   sig=sig, compact=compact)
+                PostingListEngine(self.session).Append(
+                    self.session, sig, _valid_b36(self.WORDS[sig]),
+                    sig=sig, compact=compact)
                 del self.WORDS[sig]
                 return True
         return False
 
-    def _purge_deleted(self, sig, deleted_sig, deleted_set):
+    def _purge_deleted(self, sig, deleted_sig, deleted_list):
         if sig in GPL_NEVER_MIGRATE:
             return False
         with self.lock:
-            plc = PostingListContainer.Load(self.session, sig)
-            return plc.purge_deleted(deleted_sig, deleted_set)
+            return PostingListEngine(self.session).PurgeDeleted(
+                self.session, sig, deleted_sig, deleted_list)
 
     def remove(self, eids):
-        PostingList(self.session, self.word).remove(eids).save()
+        PostingListEngine(self.session)(self.session, self.word).remove(eids)
         return OldPostingList.remove(self, eids)
 
     def hits(self):
-        return (self.WORDS.get(self.sig, set())
-                | PostingList(self.session, self.word).hits())
+        """
+        Returns a sorted array of msg_idx integers, merging the journal
+        with the on-disk posting list.
+        """
+        with self.lock:
+            journal = SortedIntList(_valid_b36(self.WORDS.get(self.sig, [])))
+        engine = PostingListEngine(self.session)
+        return MergeIntLists(engine(self.session, self.word).hits(), journal)
 
     def plc_keys(self):
-        keys = []
-        # FIXME: Scan the posting list directory tree for keys as well
-        return list(keys)
+        """List every key on disk. This can be slow, see _Optimize()."""
+        return list(PostingListEngine(self.session).Keys(self.session))
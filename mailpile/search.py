@@ -7,6 +7,7 @@ import rfc822
 import time
 import threading
 import traceback
+from array import array
 from urllib import quote, unquote
 
 import mailpile.util
@@ -17,12 +18,17 @@ from mailpile.eventlog import GetThreadEvent
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.index.base import BaseIndex
+from mailpile.index.bitmap import Bitmap
+from mailpile.index.columns import MetadataColumns, RankTable
+from mailpile.index.parallel import ForkedMap
+from mailpile.index.records import MetadataRecordStore
 from mailpile.index.search import SearchResultSet, CachedSearchResultSet
 from mailpile.plugins import PluginManager
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils.addresses import AddressHeaderParser
 from mailpile.mailutils.emails import ExtractEmails, ExtractEmailAndName
 from mailpile.mailutils.emails import Email, ParseMessage, GetTextPayload
+from mailpile.mailutils.emails import VerifyMessageSignatures
 from mailpile.mailutils.header import decode_header
 from mailpile.mailutils.headerprint import HeaderPrints
 from mailpile.mailutils.html import extract_text_from_html
@@ -47,6 +53,10 @@ class MailIndex(BaseIndex):
     APPEND_MARK = '-----APPENDED SECTION-----'
 
     MAX_CACHE_ENTRIES = 2500
+    # With the parallel_indexing experiment, messages are parsed this many
+    # at a time in forked worker processes.
+    SCAN_BATCH_SIZE = 50
+
     CAPABILITIES = set([
         BaseIndex.CAN_SEARCH,
         BaseIndex.CAN_SORT,
@@ -58,19 +68,25 @@ class MailIndex(BaseIndex):
         BaseIndex.__init__(self, config)
         self.interrupt = None
         self.loaded_index = False
-        self.INDEX = []
+        self.INDEX = MetadataColumns()
         self.INDEX_SORT = {}
-        self.INDEX_THR = []
+        self.INDEX_THR = array('l')
+        self.THREAD_MEMBERS = {}
+        self.THREAD_HEADS = {}
         self.PTRS = {}
         self.TAGS = {}
+        self.TAG_BITMAPS = {}
         self.MSGIDS = {}
         self.MODIFIED = set()
         self.EMAILS_SAVED = 0
         self._scanned = {}
         self._saved_changes = 0
         self._saved_lines = 0
+        self._records = None
+        self._skip_sorting = False
         self._lock = SearchRLock()
         self._save_lock = SearchRLock()
+        self._unread_cache = None
         self._prepare_sorting()
         self._url_re_cache = {}
 
@@ -96,8 +112,47 @@ class MailIndex(BaseIndex):
         parts = [unicode(p).translate(self.NORM_TABLE) for p in message]
         return (u'\t'.join(parts)).encode('utf-8')
 
+    def _records_base(self):
+        return os.path.join(self.config.workdir, 'mailpile-records')
+
+    def _open_records(self):
+        """
+        Open the random-access metadata record store, if that experiment
+        is enabled. It needs the master key, as records are encrypted.
+        """
+        master_key = self.config.get_master_key()
+        if (self._records is None and master_key and
+                'metadata_records' in self.config.sys.experiments):
+            self._records = MetadataRecordStore(self._records_base(),
+                                                master_key)
+        return self._records
+
     def load(self, session=None):
-        self.INDEX = []
+        # If there is a metadata index file, it takes precedence over the
+        # record store: it is either newer, or a migration was interrupted.
+        from_records = (
+            MetadataRecordStore.Exists(self._records_base()) and
+            not os.path.exists(self.config.mailindex_file()))
+        if from_records and not self.config.get_master_key():
+            # Starting with an empty index would soon write a new metadata
+            # index file, hiding the records for good.
+            raise Exception(_('The metadata record store is encrypted, '
+                              'but no master key is available!'))
+
+        records = self._open_records()
+        if from_records and records is None:
+            # The experiment was disabled; read the records one last time
+            # and save everything to a new metadata index file.
+            records = MetadataRecordStore(self._records_base(),
+                                          self.config.get_master_key())
+        else:
+            from_records = from_records and (records is not None)
+
+        self.INDEX = MetadataColumns(
+            loader=(self._records and self._records.load_message))
+        self.INDEX_THR = array('l')
+        self.THREAD_MEMBERS = {}
+        self.THREAD_HEADS = None  # Rebuilt once everything is loaded
         self.CACHE = {}
         self.PTRS = {}
         self.MSGIDS = {}
@@ -106,6 +161,14 @@ class MailIndex(BaseIndex):
         CachedSearchResultSet.DropCaches()
         bogus_lines = []
 
+        # If we have up-to-date sort keys on disk, don't recalculate them.
+        self._prepare_sorting()
+        sort_cache = self._load_sort_cache(session)
+        self._skip_sorting = bool(sort_cache)
+        if not sort_cache:
+            for ranks in self.SORT_RANKS.values():
+                ranks.defer()
+
         def process_lines(lines):
             for line in lines:
                 line = line.strip()
@@ -168,27 +231,63 @@ class MailIndex(BaseIndex):
 
         if session:
             session.ui.mark(_('Loading metadata index...'))
-        try:
-            import mailpile.mail_source
+
+        if from_records:
+            # Records are read one at a time, and only the columns needed
+            # for searching and sorting stay in RAM; the rest is evicted
+            # and loaded again from disk on demand.
+            #
+            # If the sort cache is valid, we don't need the subjects either
+            # and the column cache has everything else; then we don't have
+            # to decrypt any of the records up front.
             with self._save_lock, self._lock:
-                with open(self.config.mailindex_file(), 'r') as fd:
-                    # We don't raise on errors, in case only some of the chunks
-                    # are corrupt - we want to read the rest of them.
-                    errors = 0
-                    def warn(offset):
-                        if session:
-                            session.ui.error('WARNING: Failed to decrypt '
-                                             'block of index ending at %d'
-                                             % offset)
-                    # FIXME: Differentiate between partial index and no index?
-                    gpgi = GnuPG(self.config, event=GetThreadEvent())
-                    decrypt_and_parse_lines(fd, process_lines, self.config,
-                        newlines=True, decode=False, gpgi=gpgi,
-                        _raise=False, error_cb=warn)
-        except IOError:
-            if session:
-                session.ui.warning(_('Metadata index not found: %s'
-                                     ) % self.config.mailindex_file())
+                if not (sort_cache and records is self._records and
+                        self._load_column_cache(session)):
+                    for pos, email in records.emails():
+                        while len(self.EMAILS) < pos + 1:
+                            self.EMAILS.append('')
+                        self.EMAILS[pos] = email
+                        self.EMAIL_IDS[email.split()[0].lower()] = pos
+                    process_lines(line for pos, line in records.messages())
+                    for pos in range(0, len(self.INDEX)):
+                        self.INDEX.evict(pos)
+        else:
+            try:
+                import mailpile.mail_source
+                with self._save_lock, self._lock:
+                    with open(self.config.mailindex_file(), 'r') as fd:
+                        # We don't raise on errors, in case only some of the
+                        # chunks are corrupt - we want to read the rest.
+                        errors = 0
+                        def warn(offset):
+                            if session:
+                                session.ui.error(
+                                    'WARNING: Failed to decrypt block of '
+                                    'index ending at %d' % offset)
+                        # FIXME: Differentiate between partial index and
+                        #        no index?
+                        gpgi = GnuPG(self.config, event=GetThreadEvent())
+                        decrypt_and_parse_lines(
+                            fd, process_lines, self.config,
+                            newlines=True, decode=False, gpgi=gpgi,
+                            _raise=False, error_cb=warn)
+            except IOError:
+                if session:
+                    session.ui.warning(_('Metadata index not found: %s'
+                                         ) % self.config.mailindex_file())
+
+        self._skip_sorting = False
+        if sort_cache and len(sort_cache['thr']) == len(self.INDEX):
+            self.INDEX_THR = sort_cache['thr']
+            for order in self.INDEX_SORT:
+                self.INDEX_SORT[order] = sort_cache[order]
+            for order in self.SORT_RANKS:
+                self.SORT_RANKS[order] = sort_cache['ranks:%s' % order]
+        elif sort_cache:
+            self._rebuild_sorting(session)
+        else:
+            self._finish_sort_ranks()
+        self._rebuild_threads()
 
         session.ui.mark(_('Loading global posting list...'))
         GlobalPostingList(session, '')
@@ -209,6 +308,12 @@ class MailIndex(BaseIndex):
                                ) % len(self.INDEX))
         self.EMAILS_SAVED = len(self.EMAILS)
 
+        if (records is not self._records) or (records and not from_records):
+            # Migrating to or from the record store: the next save will
+            # write out everything.
+            self.MODIFIED = set(range(0, len(self.INDEX)))
+            self.EMAILS_SAVED = 0
+
         # Make sure metadata has entry for every msg_mid in keyword index.
         max_kw_msg_idx_pos = GlobalPostingList.GetMaxMsgIdxPos()
         if max_kw_msg_idx_pos and max_kw_msg_idx_pos >= len(self.INDEX):
@@ -227,11 +332,24 @@ class MailIndex(BaseIndex):
         tags = set(self.get_tags(msg_info=msg_info))
         with self._lock:
             for tid in (set(self.TAGS.keys()) - tags):
-                self.TAGS[tid] -= set([msg_idx_pos])
+                if msg_idx_pos in self.TAGS[tid]:
+                    self.TAGS[tid].discard(msg_idx_pos)
+                    self.TAG_BITMAPS.pop(tid, None)
             for tid in tags:
                 if tid not in self.TAGS:
                     self.TAGS[tid] = set()
-                self.TAGS[tid].add(msg_idx_pos)
+                if msg_idx_pos not in self.TAGS[tid]:
+                    self.TAGS[tid].add(msg_idx_pos)
+                    self.TAG_BITMAPS.pop(tid, None)
+
+    def _tag_bitmap(self, tid):
+        """Return (and cache) a bitmap of the messages in a given tag."""
+        with self._lock:
+            bitmap = self.TAG_BITMAPS.get(tid)
+            if bitmap is None:
+                bitmap = Bitmap(self.TAGS.get(tid, []))
+                self.TAG_BITMAPS[tid] = bitmap
+            return bitmap
 
     def _maybe_encrypt(self, data):
         gpgr = self.config.prefs.gpg_recipient
@@ -254,7 +372,66 @@ class MailIndex(BaseIndex):
 
         return data
 
+    def _save_records(self, session=None):
+        """
+        Write changed metadata to the record store. Each record is rewritten
+        in place, so there is no log to compact and save() and save_changes()
+        are the same thing.
+        """
+        self._save_lock.acquire()
+        try:
+            with self._lock:
+                mods, self.MODIFIED = self.MODIFIED, set()
+                old_emails_saved, total = self.EMAILS_SAVED, len(self.EMAILS)
+
+            if old_emails_saved == total and not mods:
+                # Nothing to do...
+                if mailpile.util.QUITTING:
+                    self._save_sort_cache(session)
+                    self._save_column_cache(session)
+                return
+
+            if session:
+                session.ui.mark(_("Saving metadata index changes..."))
+
+            for eid in range(old_emails_saved, total):
+                self._records.save_email(eid, self.EMAILS[eid])
+            for pos in sorted(mods):
+                with self._lock:
+                    line = self.INDEX[pos]
+                self._records.save_message(pos, line)
+            self._records.flush()
+
+            # Once the records are complete, retire the old index file.
+            backup_file(self.config.mailindex_file(), backups=5)
+
+            with self._lock:
+                self.EMAILS_SAVED = total
+                for pos in mods:
+                    if pos not in self.MODIFIED:
+                        self.INDEX.evict(pos)
+
+            # Refresh the caches along with the records, so startup after
+            # an unclean exit does not have to decrypt every record.
+            self._save_sort_cache(session)
+            self._save_column_cache(session)
+            if session:
+                session.ui.mark(_("Saved metadata index changes"))
+        except:
+            # Failed, roll back...
+            with self._lock:
+                self.MODIFIED |= mods
+                self.EMAILS_SAVED = old_emails_saved
+            raise
+        finally:
+            self._save_lock.release()
+
     def save_changes(self, session=None):
+        # Keywords must hit the disk before the metadata referring to them.
+        GlobalPostingList.FlushJournal(session or self.config.background)
+        if self._records is not None:
+            return self._save_records(session=session)
+
         self._save_lock.acquire()
         try:
             # In a locked section, check what needs to be done!
@@ -265,6 +442,8 @@ class MailIndex(BaseIndex):
 
             if old_emails_saved == total and not mods:
                 # Nothing to do...
+                if mailpile.util.QUITTING:
+                    self._save_sort_cache(session)
                 return
 
             max_incremental_saves = (index_items + self.ITEM_COUNT_OFFSET
@@ -302,6 +481,8 @@ class MailIndex(BaseIndex):
                 self._saved_changes += 1
                 self._saved_lines += total - old_emails_saved + len(mods)
 
+            if mailpile.util.QUITTING:
+                self._save_sort_cache(session)
             if session:
                 session.ui.mark(_("Saved metadata index changes"))
         except:
@@ -313,6 +494,9 @@ class MailIndex(BaseIndex):
             self._save_lock.release()
 
     def save(self, session=None):
+        GlobalPostingList.FlushJournal(session or self.config.background)
+        if self._records is not None:
+            return self._save_records(session=session)
         try:
             self._save_lock.acquire()
             with self._lock:
@@ -347,6 +531,7 @@ class MailIndex(BaseIndex):
 
             self._saved_changes = 0
             self._saved_lines = email_counter + index_counter
+            self._save_sort_cache(session)
             if session:
                 session.ui.mark(_("Saved metadata index"))
         except:
@@ -364,14 +549,15 @@ class MailIndex(BaseIndex):
             self.PTRS = {}
             self.MSGIDS = {}
             for offset in range(0, len(self.INDEX)):
-                message = self.l2m(self.INDEX[offset])
-                if len(message) == self.MSG_FIELDS_V2:
+                try:
+                    message = self.INDEX.get_fields(offset)
                     self.MSGIDS[message[self.MSG_ID]] = offset
                     for msg_ptr in message[self.MSG_PTRS].split(','):
                         if msg_ptr:
                             self.PTRS[msg_ptr] = offset
-                else:
-                    session.ui.warning(_('Bogus line: %s') % line)
+                except ValueError:
+                    session.ui.warning(_('Bogus line: %s')
+                                       % self.INDEX[offset])
 
     def _remove_location(self, session, msg_ptr):
         msg_idx_pos = self.PTRS[msg_ptr]
@@ -441,8 +627,11 @@ class MailIndex(BaseIndex):
         mailbox_idx = FormatMbxId(mailbox_idx)
         progress = self._get_scan_progress(mailbox_idx,
                                            event=event, reset=True)
+        reader = None
 
         def finito(code, message, **kwargs):
+            if reader is not None:
+                reader.close()
             if event:
                 event.data['rescans'].append(
                     (mailbox_idx, code, message, kwargs))
@@ -499,54 +688,96 @@ class MailIndex(BaseIndex):
         not_done_yet = 'NOT DONE YET'
         if reverse:
             messages.reverse()
-        for ui in range(0, len(messages)):
-            if mailpile.util.QUITTING or self.interrupt:
-                ir, self.interrupt = self.interrupt, None
-                return finito(-1, _('Rescan interrupted: %s') % ir)
-            if stop_after and added >= stop_after:
-                messages_md5 = not_done_yet
-                break
-            elif deadline and time.time() > deadline:
-                messages_md5 = not_done_yet
-                break
-            elif mbox_version != mbox.last_updated():
-                messages_md5 = not_done_yet
-                break
-
-            i = messages[ui]
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
-            if msg_ptr in self.PTRS:
-                if not lazy:
-                    msg_info = self.get_msg_at_idx_pos(self.PTRS[msg_ptr])
-                    msg_body = msg_info[self.MSG_BODY]
-                if lazy or (msg_body not in self.MSG_BODY_UNSCANNED):
-                    if (ui % 1129) == 0:
-                        session.ui.mark(parse_status(ui))
-                    continue
-
-            session.ui.mark(parse_status(ui))
-            if (ui % 127) == 0 and not force:
-                play_nice_with_threads()
 
-            # Message new or modified, let's parse it.
-            try:
-                last_date, a, u = self.scan_one_message(session,
-                                                        mailbox_idx, mbox, i,
-                                                        wait=True,
-                                                        msg_ptr=msg_ptr,
-                                                        last_date=last_date,
-                                                        process_new=process_new,
-                                                        apply_tags=apply_tags,
-                                                        stop_after=stop_after,
-                                                        editable=editable,
-                                                        event=event,
-                                                        progress=progress,
-                                                        lazy=lazy)
-            except TypeError:
-                a = u = 0
+        # Parsing messages is slow, so if requested we do it in parallel
+        # in other processes. Messages are still added to the index one
+        # at a time, in order, by the scan worker. Batches also let us
+        # check all their PGP signatures at once.
+        batch = []
+        scan_kwargs = {
+            'process_new': process_new,
+            'apply_tags': apply_tags,
+            'stop_after': stop_after,
+            'editable': editable,
+            'event': event,
+            'progress': progress,
+            'lazy': lazy}
+        if not lazy and 'parallel_indexing' in session.config.sys.experiments:
+            quiet_session = Session(session.config)
+            quiet_session.ui = SilentInteraction(session.config)
+            reader = ForkedMap(
+                lambda ptr, data: self._parse_and_read(
+                    quiet_session, mailbox_idx, ptr, data),
+                debug=bool(session.config.sys.debug))
+        batching = (reader is not None) or (
+            not lazy and session.config.prefs.index_encrypted)
+
+        # The worker processes must not outlive the scan, however it ends.
+        try:
+            for ui in range(0, len(messages)):
+                if mailpile.util.QUITTING or self.interrupt:
+                    ir, self.interrupt = self.interrupt, None
+                    return finito(-1, _('Rescan interrupted: %s') % ir)
+                if stop_after and added + len(batch) >= stop_after:
+                    messages_md5 = not_done_yet
+                    break
+                elif deadline and time.time() > deadline:
+                    messages_md5 = not_done_yet
+                    break
+                elif mbox_version != mbox.last_updated():
+                    messages_md5 = not_done_yet
+                    break
 
-            added += a
-            updated += u
+                i = messages[ui]
+                msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+                if msg_ptr in self.PTRS:
+                    if not lazy:
+                        msg_info = self.get_msg_at_idx_pos(self.PTRS[msg_ptr])
+                        msg_body = msg_info[self.MSG_BODY]
+                    if lazy or (msg_body not in self.MSG_BODY_UNSCANNED):
+                        if (ui % 1129) == 0:
+                            session.ui.mark(parse_status(ui))
+                        continue
+
+                session.ui.mark(parse_status(ui))
+                if (ui % 127) == 0 and not force:
+                    play_nice_with_threads()
+
+                # Message new or modified, let's parse it.
+                if batching:
+                    batch.append((i, msg_ptr))
+                    if len(batch) >= self.SCAN_BATCH_SIZE:
+                        last_date, a, u = self._scan_batch(session, reader,
+                                                           mailbox_idx, mbox,
+                                                           batch, last_date,
+                                                           scan_kwargs)
+                        added += a
+                        updated += u
+                        batch = []
+                    continue
+                try:
+                    last_date, a, u = self.scan_one_message(
+                        session, mailbox_idx, mbox, i,
+                        wait=True,
+                        msg_ptr=msg_ptr,
+                        last_date=last_date,
+                        **scan_kwargs)
+                except TypeError:
+                    a = u = 0
+
+                added += a
+                updated += u
+
+            if batch:
+                last_date, a, u = self._scan_batch(session, reader,
+                                                   mailbox_idx, mbox,
+                                                   batch, last_date,
+                                                   scan_kwargs)
+                added += a
+                updated += u
+        finally:
+            if reader is not None:
+                reader.close()
 
         if not lazy:
             # Figure out which messages exist at all, and remove stale pointers.
@@ -579,6 +810,53 @@ class MailIndex(BaseIndex):
                       updated=updated,
                       complete=(messages_md5 != not_done_yet))
 
+    def _scan_batch(self, session, reader, mailbox_idx, mbox, batch,
+                    last_date, scan_kwargs):
+        """
+        Parse a batch of messages, in parallel if we have a reader, then
+        index them in order. Messages which fail to parse elsewhere are
+        parsed here instead.
+        """
+        msg_datas = []
+        for msg_mbox_key, msg_ptr in batch:
+            try:
+                msg_datas.append((mbox.get_bytes(msg_mbox_key),
+                                  mbox.get_metadata_keywords(msg_mbox_key)))
+            except (IOError, OSError, ValueError, IndexError, KeyError):
+                msg_datas.append((None, None))
+
+        if session.config.prefs.index_encrypted:
+            VerifyMessageSignatures([md[0] for md in msg_datas],
+                                    config=session.config,
+                                    event=scan_kwargs['event'])
+
+        if reader is not None:
+            parsed = reader.map([(batch[i][1], msg_datas[i][0])
+                                 for i in range(0, len(batch))])
+        else:
+            parsed = [None for md in msg_datas]
+
+        added = updated = 0
+        for i in range(0, len(batch)):
+            msg_mbox_key, msg_ptr = batch[i]
+            msg_data, msg_metadata_kws = msg_datas[i]
+            msg_parsed = parsed[i]
+            try:
+                last_date, a, u = self.scan_one_message(
+                    session, mailbox_idx, mbox, msg_mbox_key,
+                    wait=True,
+                    msg_ptr=msg_ptr,
+                    msg_data=msg_data,
+                    msg_metadata_kws=msg_metadata_kws,
+                    msg_parsed=msg_parsed,
+                    last_date=last_date,
+                    **scan_kwargs)
+            except TypeError:
+                a = u = 0
+            added += a
+            updated += u
+        return last_date, added, updated
+
     def scan_one_message(self, session, mailbox_idx, mbox, msg_mbox_key,
                          wait=False, **kwargs):
         args = [session, mailbox_idx, mbox, msg_mbox_key]
@@ -594,7 +872,7 @@ class MailIndex(BaseIndex):
     def _real_scan_one(self, session,
                        mailbox_idx, mbox, msg_mbox_idx,
                        msg_ptr=None, msg_data=None, msg_metadata_kws=None,
-                       last_date=None,
+                       msg_parsed=None, last_date=None,
                        process_new=None, apply_tags=None, stop_after=None,
                        editable=False, event=None, progress=None,
                        lazy=False):
@@ -611,6 +889,9 @@ class MailIndex(BaseIndex):
         if 'rescan' in session.config.sys.debug:
             session.ui.debug('Reading message %s/%s'
                              % (mailbox_idx, msg_mbox_idx))
+        # Keywords and snippet may have been read by _parse_and_read(),
+        # elsewhere; we still parse the message here for its headers.
+        read_result = msg_parsed
         try:
             if msg_data:
                 msg_fd = cStringIO.StringIO(msg_data)
@@ -656,7 +937,7 @@ class MailIndex(BaseIndex):
                 session, msg_id, msg_ptr, msg_bytes,
                 msg, msg_metadata_kws,
                 last_date + 1, mailbox_idx, process_new, apply_tags,
-                lazy_body, msg_info)
+                lazy_body, msg_info, read_result=read_result)
             last_date = long(msg_info[self.MSG_DATE], 36)
             added += 1
 
@@ -752,7 +1033,7 @@ class MailIndex(BaseIndex):
                                 msg_id, msg_ptr, msg_size,
                                 msg, msg_metadata_kws, default_date,
                                 mailbox_idx, process_new, apply_tags,
-                                lazy_body, msg_info):
+                                lazy_body, msg_info, read_result=None):
         if lazy_body:
             msg_ts = self._extract_date_ts(session, 'new', msg_id, msg,
                                            default_date)
@@ -783,7 +1064,8 @@ class MailIndex(BaseIndex):
                                               default_date,
                                               process_new=process_new,
                                               apply_tags=apply_tags,
-                                              incoming=True)
+                                              incoming=True,
+                                              read_result=read_result)
 
             # Finally, update the metadata index with whatever we learned
             self.edit_msg_info(msg_info,
@@ -1233,7 +1515,7 @@ class MailIndex(BaseIndex):
 
     def read_message(self, session,
                      msg_mid, msg_id, msg, msg_size, msg_ts,
-                     mailbox=None):
+                     mailbox=None, meta=True, crypto=True):
         keywords = []
         snippet_text = snippet_html = ''
         body_info = {}
@@ -1377,7 +1659,7 @@ class MailIndex(BaseIndex):
         if textparts == 0:
             keywords.append('text:missing')
 
-        if 'crypto:has' in keywords:
+        if crypto and 'crypto:has' in keywords:
             e = Email(self, -1,
                       msg_parsed=msg,
                       msg_parsed_pgpmime=('all', msg),
@@ -1481,13 +1763,10 @@ class MailIndex(BaseIndex):
             if not msg[key]:
                 keywords.append('%s:missing' % key)
 
-        for extract in _plugins.get_meta_kw_extractors():
-            try:
-                keywords.extend(extract(self, msg_mid, msg, msg_size, msg_ts,
-                                        body_info=body_info))
-            except:
-                if session.config.sys.debug:
-                    traceback.print_exc()
+        if meta:
+            keywords.extend(self.read_message_meta(session, msg_mid, msg,
+                                                   msg_size, msg_ts,
+                                                   body_info))
 
         # FIXME: If we have a good snippet from the HTML part, it is likely
         #        to be more relevant due to the unfortunate habit of some
@@ -1499,6 +1778,57 @@ class MailIndex(BaseIndex):
 
         return (set(keywords) - STOPLIST), body_info
 
+    def read_message_meta(self, session,
+                          msg_mid, msg, msg_size, msg_ts, body_info):
+        """
+        Run the metadata keyword extractors. These may update state (the
+        Autocrypt database, for example), so unlike the rest of
+        read_message() they must run in the indexing process itself.
+        """
+        keywords = []
+        for extract in _plugins.get_meta_kw_extractors():
+            try:
+                keywords.extend(extract(self, msg_mid, msg, msg_size, msg_ts,
+                                        body_info=body_info))
+            except:
+                if session.config.sys.debug:
+                    traceback.print_exc()
+        return keywords
+
+    def _parse_and_read(self, session, mailbox_idx, msg_ptr, msg_data):
+        """
+        Parse a message and extract its keywords and snippet. This is the
+        part of indexing which does not touch the index, so it can run in
+        a separate process; see scan_mailbox().
+
+        The process may have been forked while other threads held locks,
+        so this must not take any: nothing here talks to GnuPG, and the
+        session should be a quiet one. Returns None for messages with
+        any OpenPGP content; those must be parsed by the caller.
+        """
+        msg = ParseMessage(cStringIO.StringIO(msg_data), pgpmime=False,
+                           config=session.config)
+        for part in msg.walk():
+            if part.get_content_type() in ('multipart/signed',
+                                           'multipart/encrypted'):
+                return None
+            if (session.config.prefs.index_encrypted and
+                    not part.is_multipart() and
+                    (part['content-disposition'] or '').startswith(
+                        'attachment')):
+                kind = GnuPG(session.config).sniff(
+                    part.get_payload(),
+                    part['content-transfer-encoding'] or '')
+                if 'encrypted' in kind or 'signature' in kind:
+                    return None
+        keywords, body_info = self.read_message(
+            session, 'new', self.get_msg_id(msg, msg_ptr), msg,
+            len(msg_data), None, mailbox=mailbox_idx, meta=False,
+            crypto=False)
+        if 'crypto:has' in keywords:
+            return None
+        return keywords, body_info
+
     # FIXME: Here it would be nice to recognize more boilerplate junk in
     #        more languages!
     SNIPPET_JUNK_RE = re.compile(
@@ -1521,11 +1851,19 @@ class MailIndex(BaseIndex):
     def index_message(self, session, msg_mid, msg_id,
                       msg, msg_metadata_kws, msg_size, msg_ts,
                       mailbox=None, compact=True, filter_hooks=None,
-                      process_new=None, apply_tags=None, incoming=False):
-        keywords, snippet = self.read_message(session,
-                                              msg_mid, msg_id, msg,
-                                              msg_size, msg_ts,
-                                              mailbox=mailbox)
+                      process_new=None, apply_tags=None, incoming=False,
+                      read_result=None):
+        if read_result:
+            keywords, snippet = read_result
+            keywords |= (set(self.read_message_meta(session,
+                                                    msg_mid, msg, msg_size,
+                                                    msg_ts, snippet))
+                         - STOPLIST)
+        else:
+            keywords, snippet = self.read_message(session,
+                                                  msg_mid, msg_id, msg,
+                                                  msg_size, msg_ts,
+                                                  mailbox=mailbox)
 
         # Apply the defaults for this mail source / mailbox.
         if apply_tags:
@@ -1570,10 +1908,11 @@ class MailIndex(BaseIndex):
         return keywords, snippet
 
     def get_msg_at_idx_pos_uncached(self, msg_idx):
-        rv = self.l2m(self.INDEX[msg_idx])
-        if len(rv) != self.MSG_FIELDS_V2:
-            raise ValueError()
-        return rv
+        return self.INDEX.get_fields(msg_idx)
+
+    def get_msg_field_at_idx_pos(self, msg_idx, field):
+        """Fetch a single metadata field, without decoding the others."""
+        return self.INDEX.get_field(msg_idx, field)
 
     def delete_msg_at_idx_pos(self, session, msg_idx, keep_msgid=False):
         info = self.get_msg_at_idx_pos(msg_idx)
@@ -1618,8 +1957,130 @@ class MailIndex(BaseIndex):
         GlobalPostingList.Append(session, 'deleted:is', [b36(msg_idx)])
 
     def update_msg_sorting(self, msg_idx, msg_info):
-        for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
+        if self._skip_sorting:
+            return
+        with self._lock:
+            old_fresh = self.INDEX_SORT['freshness'][msg_idx]
+            for order, sorter in self.SORT_ORDERS.iteritems():
+                self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
+            self._join_thread(self.INDEX_THR[msg_idx], msg_idx, old_fresh)
+
+    def _is_fresh(self, msg_idx):
+        # Unread messages get a freshness boost, nothing else does.
+        return (self.INDEX_SORT['freshness'][msg_idx] >
+                self.INDEX_SORT['date'][msg_idx])
+
+    def _update_thread_head(self, thr_idx, changed=None, old_fresh=None):
+        """
+        Record the freshest message in a thread, which places the thread
+        in rev-freshness views, and its oldest unread message, which then
+        represents it.
+
+        If we know which message changed (and its old freshness), only
+        that message is compared against the current head; the members
+        are rescanned only if the head itself got less fresh or left.
+        """
+        members = self.THREAD_MEMBERS.get(thr_idx)
+        if not members:
+            self.THREAD_HEADS.pop(thr_idx, None)
+            return
+        fresh = self.INDEX_SORT['freshness']
+        key = lambda m: (fresh[m], m)
+        head, unread, rescan_unread = None, None, True
+        if changed is not None and thr_idx in self.THREAD_HEADS:
+            head, unread = self.THREAD_HEADS[thr_idx]
+            rescan_unread = False
+            if changed not in members:
+                # The message left the thread
+                if changed == head:
+                    head = None
+                rescan_unread = (changed == unread)
+            else:
+                if changed == head:
+                    if old_fresh is None or fresh[changed] < old_fresh:
+                        head = None
+                elif key(changed) > key(head):
+                    head = changed
+                if changed == unread:
+                    rescan_unread = (old_fresh is None or
+                                     fresh[changed] > old_fresh or
+                                     not self._is_fresh(changed))
+                elif self._is_fresh(changed) and (
+                        unread is None or key(changed) < key(unread)):
+                    unread = changed
+
+        if head is None:
+            head = max(members, key=key)
+        if rescan_unread:
+            unread = [m for m in members if self._is_fresh(m)]
+            unread = min(unread, key=key) if unread else None
+        self.THREAD_HEADS[thr_idx] = (head, unread)
+
+    def _join_thread(self, thr_idx, msg_idx, old_fresh=None):
+        if self.THREAD_HEADS is None or thr_idx < 0:
+            return
+        members = self.THREAD_MEMBERS.get(thr_idx)
+        if members is None:
+            members = self.THREAD_MEMBERS[thr_idx] = set()
+        members.add(msg_idx)
+        self._update_thread_head(thr_idx, msg_idx, old_fresh)
+
+    def _leave_thread(self, thr_idx, msg_idx):
+        if self.THREAD_HEADS is None or thr_idx < 0:
+            return
+        members = self.THREAD_MEMBERS.get(thr_idx, set())
+        if msg_idx in members:
+            members.discard(msg_idx)
+            if not members:
+                del self.THREAD_MEMBERS[thr_idx]
+            self._update_thread_head(thr_idx, msg_idx)
+
+    def _rebuild_threads(self):
+        with self._lock:
+            self.THREAD_MEMBERS = {}
+            for msg_idx, thr_idx in enumerate(self.INDEX_THR):
+                if thr_idx >= 0:
+                    members = self.THREAD_MEMBERS.get(thr_idx)
+                    if members is None:
+                        members = self.THREAD_MEMBERS[thr_idx] = set()
+                    members.add(msg_idx)
+            self.THREAD_HEADS = {}
+            for thr_idx in self.THREAD_MEMBERS:
+                self._update_thread_head(thr_idx)
+
+    def _rebuild_sorting(self, session=None):
+        if session:
+            session.ui.mark(_('Calculating sort orders...'))
+        self._prepare_sorting()
+        for ranks in self.SORT_RANKS.values():
+            ranks.defer()
+        for msg_idx in range(0, len(self.INDEX)):
+            for order in self.INDEX_SORT:
+                self.INDEX_SORT[order].append(0)
+            try:
+                msg_info = self.get_msg_at_idx_pos_uncached(msg_idx)
+            except ValueError:
+                continue
+            for order, sorter in self.SORT_ORDERS.iteritems():
+                self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
+        self._finish_sort_ranks()
+
+    def _sort_id(self, order, string):
+        with self._lock:
+            return self.SORT_RANKS[order].intern(string)
+
+    def _finish_sort_ranks(self):
+        with self._lock:
+            for ranks in self.SORT_RANKS.values():
+                ranks.finish()
+
+    def _sort_key(self, order):
+        """Return a function giving the sort key of a message."""
+        keys = self.INDEX_SORT[order]
+        if order in self.SORT_RANKS:
+            ranks = self.SORT_RANKS[order].ranks
+            return lambda msg_idx: ranks[keys[msg_idx]]
+        return keys.__getitem__
 
     def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
         with self._lock:
@@ -1630,11 +2091,15 @@ class MailIndex(BaseIndex):
                     self.INDEX_SORT[order].append(0)
 
         msg_thr_mid = msg_info[self.MSG_THREAD_MID].split('/')[0]
+        old_thr_idx = self.INDEX_THR[msg_idx]
         self.INDEX[msg_idx] = original_line or self.m2l(msg_info)
         self.INDEX_THR[msg_idx] = int(msg_thr_mid, 36)
         self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
         for msg_ptr in msg_info[self.MSG_PTRS].split(','):
             self.PTRS[msg_ptr] = msg_idx
+        if old_thr_idx != self.INDEX_THR[msg_idx]:
+            with self._lock:
+                self._leave_thread(old_thr_idx, msg_idx)
         self.update_msg_sorting(msg_idx, msg_info)
         self.update_msg_tags(msg_idx, msg_info)
 
@@ -1758,6 +2223,7 @@ class MailIndex(BaseIndex):
                 self.TAGS[tag_id] |= eids
             elif eids:
                 self.TAGS[tag_id] = eids
+            self.TAG_BITMAPS.pop(tag_id, None)
 
         # Record that these messages were touched in some way
         GlobalPostingList.Append(session,
@@ -1820,6 +2286,7 @@ class MailIndex(BaseIndex):
         with self._lock:
             if tag_id in self.TAGS:
                 self.TAGS[tag_id] -= eids
+            self.TAG_BITMAPS.pop(tag_id, None)
 
         # Record that these messages were touched in some way
         GlobalPostingList.Append(session,
@@ -1838,15 +2305,15 @@ class MailIndex(BaseIndex):
     def search_tag(self, session, term, hits, recursion=0):
         t = term.split(':', 1)
         tag_id, tag = t[1], self.config.get_tag(t[1])
-        results = []
+        results = Bitmap()
         if tag:
             tag_id = tag._key
             for subtag in self.config.get_tags(parent=tag_id):
-                results.extend(hits('%s:in' % subtag._key))
+                results.update(hits('%s:in' % subtag._key))
             if tag.magic_terms and recursion < 5:
-                results.extend(self.search(session, [tag.magic_terms],
-                                           recursion=recursion+1).as_set())
-        results.extend(hits('%s:in' % tag_id))
+                results.update(self.search(session, [tag.magic_terms],
+                                           recursion=recursion+1).as_bitmap())
+        results.update(hits('%s:in' % tag_id))
         return results, tag
 
     def search(self, session, searchterms,
@@ -1863,17 +2330,10 @@ class MailIndex(BaseIndex):
             # Normal search
             def hits(term):
                 if term.endswith(':in'):
-                    return self.TAGS.get(term.rsplit(':', 1)[0], [])
+                    return self._tag_bitmap(term.rsplit(':', 1)[0])
                 else:
                     session.ui.mark(_('Searching for %s') % term)
-                    gpl_hits = GlobalPostingList(session, term).hits()
-                    try:
-                        return [int(h, 36) for h in gpl_hits]
-                    except ValueError:
-                        b36re = re.compile('^[a-zA-Z0-9]{1,8}$')
-                        print('FIXME! BAD HITS: %s => %s' % (term, [
-                            h for h in gpl_hits if not b36re.match(h)]))
-                        return [int(h, 36) for h in gpl_hits if b36re.match(h)]
+                    return GlobalPostingList(session, term).hits()
 
         # Replace some GMail-compatible terms with what we really use
         if 'tags' in self.config:
@@ -1892,8 +2352,15 @@ class MailIndex(BaseIndex):
         if searchterms and searchterms[0] and searchterms[0][0] == '-':
             searchterms[:0] = ['all:mail']
 
+        # Message indexes from the search terms or context are only trusted
+        # if they exist, as bitmaps are sized by their largest member. When
+        # filtering by keywords, the message may be about to be added.
+        index_size = len(self.INDEX) + (1 if keywords is not None else 0)
+        def in_index(msg_idxs):
+            return [i for i in msg_idxs if 0 <= i < index_size]
+
         if context:
-            r = [(None, set(context))]
+            r = [(None, Bitmap(in_index(context)))]
         else:
             r = []
 
@@ -1913,7 +2380,7 @@ class MailIndex(BaseIndex):
             else:
                 op = None
 
-            r.append((op, []))
+            r.append((op, Bitmap()))
             rt = r[-1][1]
             term = term.lower()
 
@@ -1921,7 +2388,7 @@ class MailIndex(BaseIndex):
                 if term.startswith('in:'):
                     results, tag = self.search_tag(session, term, hits,
                                                    recursion=recursion)
-                    rt.extend(results)
+                    rt.update(results)
                     if tag:
                         if tag.flag_hides:
                             searched_invisible = True
@@ -1929,12 +2396,12 @@ class MailIndex(BaseIndex):
                             searched_mailbox = True
 
                 elif term.startswith('mid:'):
-                    rt.extend([int(t, 36) for t in
-                               term[4:].replace('=', '').split(',')])
+                    rt.update(in_index([int(t, 36) for t in
+                                        term[4:].replace('=', '').split(',')]))
                 elif term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
+                    rt.update(hits(term[5:]))
                 elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
+                    rt.update(Bitmap.Range(len(self.INDEX)))
                 elif term in ('to:me', 'cc:me', 'from:me'):
                     vcards = self.config.vcards
                     emails = []
@@ -1942,20 +2409,20 @@ class MailIndex(BaseIndex):
                         emails += [vcl.value for vcl in vc.get_all('email')]
                     for email in set(emails):
                         if email:
-                            rt.extend(hits('%s:%s' % (email,
+                            rt.update(hits('%s:%s' % (email,
                                                       term.split(':')[0])))
                 elif term == 'is:encrypted':
                     for status in EncryptionInfo.STATUSES:
                         if status in CryptoInfo.STATUSES:
                             continue
-                        rt.extend(self.search_tag(
+                        rt.update(self.search_tag(
                             session, 'in:mp_enc-%s' % status, hits,
                             recursion=recursion)[0])
                 elif term == 'is:signed':
                     for status in SignatureInfo.STATUSES:
                         if status in CryptoInfo.STATUSES:
                             continue
-                        rt.extend(self.search_tag(
+                        rt.update(self.search_tag(
                             session, 'in:mp_sig-%s' % status, hits,
                             recursion=recursion)[0])
                 else:
@@ -1964,30 +2431,30 @@ class MailIndex(BaseIndex):
                     t = term.split(':', 1)
                     fnc = _plugins.get_search_term(t[0])
                     if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
+                        rt.update(fnc(self.config, self, term, hits))
                     else:
-                        rt.extend(hits('%s:%s' % (t[1], t[0])))
+                        rt.update(hits('%s:%s' % (t[1], t[0])))
             else:
-                rt.extend(hits(term))
+                rt.update(hits(term))
 
         if r:
-            results = set(r[0][1])
+            results = r[0][1].copy()
             for (op, rt) in r[1:]:
                 if op == '+':
-                    results |= set(rt)
+                    results |= rt
                 elif op == '-':
-                    results -= set(rt)
+                    results -= rt
                 else:
-                    results &= set(rt)
+                    results &= rt
             # Sometimes the scan gets aborted...
             if keywords is None:
-                results -= set([len(self.INDEX)])
+                results.discard(len(self.INDEX))
         else:
-            results = set()
+            results = Bitmap()
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
-        exclude = []
+        exclude = Bitmap()
         order = order or (session and session.order) or 'flat-index'
         if (results and (keywords is None) and
                 (not searched_invisible) and
@@ -2002,7 +2469,7 @@ class MailIndex(BaseIndex):
                 exclude_terms = ([exclude_terms[0]] +
                                  ['+%s' % e for e in exclude_terms[1:]])
             # Recursing to pull the excluded terms from cache as well
-            exclude = self.search(session, exclude_terms).as_set()
+            exclude = self.search(session, exclude_terms).as_bitmap()
 
         # Decide if this is cached or not
         if keywords is None:
@@ -2030,21 +2497,261 @@ class MailIndex(BaseIndex):
                 return ts + self.FRESHNESS_SORT_BOOST
         return ts
 
+    # Sorting by sender or subject stores the ID of the string in a
+    # RankTable, which knows how to sort them, so each order costs one
+    # machine word per message plus a fixed-size key per distinct string.
+    def _from_sorter(self, msg_info):
+        email, name = ExtractEmailAndName(msg_info[self.MSG_FROM])
+        return self._sort_id('from', name)
+
+    def _subject_sorter(self, msg_info):
+        subject = msg_info[self.MSG_SUBJECT]
+        if isinstance(subject, str):
+            subject = subject.decode('utf-8', 'replace')
+        return self._sort_id('subject',
+                             self.SUBJECT_PREFIX_RE.sub(u'', subject))
+
     FRESHNESS_SORT_BOOST = (5 * 24 * 3600)
+    SUBJECT_PREFIX_RE = re.compile(r'^(\s*(re|fwd?|aw|sv|vs)\s*:)+\s*',
+                                   flags=re.IGNORECASE)
     SORT_ORDERS = {
         'freshness': _freshness_sorter,
         'date': lambda s, mi: long(mi[s.MSG_DATE], 36),
-# FIXME: The following are disabled for now for being memory hogs
-#       'from': lambda s, mi: s.mi[s.MSG_FROM]),
-#       'subject': lambda s, mi: s.mi[s.MSG_SUBJECT]),
+        'from': _from_sorter,
+        'subject': _subject_sorter,
     }
+    RANKED_SORT_ORDERS = ('from', 'subject')
 
     def _prepare_sorting(self):
         self._sort_freshness_tags = [tag._key for tag in
                                      self.config.get_tags(type='unread')]
         self.INDEX_SORT = {}
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order] = []
+            self.INDEX_SORT[order] = array('l')
+        self.SORT_RANKS = dict((order, RankTable())
+                               for order in self.RANKED_SORT_ORDERS)
+
+    SORT_CACHE_MAGIC = 'SORT:3'
+
+    def _sort_cache_file(self):
+        return os.path.join(self.config.workdir, 'mailpile-sort.dat')
+
+    def _metadata_stamp(self):
+        """A stamp which changes whenever the saved metadata changes."""
+        if os.path.exists(self.config.mailindex_file()):
+            st = os.stat(self.config.mailindex_file())
+            return '%x.%x' % (st.st_size, int(st.st_mtime * 1000))
+        elif self._records is not None:
+            return self._records.stamp()
+        return None
+
+    def _sort_cache_header(self, stamp, count):
+        return '%s\t%s\t%s\t%s\t%d\n' % (self.SORT_CACHE_MAGIC, stamp,
+                                         ','.join(self._sort_freshness_tags),
+                                         ','.join(sorted(self.INDEX_SORT)),
+                                         count)
+
+    def _save_sort_cache(self, session=None):
+        """
+        Write the sort keys and thread IDs to disk as packed arrays, so the
+        next load() can skip calculating them. This is only valid as long
+        as the metadata on disk does not change, so we stamp it.
+        """
+        stamp = self._metadata_stamp()
+        if not stamp:
+            return
+        with self._lock:
+            count = len(self.INDEX)
+            data = [self._sort_cache_header(stamp, count),
+                    self.INDEX_THR[:count].tostring()]
+            for order in sorted(self.INDEX_SORT.keys()):
+                data.append(self.INDEX_SORT[order][:count].tostring())
+            for order in sorted(self.SORT_RANKS.keys()):
+                ranks = self.SORT_RANKS[order].dumps()
+                data.append('%d\n%s' % (len(ranks), ranks))
+        data = ''.join(data)
+        self._write_cache_file(self._sort_cache_file(), data, 'SortCache',
+                               session=session)
+
+    def _write_cache_file(self, cache_file, data, name, session=None):
+        try:
+            if self.config.get_master_key():
+                with EncryptingStreamer(self.config.get_master_key(),
+                                        delimited=False,
+                                        dir=self.config.tempfile_dir(),
+                                        name=name) as fd:
+                    fd.write(data)
+                    fd.save(cache_file)
+            else:
+                with open(cache_file, 'wb') as fd:
+                    fd.write(data)
+        except (IOError, OSError):
+            if session:
+                session.ui.warning(_('Failed to save cache: %s'
+                                     ) % cache_file)
+
+    def _read_cache_file(self, cache_file, magic):
+        with open(cache_file, 'rb') as fd:
+            first = fd.readline()
+            if first.startswith(magic):
+                chunks = [first, fd.read()]
+            else:
+                chunks = []
+                fd.seek(0)
+                decrypt_and_parse_lines(fd, chunks.extend, self.config,
+                                        newlines=True, decode=False)
+        return ''.join(chunks)
+
+    def _load_sort_cache(self, session=None):
+        stamp = self._metadata_stamp()
+        try:
+            data = self._read_cache_file(self._sort_cache_file(),
+                                         self.SORT_CACHE_MAGIC)
+            header, data = data.split('\n', 1)
+            count = int(header.split('\t')[-1])
+            if not stamp or (header + '\n' !=
+                             self._sort_cache_header(stamp, count)):
+                return None
+
+            arrays, offset = {}, 0
+            for order in ['thr'] + sorted(self.INDEX_SORT.keys()):
+                arrays[order] = array('l')
+                size = count * arrays[order].itemsize
+                arrays[order].fromstring(data[offset:offset + size])
+                if len(arrays[order]) != count:
+                    return None
+                offset += size
+            data = data[offset:]
+            for order in sorted(self.SORT_RANKS.keys()):
+                size, data = data.split('\n', 1)
+                size = int(size)
+                arrays['ranks:%s' % order] = RankTable.loads(data[:size])
+                data = data[size:]
+            return arrays
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+
+    COLUMN_CACHE_MAGIC = 'COLS:1'
+
+    def _column_cache_file(self):
+        return os.path.join(self.config.workdir, 'mailpile-columns.dat')
+
+    def _save_column_cache(self, session=None):
+        """
+        Write the e-mail table and the metadata columns we keep in RAM to
+        one file, so the next load() can skip decrypting every record in
+        the record store. Like the sort cache, it is only valid as long as
+        the records on disk do not change, so we stamp it.
+        """
+        if self._records is None:
+            return
+        stamp = self._records.stamp()
+        with self._lock:
+            if self.MODIFIED:
+                # The cache would be ahead of the records on disk.
+                return
+            ptrs, msgids = {}, {}
+            for ptr, pos in self.PTRS.iteritems():
+                ptrs.setdefault(pos, []).append(ptr)
+            for msgid, pos in self.MSGIDS.iteritems():
+                msgids[pos] = msgid
+            data = ['%s\t%s\t%d\t%d\n' % (self.COLUMN_CACHE_MAGIC, stamp,
+                                           len(self.EMAILS), len(self.INDEX))]
+            for email in self.EMAILS:
+                data.append(quote(email.encode('utf-8')) + '\n')
+            for pos in range(0, len(self.INDEX)):
+                data.append(self.INDEX.get_columns(pos, {
+                    self.MSG_MID: b36(pos),
+                    self.MSG_PTRS: ','.join(sorted(ptrs.get(pos, []))),
+                    self.MSG_ID: msgids.get(pos, ''),
+                    self.MSG_THREAD_MID: b36(self.INDEX_THR[pos])
+                }) + '\n')
+        self._write_cache_file(self._column_cache_file(), ''.join(data),
+                               'ColumnCache', session=session)
+
+    def _load_column_cache(self, session=None):
+        """
+        Load the e-mail table and metadata columns saved by
+        _save_column_cache(), evicting everything else. Returns False if
+        the cache is missing or stale, in which case nothing is changed.
+        """
+        try:
+            data = self._read_cache_file(self._column_cache_file(),
+                                         self.COLUMN_CACHE_MAGIC)
+            lines = data.split('\n')
+            magic, stamp, emails, count = lines[0].split('\t')
+            emails, count = int(emails), int(count)
+            if (magic != self.COLUMN_CACHE_MAGIC or
+                    stamp != self._records.stamp() or
+                    len(lines) != 2 + emails + count):
+                return False
+        except (IOError, OSError, ValueError):
+            return False
+
+        for line in lines[1:1 + emails]:
+            email = unquote(line).decode('utf-8')
+            if email:
+                self.EMAIL_IDS[email.split()[0].lower()] = len(self.EMAILS)
+            self.EMAILS.append(email)
+        for pos, line in enumerate(lines[1 + emails:-1]):
+            words = line.split('\t')
+            if len(words) == self.MSG_FIELDS_V2:
+                self.set_msg_at_idx_pos(pos, words, original_line=line)
+                self.INDEX.evict(pos)
+                if session and pos % 1009 == 1000:
+                    session.ui.mark(_('Loading metadata index...') +
+                                    ' %s' % pos)
+        # Messages whose ID now points elsewhere were saved without one.
+        self.MSGIDS.pop('', None)
+        return True
+
+    def _unread_set(self, session):
+        """
+        The set of all unread messages, cached until any of the unread tags
+        change (which replaces their bitmaps).
+        """
+        bitmaps = [self._tag_bitmap(tag._key) for tag in
+                   session.config.get_tags(type='unread')]
+        cached = self._unread_cache
+        if (cached and len(cached[0]) == len(bitmaps) and
+                not [1 for a, b in zip(cached[0], bitmaps) if a is not b]):
+            return cached[1]
+        unread = Bitmap()
+        for bitmap in bitmaps:
+            unread |= bitmap
+        unread = unread.as_set()
+        self._unread_cache = (bitmaps, unread)
+        return unread
+
+    def _collapse_by_thread_heads(self, results):
+        """
+        Sort results by rev-freshness, keeping one message per thread: the
+        oldest unread one, or else the freshest. Threads are placed by the
+        freshness of their head, so we only sort one message per thread.
+        """
+        fresh = self.INDEX_SORT['freshness']
+        key = lambda m: (fresh[m], m)
+        result_set = set(results)
+        heads = {}
+        with self._lock:
+            for ri in results:
+                ti = self.INDEX_THR[ri]
+                if ti in heads:
+                    continue
+                head, unread = self.THREAD_HEADS.get(ti, (None, None))
+                if head in result_set and (unread is None or
+                                           unread in result_set):
+                    heads[ti] = (head, head if (unread is None) else unread)
+                else:
+                    # Only part of the thread matched; look at that part.
+                    members = [m for m in self.THREAD_MEMBERS.get(ti, ())
+                               if m in result_set] or [ri]
+                    unread = [m for m in members if self._is_fresh(m)]
+                    head = max(members, key=key)
+                    heads[ti] = (head, min(unread or [head], key=key))
+        heads = heads.values()
+        heads.sort(key=lambda hr: key(hr[0]), reverse=True)
+        results[:] = [rep for head, rep in heads]
 
     def sort_results(self, session, results, how):
         if not results:
@@ -2052,12 +2759,17 @@ class MailIndex(BaseIndex):
 
         count = len(results)
         how = how or 'flat-unsorted'
+
+        # Conversations by freshness is the default view. We keep track of
+        # the head of each thread, so we only need to sort those.
+        by_heads = (how == 'rev-freshness' and self.THREAD_HEADS is not None)
+
         session.ui.mark(_n('Sorting %d message by %s...',
                            'Sorting %d messages by %s...',
                            count
                            ) % (count, _(how)))
         try:
-            if how.endswith('unsorted'):
+            if by_heads or how.endswith('unsorted'):
                 pass
             elif how.endswith('index'):
                 results.sort()
@@ -2069,8 +2781,7 @@ class MailIndex(BaseIndex):
                 for order in self.INDEX_SORT:
                     if how.endswith(order):
                         try:
-                            results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                            results.sort(key=self._sort_key(order))
                         except IndexError:
                             say = session.ui.error
                             if session.config.sys.debug:
@@ -2084,8 +2795,7 @@ class MailIndex(BaseIndex):
                             say(_('Please tell team@mailpile.is !'))
                             clean_results = [r for r in results
                                              if r >= 0 and r < len(self.INDEX)]
-                            clean_results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                            clean_results.sort(key=self._sort_key(order))
                             results[:] = clean_results
                         did_sort = True
                         break
@@ -2098,31 +2808,33 @@ class MailIndex(BaseIndex):
             session.ui.warning(_('Sort failed, sorting badly. Partial index?'))
             results.sort()
 
-        if how.startswith('rev'):
+        if how.startswith('rev') and not by_heads:
             results.reverse()
 
-        if 'flat' not in how:
+        if by_heads:
+            session.ui.mark(_('Collapsing conversations...'))
+            self._collapse_by_thread_heads(results)
+        elif 'flat' not in how:
             all_new = set()
             if 'freshness' in how:
-                # FIXME: This calculation appears very cachable!
-                new_tags = session.config.get_tags(type='unread')
-                for tag in new_tags:
-                    all_new |= self.TAGS.get(tag._key, set([]))
+                all_new = self._unread_set(session)
 
-            # This filters away all but the first (or oldst unread) result in
-            # each conversation.
+            # This filters away all but the first (or oldest unread) result
+            # in each conversation.
             session.ui.mark(_('Collapsing conversations...'))
             seen, pi = {}, 0
             for ri in results:
                 ti = self.INDEX_THR[ri]
                 if ti in seen:
-                    if ti in all_new:
+                    if ri in all_new:
                         results[seen[ti]] = ri
                 else:
                     results[pi] = ri
                     seen[ti] = pi
                     pi += 1
             results[pi:] = []
+
+        if 'flat' not in how:
             session.ui.mark(_n('Sorted %d message by %s',
                                'Sorted %d messages by %s',
                                count
@@ -2137,7 +2849,6 @@ class MailIndex(BaseIndex):
                                'Sorted %d messages by %s',
                                count
                                ) % (count, _(how)))
-
         return True
 
 
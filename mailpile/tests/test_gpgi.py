@@ -0,0 +1,145 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from mock import Mock, patch
+
+from mailpile.crypto.gpgi import GnuPG, GnuPGKeyringCache, GnuPGWorkerPool
+from mailpile.crypto.gpgi import GNUPG_KEYRINGS, GNUPG_VERIFIED, GNUPG_WORKERS
+
+
+class TestGnuPGWorkerPool(unittest.TestCase):
+    ARGS = ['gpg', '--status-file=/tmp/status', '--verify']
+
+    def _add_worker(self, pool):
+        proc = Mock()
+        proc.poll.return_value = None
+        key = pool._key(self.ARGS)
+        pool.idle[key] = [(9e99, os.getpid(), proc, '/tmp/status')]
+        return proc
+
+    def test_forked_child_does_not_reuse_workers(self):
+        pool = GnuPGWorkerPool()
+        proc = self._add_worker(pool)
+        pool.lock.acquire()  # As if another thread held it when forking
+
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                worker = pool.take(self.ARGS)
+                os.write(wfd, 'ok' if (worker is None and
+                                       not pool.idle and
+                                       not proc.method_calls) else 'bad')
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        result = os.read(rfd, 10)
+        os.close(rfd)
+        os.waitpid(pid, 0)
+        pool.lock.release()
+
+        self.assertEqual(result, 'ok')
+        self.assertEqual(pool.take(self.ARGS), (proc, '/tmp/status'))
+
+
+class TestVerifyBatch(unittest.TestCase):
+    MESSAGE = os.path.join(os.path.dirname(__file__), 'data', 'Maildir',
+                           'cur', '1379857166.25980_9.hottie,2,S')
+    BOUNDARY = '--===============7038572445886209563=='
+
+    def setUp(self):
+        # Work on a copy, as GnuPG 2.1+ migrates the keyring it is given
+        self.homedir = tempfile.mkdtemp()
+        keyring = os.path.join(os.path.dirname(__file__), 'data',
+                               'gpg-keyring')
+        for fn in ('pubring.gpg', 'secring.gpg', 'trustdb.gpg'):
+            shutil.copy(os.path.join(keyring, fn), self.homedir)
+        self.gnupg = GnuPG(None)
+        self.gnupg.homedir = self.homedir
+        GNUPG_VERIFIED.flush()
+
+    def tearDown(self):
+        GNUPG_VERIFIED.flush()
+        GNUPG_WORKERS.flush()
+        try:
+            subprocess.call(['gpgconf', '--homedir', self.homedir,
+                             '--kill', 'gpg-agent'])
+        except OSError:
+            pass
+        shutil.rmtree(self.homedir)
+
+    def _items(self):
+        with open(self.MESSAGE) as fd:
+            parts = fd.read().split(self.BOUNDARY)
+        data = parts[1][1:-1].replace('\n', '\r\n')
+        signature = parts[2].split('\n\n', 1)[1].strip()
+        status, clearsigned = self.gnupg.sign('Hello, World\n',
+                                              clearsign=True)
+        self.assertEqual(status, 0)
+        return [
+            (data, signature),
+            (data.replace('original', 'tampered'), signature),
+            (clearsigned, None),
+            (clearsigned.replace('Hello', 'Howdy'), None),
+            (data, None)]
+
+    def test_batch_matches_verify(self):
+        items = self._items()
+        expected = [self.gnupg.verify(*item) for item in items]
+        self.assertEqual([si['status'] for si in expected[:4]],
+                         ['verified', 'invalid', 'verified', 'invalid'])
+
+        results = self.gnupg.verify_batch(items)
+        self.assertEqual(len(results), len(items))
+        self.assertEqual(results[0], expected[0])
+        self.assertEqual(results[2], expected[2])
+        for si, exp in zip(results, expected):
+            # None means "ask verify()", anything else must agree with it
+            self.assertTrue(si is None or si == exp)
+
+    def test_tampered_data_is_not_served_from_cache(self):
+        items = self._items()
+        for item, si in zip(items, self.gnupg.verify_batch(items)):
+            if si is not None:
+                GNUPG_VERIFIED.put(GNUPG_VERIFIED.key(self.gnupg, *item), si)
+
+        for i in (1, 3):
+            self.assertEqual(self.gnupg.verify(*items[i])['status'],
+                             'invalid')
+        self.assertEqual(self.gnupg.verify(*items[0])['status'], 'verified')
+
+
+class TestKeyringCache(unittest.TestCase):
+    KEY = os.path.join(os.path.dirname(__file__), 'data', 'pub.key')
+    FINGERPRINT = '08A650B8E2CBC1B02297915DC65626EED13C70DA'
+
+    def setUp(self):
+        self.homedir = tempfile.mkdtemp()
+        self.gnupg = GnuPG(None)
+        self.gnupg.homedir = self.homedir
+        GNUPG_KEYRINGS.flush()
+
+    def tearDown(self):
+        GNUPG_KEYRINGS.flush()
+        GNUPG_WORKERS.flush()
+        shutil.rmtree(self.homedir)
+
+    def test_import_invalidates_cache(self):
+        # Keep the keyring files looking unchanged, so only Mailpile
+        # noticing the import can invalidate the cached key list.
+        with patch.object(GnuPGKeyringCache, '_stamp', return_value=()):
+            self.assertEqual(self.gnupg.list_keys(), {})
+            with patch.object(self.gnupg, '_list_keys') as loader:
+                self.assertEqual(self.gnupg.list_keys(), {})
+                self.assertFalse(loader.called)
+
+            with open(self.KEY) as fd:
+                result = self.gnupg.import_keys(fd.read())
+            self.assertEqual(len(result['imported']), 1)
+
+            self.assertEqual(self.gnupg.list_keys().keys(),
+                             [self.FINGERPRINT])
+            self.assertEqual(self.gnupg.list_keys(['0xD13C70DA']).keys(),
+                             [self.FINGERPRINT])
@@ -0,0 +1,57 @@
+from mock import patch
+import os
+import shutil
+
+from mailpile.tests import MailPileUnittest
+from mailpile.mail_source import MailSource
+
+
+mailpile_root = os.path.join(os.path.dirname(__file__), "..", "..")
+mailpile_tmp = os.path.join(mailpile_root, "mailpile", "tests", "data", "tmp")
+
+
+class TestLocalMailSource(MailPileUnittest):
+    def setUp(self):
+        self.maildir = os.path.join(mailpile_tmp, 'watched-maildir')
+        for sub in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(self.maildir, sub))
+        self.config.sources['lcltest'] = {}
+        self.src_cfg = self.config.sources['lcltest']
+        self.src_cfg.name = 'Watched'
+        self.src_cfg.protocol = 'local'
+        self.src_cfg.discovery.policy = 'read'
+        self.src_cfg.mailbox['0001'] = {
+            'name': 'watched',
+            'path': self.maildir,
+            'policy': 'read'}
+        self.src = MailSource(self.session, self.src_cfg)
+        self.src._load_state()
+
+    def tearDown(self):
+        self.src.close()
+        del self.config.sources['lcltest']
+        shutil.rmtree(self.maildir)
+
+    def _loop_pass(self):
+        # What one pass of BaseMailSource.run() does, minus the sleeping.
+        self.src._loop_count += 1
+        self.assertTrue(self.src.open())
+        self.src.sync_mail()
+        self.src._check_keepalive()
+
+    def test_watcher_survives_passes(self):
+        with patch('mailpile.mail_source.random.randint', return_value=0):
+            self._loop_pass()
+            watcher = self.src.watcher
+            if not watcher:
+                self.skipTest('inotify is not available')
+
+            with patch('os.path.getmtime', wraps=os.path.getmtime) as mt, \
+                    patch('os.path.getsize', wraps=os.path.getsize) as sz:
+                self._loop_pass()
+
+        # The second pass trusted inotify, instead of stat()-ing the
+        # unchanged mailbox or setting up a new watcher.
+        self.assertEqual(mt.call_count, 0)
+        self.assertEqual(sz.call_count, 0)
+        self.assertTrue(self.src.watcher is watcher)
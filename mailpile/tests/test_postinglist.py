@@ -0,0 +1,82 @@
+import os
+import threading
+from mock import MagicMock, patch
+
+import mailpile.postinglist
+from mailpile.config.manager import ConfigManager
+from mailpile.postinglist import GlobalPostingList
+from mailpile.tests import MailPileUnittest
+
+
+class TestKeywordJournal(MailPileUnittest):
+    def setUp(self):
+        GlobalPostingList.FlushJournal(self.session)
+        self.journal = GlobalPostingList.SaveFile(self.session, None)
+
+    def _journal_size(self):
+        if os.path.exists(self.journal):
+            return os.path.getsize(self.journal)
+        return 0
+
+    def _append(self, word):
+        GlobalPostingList.Append(self.session, word, ['1'])
+        return GlobalPostingList.WordSig(word, self.config)
+
+    def _buffered(self, sig):
+        return [l for l in mailpile.postinglist.GPL_JOURNAL_BUFFER
+                if l.startswith(sig + '\t')]
+
+    def test_appends_are_buffered(self):
+        size = self._journal_size()
+        sig = self._append('journaltestbuffered')
+        self.assertEqual(self._buffered(sig), ['%s\t1\n' % sig])
+        self.assertEqual(self._journal_size(), size)
+
+        self.assertEqual(GlobalPostingList.FlushJournal(self.session), 1)
+        self.assertEqual(mailpile.postinglist.GPL_JOURNAL_BUFFER, [])
+        self.assertTrue(self._journal_size() > size)
+
+    def test_flush_when_buffer_is_big(self):
+        with patch.object(GlobalPostingList, 'JOURNAL_FLUSH_BYTES', 1):
+            sig = self._append('journaltestbig')
+        self.assertEqual(self._buffered(sig), [])
+
+    def test_flush_when_buffer_is_old(self):
+        with patch.object(GlobalPostingList, 'JOURNAL_FLUSH_SECONDS', -1):
+            sig = self._append('journaltestold')
+        self.assertEqual(self._buffered(sig), [])
+
+    def test_failed_flush_keeps_buffer(self):
+        sig = self._append('journaltestfailed')
+        with patch.object(GlobalPostingList, 'SaveFile',
+                          return_value='/nonexistent/kw-journal.dat'):
+            self.assertEqual(GlobalPostingList.FlushJournal(self.session), 0)
+        self.assertEqual(self._buffered(sig), ['%s\t1\n' % sig])
+
+    def test_flush_before_save(self):
+        for save in (self.config.index.save, self.config.index.save_changes):
+            sig = self._append('journaltestsave')
+            save(self.session)
+            self.assertEqual(self._buffered(sig), [])
+
+    def test_flush_before_optimize(self):
+        sig = self._append('journaltestoptimize')
+        GlobalPostingList._Optimize(self.session, self.config.index,
+                                    lazy=True)
+        self.assertEqual(self._buffered(sig), [])
+
+    def test_flush_on_shutdown(self):
+        config = MagicMock()
+        config._lock = threading.RLock()
+        config._unlocked_get_all_workers.return_value = []
+        config.sys.debug = False
+        save_worker = config.save_worker
+
+        calls = []
+        save_worker.quit.side_effect = lambda **kw: calls.append('quit')
+        with patch.object(GlobalPostingList, 'FlushJournal',
+                          side_effect=lambda s: calls.append('flush')), \
+                patch('mailpile.postinglist.PLC_CACHE_FlushAndClean'), \
+                patch('mailpile.config.manager.GNUPG_WORKERS'):
+            ConfigManager.stop_workers.im_func(config)
+        self.assertEqual(calls, ['flush', 'quit'])
@@ -1,8 +1,18 @@
+# -*- coding: utf-8 -*-
 from __future__ import print_function
+import os
+import tempfile
+import shutil
 import unittest
+from array import array
+from mock import patch
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile
+from mailpile.index.parallel import ForkedMap
+from mailpile.postinglist import GlobalPostingList
+from mailpile.search import MailIndex
+from mailpile.util import b36
+from mailpile.tests import get_shared_mailpile, MailPileUnittest
 
 
 def checkSearch(query, expected_count=1):
@@ -49,3 +59,214 @@ def test_generator():
 
     # Test that we do not crash when searching for a non-existant tag.
     yield checkSearch(['in:doesnotexist'], 0)
+
+
+class TestBooleanSearch(MailPileUnittest):
+    """Check the bitmap-based boolean search against plain Python sets."""
+    def _term_set(self, term):
+        idx = self.config.index
+        if term == 'all:mail':
+            return set(range(0, len(idx.INDEX)))
+        elif term.startswith('mid:'):
+            return set(i for i in [int(t, 36) for t in term[4:].split(',')]
+                       if 0 <= i < len(idx.INDEX))
+        elif ':' in term:
+            term = '%s:%s' % tuple(reversed(term.split(':', 1)))
+        return set(GlobalPostingList(self.session, term).hits())
+
+    def _set_search(self, terms):
+        if terms[0][0] == '-':
+            terms = ['all:mail'] + terms
+        results = self._term_set(terms[0])
+        for term in terms[1:]:
+            if term[0] == '+':
+                results |= self._term_set(term[1:])
+            elif term[0] == '-':
+                results -= self._term_set(term[1:])
+            else:
+                results &= self._term_set(term)
+        results.discard(len(self.config.index.INDEX))
+        return results
+
+    def _check(self, terms):
+        srs = self.config.index.search(self.session, terms[:])
+        expected = self._set_search(terms) - srs.excluded().as_set()
+        self.assertEqual(srs.as_set(), expected, terms)
+        return expected
+
+    def test_boolean_searches(self):
+        self.assertTrue(self._check(['all:mail']))
+        self.assertTrue(self._check(['brennan']))
+        self.assertTrue(self._check(['brennan', '+twitter']))
+        self._check(['brennan', 'twitter'])
+        self._check(['brennan', '-twitter'])
+        self._check(['-brennan'])
+        self._check(['all:mail', '-from:twitter', '+brennan'])
+        self._check(['mid:1,3,5', '+twitter', '-brennan'])
+        self._check(['-mid:0,2'])
+
+    def test_bogus_message_ids(self):
+        # These used to allocate giant bitmaps or wrap around.
+        self.assertEqual(self._check(['mid:zzzzzzzz']), set())
+        self.assertTrue(self._check(['mid:-1,1']) <= set([1]))
+
+
+class TestThreadHeads(MailPileUnittest):
+    """Check collapsing by thread heads against the generic collapse."""
+    def _collapsed(self, results, by_heads):
+        idx = self.config.index
+        results = list(results)
+        if by_heads:
+            idx.sort_results(self.session, results, 'rev-freshness')
+        else:
+            with patch.object(idx, 'THREAD_HEADS', None):
+                idx.sort_results(self.session, results, 'rev-freshness')
+        return results
+
+    def _check_heads(self):
+        idx = self.config.index
+        heads = dict(idx.THREAD_HEADS)
+        idx._rebuild_threads()
+        self.assertEqual(idx.THREAD_HEADS, heads)
+
+        everything = range(0, len(idx.INDEX))
+        for results in (everything, everything[::2], everything[1::3]):
+            self.assertEqual(self._collapsed(results, True),
+                             self._collapsed(results, False))
+
+    def test_collapse_by_thread_heads(self):
+        idx = self.config.index
+        count = len(idx.INDEX)
+        dates = idx.INDEX_SORT['date']
+
+        # Group the test messages into threads of four, and make every
+        # third message unread by giving it a freshness boost.
+        threads = array('l', [m - (m % 4) for m in range(0, count)])
+        fresh = array('l', [dates[m] + (1000 if (m % 3 == 1) else 0)
+                            for m in range(0, count)])
+        def unread_set(session):
+            return set(m for m in range(0, count) if idx._is_fresh(m))
+
+        with patch.object(idx, 'INDEX_THR', threads), \
+                patch.dict(idx.INDEX_SORT, {'freshness': fresh}), \
+                patch.object(idx, 'THREAD_MEMBERS', {}), \
+                patch.object(idx, 'THREAD_HEADS', {}), \
+                patch.object(idx, '_unread_set', unread_set):
+            idx._rebuild_threads()
+            self._check_heads()
+
+            # Mark messages read and unread, one at a time
+            for m in (1, 4, 5, 0, 12, 7, 4):
+                old_fresh = fresh[m]
+                if idx._is_fresh(m):
+                    fresh[m] = dates[m]
+                else:
+                    fresh[m] = dates[m] + 2000 + m
+                idx._join_thread(threads[m], m, old_fresh)
+                self._check_heads()
+
+        idx._rebuild_threads()
+
+
+class TestParallelScan(MailPileUnittest):
+    """Check that parallel indexing gives the same results as serial."""
+    def _scan(self, experiments):
+        keywords = {}
+        def append(session, word, msg_mids, compact=True):
+            for msg_mid in msg_mids:
+                keywords.setdefault(msg_mid, set()).add(word)
+
+        read = []
+        real_map = ForkedMap.map
+        def forked_map(fm, args_list):
+            results = real_map(fm, args_list)
+            read.extend(results)
+            return results
+
+        mbx_id, mbx_path = [(fid, fpath) for fid, fpath, sc
+                            in self.config.get_mailboxes()
+                            if fpath.endswith('Maildir')][0]
+        old_experiments = self.config.sys.experiments
+        idx = MailIndex(self.config)
+        try:
+            self.config.sys.experiments = experiments
+            with patch.object(GlobalPostingList, 'Append',
+                              side_effect=append), \
+                    patch.object(ForkedMap, 'map', forked_map):
+                idx.scan_mailbox(self.session, mbx_id, mbx_path,
+                                 self.config.open_mailbox, force=True)
+        finally:
+            self.config.sys.experiments = old_experiments
+        return idx, keywords, read
+
+    def test_parallel_scan(self):
+        serial, serial_kws, read = self._scan('')
+        self.assertEqual(read, [])
+        parallel, parallel_kws, read = self._scan('parallel_indexing')
+
+        # Most messages were read elsewhere, the signed and encrypted
+        # ones were left for us.
+        self.assertTrue([r for r in read if r is not None])
+        self.assertTrue([r for r in read if r is None])
+
+        self.assertTrue(len(serial.INDEX) > 2)
+        self.assertEqual([parallel.INDEX[i]
+                          for i in range(0, len(parallel.INDEX))],
+                         [serial.INDEX[i]
+                          for i in range(0, len(serial.INDEX))])
+        self.assertEqual(parallel_kws, serial_kws)
+
+
+class TestSortRanks(MailPileUnittest):
+    """Sorting by sender and subject, with non-ASCII metadata."""
+    SENDERS = [u'Zo\xeb <z@example.com>', u'\xc1sta <a@example.com>',
+               u'bob <b@example.com>', u'\xc9mile <e@example.com>',
+               u'\u0414\u043c\u0438\u0442\u0440\u0438\u0439 <d@example.com>']
+    SUBJECTS = [u'Re: \xdcber', u'apple', u'\xc4rger', u'zebra', u'Fwd: Bob']
+
+    def _msg_info(self, msg_idx, sender, subject):
+        return [b36(msg_idx), u'', u'<%d@example.com>' % msg_idx,
+                b36(1400000000 + msg_idx), sender, u'', u'', b36(1),
+                subject, u'', u'', u'', b36(msg_idx)]
+
+    def _sorted(self, idx, order):
+        results = list(range(0, len(idx.INDEX)))
+        idx.sort_results(self.session, results, 'flat-%s' % order)
+        return results
+
+    def test_load_and_rank_utf8(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            idx_file = os.path.join(tmpdir, 'mailpile.idx')
+            with open(idx_file, 'w') as fd:
+                for i, (sender, subject) in enumerate(zip(self.SENDERS,
+                                                          self.SUBJECTS)):
+                    fd.write(MailIndex.m2l(self._msg_info(i, sender, subject)))
+                    fd.write('\n')
+
+            # Load it in isolation from the shared test index
+            idx = MailIndex(self.config)
+            with patch.object(idx, '_sort_cache_file',
+                              return_value=os.path.join(tmpdir, 'sort.dat')
+                              ), patch.object(self.config, 'mailindex_file',
+                                              return_value=idx_file), \
+                    patch.object(GlobalPostingList, 'GetMaxMsgIdxPos',
+                                 return_value=0):
+                idx.load(self.session)
+            self.assertEqual(len(idx.INDEX), 5)
+
+            # Accents and case are ignored, Cyrillic sorts after Latin
+            self.assertEqual(self._sorted(idx, 'from'), [1, 2, 3, 0, 4])
+            self.assertEqual(self._sorted(idx, 'subject'), [1, 2, 4, 0, 3])
+
+            # New messages are ranked as they arrive; \xc6 and \xf8 do not
+            # decompose, so they sort after z and o respectively
+            idx.set_msg_at_idx_pos(5, self._msg_info(5, u'\xc6gir <g@x>',
+                                                     u'Re: \xe1\xe1'))
+            idx.set_msg_at_idx_pos(6, self._msg_info(6, u'Bj\xf6rn <b@x>',
+                                                     u'B\xf8k'))
+            self.assertEqual(self._sorted(idx, 'from'), [1, 6, 2, 3, 0, 5, 4])
+            self.assertEqual(self._sorted(idx, 'subject'),
+                             [5, 1, 2, 4, 6, 0, 3])
+        finally:
+            shutil.rmtree(tmpdir)